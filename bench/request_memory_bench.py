@@ -0,0 +1,69 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      request_memory_bench
+# Author:    liangbaikai
+# Date:      2021/1/30
+# Desc:      bytes per queued request, with and without __slots__
+# ------------------------------------------------------------------
+import dataclasses
+import gc
+import os
+import sys
+import tracemalloc
+from collections import deque
+
+# 从仓库根目录运行: python bench/request_memory_bench.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smart.request import Request
+from smart.response import Response
+
+# 和 Request 字段相同 但有 __dict__ 的对照类 即加 __slots__ 之前的 Request
+DictRequest = dataclasses.make_dataclass(
+    "DictRequest", [(field.name, field.type, field) for field in dataclasses.fields(Request)])
+DictResponse = dataclasses.make_dataclass(
+    "DictResponse", [(field.name, field.type, field) for field in dataclasses.fields(Response)])
+
+
+def measure(factory, count: int) -> float:
+    """
+    队列中每个对象占用的字节数 不含 url 等共享的值
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    queue = deque(factory(i) for i in range(count))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(queue) == count
+    return (after - before) / count
+
+
+def slot_request(i):
+    request = Request("http://www.example.com/", priority=i & 7)
+    request.__spider__ = None
+    return request
+
+
+def dict_request(i):
+    request = DictRequest(priority=i & 7)
+    request.url = "http://www.example.com/"
+    request.__spider__ = None
+    return request
+
+
+def slot_response(i):
+    return Response(b"", 200)
+
+
+def dict_response(i):
+    return DictResponse(b"", 200)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, before, after in (("request", dict_request, slot_request),
+                                ("response", dict_response, slot_response)):
+        before_size, after_size = measure(before, count), measure(after, count)
+        print(f"{name}: {before_size:.1f} bytes with __dict__, {after_size:.1f} bytes with __slots__, "
+              f"saved {(1 - after_size / before_size) * 100:.1f}%")
@@ -0,0 +1,53 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      serialize_bench
+# Author:    liangbaikai
+# Date:      2021/2/2
+# Desc:      bytes and encode/decode speed of the request wire format against pickle
+# ------------------------------------------------------------------
+import os
+import pickle
+import sys
+import timeit
+
+# 从仓库根目录运行: python bench/serialize_bench.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smart.request import Request
+from smart.serialize import dumps_request, loads_request, request_to_tuple, request_from_tuple
+
+
+class BenchSpider:
+    # 爬虫一般有配置等状态 旧的 redis 容器 pickle 整个请求时会一起序列化
+    cutome_setting_dict = {"req_per_concurrent": 100, "default_headers": {"user-agent": "x" * 100}}
+    start_urls = [f"http://www.example.com/{i}" for i in range(20)]
+
+    def parse(self, response):
+        pass
+
+
+spider = BenchSpider()
+# 包含 callback 的 pickle 需要能找到 spider 的类
+sys.modules["__main__"].BenchSpider = BenchSpider
+
+
+def make_request(i: int) -> Request:
+    return Request(f"http://www.example.com/list?page={i}", callback=spider.parse,
+                   header={"Referer": "http://www.example.com/"}, meta={"page": i, "depth": 2})
+
+
+def bench(name, dumps, loads, count):
+    requests = [make_request(i) for i in range(count)]
+    codes = [dumps(request) for request in requests]
+    size = sum(map(len, codes)) / count
+    dumps_time = timeit.timeit(lambda: [dumps(request) for request in requests], number=3) / 3
+    loads_time = timeit.timeit(lambda: [loads(code) for code in codes], number=3) / 3
+    print(f"{name:<12} {size:8.1f} bytes  encode {count / dumps_time:10.0f}/s  decode {count / loads_time:10.0f}/s")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bench("pickle", lambda r: pickle.dumps(r), pickle.loads, count)
+    bench("pickle tuple", lambda r: pickle.dumps(request_to_tuple(r), protocol=pickle.HIGHEST_PROTOCOL),
+          lambda code: request_from_tuple(pickle.loads(code), spider), count)
+    bench("wire", dumps_request, lambda code: loads_request(code, spider), count)
@@ -0,0 +1,133 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      autothrottle
+# Author:    liangbaikai
+# Date:      2021/2/1
+# Desc:      adjust per host concurrency and delay by latency and errors
+# ------------------------------------------------------------------
+import time
+from typing import Dict, Optional
+
+from smart.log import log
+from smart.request import Request
+from smart.scheduler import BaseSchedulerContainer
+from smart.setting import gloable_setting_dict
+from smart.signal import Reminder, reminder
+from smart.tool import get_domain
+
+
+class HostThrottle:
+    """
+    单个 host 的限速状态
+    """
+
+    def __init__(self, concurrency: float):
+        self.concurrency = concurrency
+        self.delay = 0.0
+        # 响应时间的指数移动平均 s
+        self.latency: Optional[float] = None
+        # 上次降速的时间 一个响应时间内只降速一次
+        self.decreased_at = 0.0
+        self.responses = 0
+        self.errors = 0
+
+
+class AutoThrottle:
+    """
+    自动限速 按 host 统计响应时间和错误(429 5xx 超时等)
+    AIMD: 响应时间不超过目标时 每个响应增加 1/并发数 的并发(约每轮增加 1) 并减半请求间隔
+    响应时间超过目标或出错时 并发乘以 autothrottle_decrease 出错时请求间隔加倍
+    调整结果写入调度容器的 host 限制(需要 smart.scheduler.DomainSchedulerContainer)
+    并发送 autothrottle_adjusted 信号
+    """
+
+    def __init__(self, container: BaseSchedulerContainer, spider=None):
+        """
+        初始方法
+        :param container: 调度容器
+        :param spider: 爬虫 优先读取爬虫的配置
+        """
+        self.container = container
+        setting = spider.cutome_setting_dict if spider else {}
+
+        def get_setting(key):
+            value = setting.get(key)
+            return gloable_setting_dict.get(key) if value is None else value
+
+        self.target_latency = get_setting("autothrottle_target_latency")
+        self.start_concurrency = get_setting("autothrottle_start_concurrency")
+        self.min_concurrency = get_setting("autothrottle_min_concurrency")
+        self.max_concurrency = get_setting("autothrottle_max_concurrency")
+        self.max_delay = get_setting("autothrottle_max_delay")
+        self.decrease = get_setting("autothrottle_decrease")
+        self.error_codes = set(get_setting("autothrottle_error_codes") or ())
+        self.hosts: Dict[str, HostThrottle] = {}
+        self.log = log
+        # 调度容器是否支持按 host 限制 不支持时只统计和发送信号
+        self.enforced = True
+
+    def _get(self, host: str) -> HostThrottle:
+        throttle = self.hosts.get(host)
+        if throttle is None:
+            throttle = self.hosts[host] = HostThrottle(self.start_concurrency)
+            self._apply(host, throttle)
+        return throttle
+
+    def on_response(self, request: Request, latency: float, status: int):
+        """
+        下载完成后调用
+        :param request: 请求
+        :param latency: 下载耗时 s
+        :param status: 响应状态码
+        :return: None
+        """
+        host = get_domain(request.url)
+        throttle = self._get(host)
+        throttle.responses += 1
+        throttle.latency = latency if throttle.latency is None else throttle.latency * 0.7 + latency * 0.3
+        if status in self.error_codes:
+            self._slow_down(host, throttle, True)
+        elif throttle.latency > self.target_latency:
+            self._slow_down(host, throttle, False)
+        else:
+            self._speed_up(host, throttle)
+
+    def on_error(self, request: Request):
+        """
+        下载出错(超时 连接失败等)时调用
+        :param request: 请求
+        :return: None
+        """
+        host = get_domain(request.url)
+        self._slow_down(host, self._get(host), True)
+
+    def _speed_up(self, host: str, throttle: HostThrottle):
+        concurrency, delay = int(throttle.concurrency), throttle.delay
+        throttle.concurrency = min(self.max_concurrency, throttle.concurrency + 1 / max(throttle.concurrency, 1))
+        throttle.delay = throttle.delay / 2 if throttle.delay > 0.01 else 0.0
+        if int(throttle.concurrency) != concurrency or throttle.delay != delay:
+            self._apply(host, throttle)
+
+    def _slow_down(self, host: str, throttle: HostThrottle, error: bool):
+        if error:
+            throttle.errors += 1
+        now = time.monotonic()
+        # 同一批在途请求的失败只降速一次
+        if now - throttle.decreased_at < (throttle.latency or self.target_latency):
+            return
+        throttle.decreased_at = now
+        throttle.concurrency = max(self.min_concurrency, throttle.concurrency * self.decrease)
+        if error:
+            throttle.delay = min(self.max_delay, max(throttle.delay * 2, 0.1))
+        self._apply(host, throttle)
+
+    def _apply(self, host: str, throttle: HostThrottle):
+        concurrency = max(int(throttle.concurrency), 1)
+        if self.enforced and not self.container.set_host_limit(host, concurrency, throttle.delay):
+            self.enforced = False
+            self.log.warning(f"{self.container.__class__.__name__} does not support per host limit, "
+                             f"autothrottle only observes, use smart.scheduler.DomainSchedulerContainer")
+        self.log.debug(f"autothrottle {host} concurrency: {concurrency} delay: {round(throttle.delay, 3)} "
+                       f"latency: {throttle.latency}")
+        reminder.go(Reminder.autothrottle_adjusted, host, concurrency=concurrency, delay=throttle.delay,
+                    latency=throttle.latency, responses=throttle.responses, errors=throttle.errors)
@@ -0,0 +1,226 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      bloom
+# Author:    liangbaikai
+# Date:      2021/1/26
+# Desc:      scalable bloom filter on a compact bit array
+# ------------------------------------------------------------------
+import hashlib
+import math
+import mmap
+import os
+import struct
+from typing import List, Tuple, Union
+
+# 文件头: magic 版本号 初始容量 误判率 增长倍数 误判率收紧系数 子过滤器个数
+_FILE_HEADER = struct.Struct("<4sBQdddI")
+# 子过滤器头: 容量 误判率 hash 个数 bit 数 已添加个数
+_FILTER_HEADER = struct.Struct("<QdIQQ")
+_MAGIC = b"SBLM"
+_VERSION = 1
+
+
+def bloom_hashes(key: Union[str, bytes]) -> Tuple[int, int]:
+    """
+    计算 key 的两个 64 位 hash 值 其余 hash 由 double hashing 生成
+    :param key: str 或 bytes
+    :return: (h1, h2)
+    """
+    if isinstance(key, str):
+        key = key.encode("utf-8")
+    digest = hashlib.md5(key).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    # h2 为奇数 保证不同 i 生成的位置不重复
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    return h1, h2
+
+
+class BloomFilter:
+    """
+    固定容量的布隆过滤器  bit 保存在 bytearray(或 mmap 的 memoryview) 中
+    """
+
+    def __init__(self, capacity: int, error_rate: float, bits=None, count: int = 0):
+        """
+        初始方法
+        :param capacity: 容量 超过后误判率将升高
+        :param error_rate: 期望误判率
+        :param bits: 已有的 bit 数组 用于从文件加载
+        :param count: 已添加的元素个数
+        """
+        if capacity <= 0:
+            raise ValueError("bloom filter capacity must >0")
+        if not 0 < error_rate < 1:
+            raise ValueError("bloom filter error_rate must between 0 and 1")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # m = -n*ln(p)/(ln2)^2   k = m/n*ln2
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8) if bits is None else bits
+        self.count = count
+
+    def _positions(self, hashes: Tuple[int, int]):
+        h1, h2 = hashes
+        num_bits = self.num_bits
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % num_bits
+
+    def contains_hashes(self, hashes: Tuple[int, int]) -> bool:
+        bits = self.bits
+        for position in self._positions(hashes):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add_hashes(self, hashes: Tuple[int, int]) -> bool:
+        """
+        添加元素
+        :param hashes: bloom_hashes 的结果
+        :return: 是否是新元素(有 bit 从 0 变为 1)
+        """
+        bits = self.bits
+        added = False
+        for position in self._positions(hashes):
+            index, mask = position >> 3, 1 << (position & 7)
+            value = bits[index]
+            if not value & mask:
+                bits[index] = value | mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, key) -> bool:
+        return self.contains_hashes(bloom_hashes(key))
+
+    def add(self, key) -> bool:
+        return self.add_hashes(bloom_hashes(key))
+
+    def __len__(self):
+        return self.count
+
+
+class ScalableBloomFilter:
+    """
+    可扩容布隆过滤器
+    当前子过滤器写满后 新建一个容量为 growth 倍 误判率为 ratio 倍的子过滤器
+    总误判率不超过 error_rate
+    """
+
+    def __init__(self, initial_capacity: int = 1000000, error_rate: float = 0.0001, growth: int = 2,
+                 ratio: float = 0.5):
+        """
+        初始方法
+        :param initial_capacity: 第一个子过滤器的容量
+        :param error_rate: 期望的总误判率
+        :param growth: 扩容倍数
+        :param ratio: 误判率收紧系数
+        """
+        if not 0 < ratio < 1:
+            raise ValueError("bloom filter ratio must between 0 and 1")
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.ratio = ratio
+        self.filters: List[BloomFilter] = []
+
+    def _grow(self) -> BloomFilter:
+        if self.filters:
+            last = self.filters[-1]
+            capacity, error_rate = last.capacity * self.growth, last.error_rate * self.ratio
+        else:
+            # 等比级数求和 p0/(1-r) = error_rate
+            capacity, error_rate = self.initial_capacity, self.error_rate * (1 - self.ratio)
+        bloom = BloomFilter(capacity, error_rate)
+        self.filters.append(bloom)
+        return bloom
+
+    def contains_hashes(self, hashes: Tuple[int, int]) -> bool:
+        for bloom in reversed(self.filters):
+            if bloom.contains_hashes(hashes):
+                return True
+        return False
+
+    def add_hashes(self, hashes: Tuple[int, int]) -> bool:
+        if self.contains_hashes(hashes):
+            return False
+        bloom = self.filters[-1] if self.filters else self._grow()
+        if bloom.count >= bloom.capacity:
+            bloom = self._grow()
+        return bloom.add_hashes(hashes)
+
+    def __contains__(self, key) -> bool:
+        return self.contains_hashes(bloom_hashes(key))
+
+    def add(self, key) -> bool:
+        """
+        添加元素
+        :param key: str 或 bytes
+        :return: 是否是新元素
+        """
+        return self.add_hashes(bloom_hashes(key))
+
+    def __len__(self):
+        """
+        已添加元素个数的估计值 误判的元素不会被计入
+        """
+        return sum(bloom.count for bloom in self.filters)
+
+    def copy(self) -> "ScalableBloomFilter":
+        """
+        拷贝一份 bit 数组 用于在其他线程中保存
+        :return: ScalableBloomFilter
+        """
+        bloom_filter = ScalableBloomFilter(self.initial_capacity, self.error_rate, self.growth, self.ratio)
+        for bloom in self.filters:
+            bloom_filter.filters.append(BloomFilter(bloom.capacity, bloom.error_rate,
+                                                    bits=bytearray(bloom.bits), count=bloom.count))
+        return bloom_filter
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(bloom.bits) for bloom in self.filters)
+
+    def save(self, path: str):
+        """
+        保存到文件 先写临时文件再替换 保证文件完整
+        :param path: 文件路径
+        :return: None
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_FILE_HEADER.pack(_MAGIC, _VERSION, self.initial_capacity, self.error_rate,
+                                      self.growth, self.ratio, len(self.filters)))
+            for bloom in self.filters:
+                f.write(_FILTER_HEADER.pack(bloom.capacity, bloom.error_rate, bloom.num_hashes,
+                                            bloom.num_bits, bloom.count))
+                f.write(bloom.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "ScalableBloomFilter":
+        """
+        通过 mmap 加载文件 bit 数组按需换页 不会整体读入内存
+        映射为写时复制 之后的添加不会修改原文件 需要调用 save 持久化
+        :param path: 文件路径
+        :return: ScalableBloomFilter
+        """
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, version, initial_capacity, error_rate, growth, ratio, num_filters = _FILE_HEADER.unpack_from(mm, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f"{path} is not a bloom filter file")
+        bloom_filter = cls(initial_capacity, error_rate, int(growth), ratio)
+        view = memoryview(mm)
+        offset = _FILE_HEADER.size
+        for _ in range(num_filters):
+            capacity, sub_error_rate, num_hashes, num_bits, count = _FILTER_HEADER.unpack_from(mm, offset)
+            offset += _FILTER_HEADER.size
+            size = (num_bits + 7) // 8
+            bloom = BloomFilter(capacity, sub_error_rate, bits=view[offset:offset + size], count=count)
+            if bloom.num_bits != num_bits or bloom.num_hashes != num_hashes:
+                raise ValueError(f"{path} is a broken bloom filter file")
+            bloom_filter.filters.append(bloom)
+            offset += size
+        return bloom_filter
@@ -0,0 +1,272 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      checkpoint
+# Author:    liangbaikai
+# Date:      2021/1/28
+# Desc:      crawl checkpoint, journal frontier and snapshot duplicate filter
+# ------------------------------------------------------------------
+import asyncio
+import json
+import mmap
+import os
+import struct
+import time
+from collections import deque
+from typing import List, Optional
+
+from smart.log import log
+from smart.request import Request
+from smart.serialize import dumps_request, loads_request, callback_to_name, is_owner_callback_name
+from smart.tool import request_fingerprint, fingerprint_digest_size
+
+
+class Checkpoint:
+    """
+    爬取检查点
+    待抓取的请求以日志的形式增量保存: 请求进入调度器时记录一条 push 处理结束时记录一条 done
+    已出队还没处理完的 等待重试的请求都没有 done 重启后会重新抓取
+    每次保存只追加两次保存之间的记录 done 的记录超过一半时在线程池中压缩日志 只保留未完成的请求
+    去重器由其 checkpoint 方法保存 set 去重器也是增量追加
+    记录在事件循环中序列化 写文件在线程池中执行 不会停止抓取
+    """
+    frontier_file = "frontier.log"
+    meta_file = "checkpoint.json"
+    # done 记录少于这个数时不压缩
+    compact_min = 10000
+
+    _LEN = struct.Struct("<I")
+
+    def __init__(self, directory: str, spider, scheduler):
+        """
+        初始方法
+        :param directory: 检查点目录 每个爬虫一个目录
+        :param spider: 爬虫 用于还原请求的回调函数
+        :param scheduler: 调度器
+        """
+        self.directory = directory
+        self.spider = spider
+        self.scheduler = scheduler
+        self.log = log
+        self.digest_size = fingerprint_digest_size(spider)
+        # 持久化的容器(如 redis)自己保存待抓取请求 只保存去重器
+        self.journal = not getattr(scheduler.scheduler_container, "persistent", False)
+        # 上次保存之后的记录 和其中 push done 的记录数
+        self.records = bytearray()
+        self.record_pushes = 0
+        self.record_dones = 0
+        # 日志文件中 push 和 done 的记录数 决定是否压缩
+        self.pushes = 0
+        self.dones = 0
+        # 第一次保存时清空旧的日志 恢复后追加
+        self.append = False
+        # 第一次保存时创建 绑定到运行中的事件循环
+        self.lock = None
+        os.makedirs(directory, exist_ok=True)
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self.directory, self.meta_file))
+
+    def _key(self, request: Request) -> bytes:
+        # 重试次数会变化 不计入 url 方法 请求体都相同的请求视为同一个
+        return request_fingerprint(request.url, request.method, request.data, 0, self.digest_size)
+
+    def push(self, request: Request):
+        """
+        请求进入调度器时调用
+        :param request: 请求
+        :return: None
+        """
+        if not self.journal:
+            return
+        if not is_owner_callback_name(callback_to_name(request.callback), self.spider):
+            # 恢复时只从 spider 所在的模块获取回调函数
+            self.log.warning(f"{request.url} can not be saved in checkpoint: "
+                             f"callback is not in the module of the spider")
+            return
+        try:
+            data = dumps_request(request)
+        except Exception as e:
+            self.log.warning(f"{request.url} can not be saved in checkpoint: {e}")
+            return
+        key = self._key(request)
+        self.records += b"P"
+        self.records.append(len(key))
+        self.records += key
+        self.records += self._LEN.pack(len(data))
+        self.records += data
+        self.record_pushes += 1
+
+    def done(self, request: Request):
+        """
+        请求处理结束(包括被丢弃)时调用 等待重试的请求没有结束
+        :param request: 请求
+        :return: None
+        """
+        if not self.journal:
+            return
+        key = self._key(request)
+        self.records += b"D"
+        self.records.append(len(key))
+        self.records += key
+        self.record_dones += 1
+
+    async def save(self):
+        """
+        保存一次检查点 同一时间只有一次保存
+        :return: None
+        """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            # 以下在同一个事件循环 tick 内完成 日志和去重器的快照是一致的
+            records, pushes, dones = self.records, self.record_pushes, self.record_dones
+            self.records, self.record_pushes, self.record_dones = bytearray(), 0, 0
+            write_duplicate = self.scheduler.duplicate_filter.checkpoint(self.directory)
+            start = time.time()
+            future = asyncio.get_running_loop().run_in_executor(None, self._write, records, pushes, dones,
+                                                                write_duplicate)
+            try:
+                count = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 写文件的线程无法取消 等它结束后再释放锁 避免两次写同一个文件
+                await asyncio.wait([future])
+                if future.exception() is not None:
+                    self._put_back(records, pushes, dones, write_duplicate)
+                raise
+            except Exception:
+                self._put_back(records, pushes, dones, write_duplicate)
+                raise
+            self.log.info(f"checkpoint saved {count} pending requests to {self.directory}, "
+                          f"it cost {round(time.time() - start, 3)} s")
+
+    def _put_back(self, records: bytearray, pushes: int, dones: int, write_duplicate):
+        """
+        日志没有写入 去重器也没有保存 记录和去重器的增量都放回 下次保存时重新写
+        """
+        self.records[:0] = records
+        self.record_pushes += pushes
+        self.record_dones += dones
+        if write_duplicate:
+            write_duplicate(discard=True)
+
+    def _write(self, records: bytearray, pushes: int, dones: int, write_duplicate) -> int:
+        # 先写待抓取请求再写去重器 中途退出时最多重复抓取 不会丢失请求
+        path = os.path.join(self.directory, self.frontier_file)
+        if self.journal:
+            with open(path, "ab" if self.append else "wb") as f:
+                start = f.tell()
+                try:
+                    f.write(records)
+                    f.flush()
+                except BaseException:
+                    # 不留下不完整的记录 下次重新追加
+                    f.truncate(start)
+                    raise
+            if not self.append:
+                self.append, self.pushes, self.dones = True, 0, 0
+            self.pushes += pushes
+            self.dones += dones
+        # 日志已经写入 之后的失败只记录 不能让调用方重新写日志
+        count = self.pushes - self.dones
+        try:
+            if self.dones >= self.compact_min and self.dones * 2 >= self.pushes:
+                self._compact()
+            if write_duplicate:
+                write_duplicate()
+            meta_path = os.path.join(self.directory, self.meta_file)
+            with open(meta_path + ".tmp", "w") as f:
+                json.dump({"spider": self.spider.name, "time": time.time(), "requests": count}, f)
+            os.replace(meta_path + ".tmp", meta_path)
+        except Exception as e:
+            self.log.error(f"checkpoint save failed: {e}", exc_info=True)
+        return count
+
+    def _iter_records(self, data):
+        """
+        遍历日志记录 最后一条不完整的记录(进程在写文件时退出)被忽略
+        :param data: 日志
+        :return: (开始位置, 结束位置, 类型, key)
+        """
+        offset, total = 0, len(data)
+        while offset + 2 <= total:
+            tag, size = data[offset], data[offset + 1]
+            end = offset + 2 + size
+            if tag == 0x50:
+                if end + self._LEN.size > total:
+                    return
+                end += self._LEN.size + self._LEN.unpack_from(data, end)[0]
+            if end > total:
+                return
+            yield offset, end, tag, data[offset + 2:offset + 2 + size]
+            offset = end
+
+    def _compact(self, load: bool = False) -> List[bytes]:
+        """
+        重放日志 只保留未完成请求的 push 记录 写临时文件后替换
+        :param load: 是否返回未完成请求的数据
+        :return: 未完成请求的数据 按 push 的顺序
+        """
+        path = os.path.join(self.directory, self.frontier_file)
+        if not os.path.exists(path) or not os.path.getsize(path):
+            self.pushes = self.dones = 0
+            return []
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # 开始位置 -> 结束位置 只保存位置 不把请求读入内存
+            pending = {}
+            # key -> 还没完成的 push 的开始位置 相同的请求先进先出
+            waiting = {}
+            for start, end, tag, key in self._iter_records(data):
+                if tag == 0x50:
+                    pending[start] = end
+                    waiting.setdefault(key, deque()).append(start)
+                else:
+                    starts = waiting.get(key)
+                    if starts:
+                        del pending[starts.popleft()]
+                        if not starts:
+                            del waiting[key]
+            codes = []
+            with open(path + ".tmp", "wb") as out:
+                for start, end in pending.items():
+                    out.write(data[start:end])
+                    if load:
+                        codes.append(data[start + 2 + data[start + 1] + self._LEN.size:end])
+        os.replace(path + ".tmp", path)
+        self.pushes, self.dones = len(pending), 0
+        return codes
+
+    def load(self) -> Optional[List[Request]]:
+        """
+        恢复去重器 并返回检查点中待抓取的请求 之后的保存追加到原来的日志中
+        :return: 没有检查点时返回 None
+        """
+        if not self.exists():
+            return None
+        if not self.scheduler.duplicate_filter.restore(self.directory):
+            self.log.warning(f"{self.scheduler.duplicate_filter.__class__.__name__} "
+                             f"restored nothing from checkpoint {self.directory}")
+        requests = []
+        if self.journal:
+            self.append = True
+            for code in self._compact(load=True):
+                try:
+                    requests.append(loads_request(code, self.spider))
+                except Exception as e:
+                    self.log.error(f"bad request in checkpoint {self.directory}: {e}")
+        self.log.info(f"checkpoint loaded {len(requests)} requests from {self.directory}")
+        return requests
+
+    async def run(self, interval: float):
+        """
+        定期保存检查点 直到被取消
+        :param interval: 保存间隔 s
+        :return: None
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.save()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log.error(f"checkpoint save failed: {e}", exc_info=True)
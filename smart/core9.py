@@ -8,6 +8,7 @@
 import asyncio
 import importlib
 import inspect
+import os
 import random
 import time
 import uuid
@@ -19,19 +20,24 @@ from typing import Dict, Any
 
 import typing
 
+from smart.checkpoint import Checkpoint
 from smart.log import log
 from smart.downloader import Downloader
 from smart.item import Item
-from smart.pipline import Piplines
+from smart.pipline import Piplines, BatchPipline
+from smart import process
 from smart.request import Request
 from smart.response import Response
+from smart.retry import RetryManager
+from smart.autothrottle import AutoThrottle
 from smart.scheduler import Scheduler, DequeSchedulerContainer, AsyncScheduler
+from smart.serialize import callback_to_name, name_to_callback
 from smart.setting import gloable_setting_dict
 from smart.signal import reminder, Reminder
 
 
 class Engine:
-    def __init__(self, spider, middlewire=None, pipline: Piplines = None):
+    def __init__(self, spider, middlewire=None, pipline: Piplines = None, resume: bool = False):
         self.reminder = reminder
         self.log = log
         self.task_dict: Dict[str, Any] = {}
@@ -44,26 +50,78 @@ class Engine:
         net_download_class = self._get_dynamic_class_setting("net_download_class")
         scheduler_class = self._get_dynamic_class_setting("scheduler_class")
         self.scheduler = scheduler_class(duplicate_filter_class(), scheduler_container_class())
+        self.scheduler.open(self.spider)
         req_per_concurrent = self.spider.cutome_setting_dict.get("req_per_concurrent") or gloable_setting_dict.get(
             "req_per_concurrent")
         single = self.spider.cutome_setting_dict.get("is_single")
         self.is_single = gloable_setting_dict.get("is_single") if single is None else single
+        autothrottle_enabled = self.spider.cutome_setting_dict.get("autothrottle_enabled")
+        if autothrottle_enabled is None:
+            autothrottle_enabled = gloable_setting_dict.get("autothrottle_enabled")
         self.downloader = Downloader(self.scheduler, self.middlewire, reminder=self.reminder,
                                      seq=req_per_concurrent,
-                                     downer=net_download_class())
-        self.request_generator_queue = asyncio.Queue()
+                                     downer=net_download_class(),
+                                     retry=RetryManager(self._requeue, self.spider),
+                                     throttle=AutoThrottle(self.scheduler.scheduler_container, self.spider)
+                                     if autothrottle_enabled else None,
+                                     queue_response=False)
+        # 常驻 worker 数 每个 worker 独立地 出队->下载->处理回调  默认与请求并发数相同
+        self.worker_num = self.spider.cutome_setting_dict.get("worker_num") or gloable_setting_dict.get(
+            "worker_num") or req_per_concurrent
+        # 正在处理请求的 worker 数
+        self.working = 0
+        # 有新请求进入调度器时通知空闲的 worker
+        self.request_event = asyncio.Event()
+        # 待抓取请求数上限 达到上限时回调的迭代会挂起等待 <=0 不限制
+        self.request_queue_maxsize = self.spider.cutome_setting_dict.get(
+            "request_queue_maxsize") or gloable_setting_dict.get("request_queue_maxsize") or 0
+        # 有请求出队时通知等待空间的回调
+        self.space_event = asyncio.Event()
+        # 因待抓取请求已满而挂起的 worker 数
+        self.blocked_workers = 0
+        # worker 正在等待的请求处理 task -> 让 worker 脱离等待的 future  只在待抓取请求有上限时使用
+        self.jobs: Dict[asyncio.Task, asyncio.Future] = {}
+        # 待抓取请求已满时 从 worker 脱离 在后台继续迭代回调的 task
+        self.producers = set()
+        # 后台迭代回调的 task 数上限 为 None 时与 worker 数相同
+        self.producer_num = self.spider.cutome_setting_dict.get("producer_num") or gloable_setting_dict.get(
+            "producer_num") or self.worker_num
+        # 回调中 yield 的协程 单独作为 task 执行
+        self.callback_tasks = set()
 
         self.stop = False
         self.condition = asyncio.Condition()
-        self.item_queue = asyncio.Queue()
+        item_queue_maxsize = self.spider.cutome_setting_dict.get("item_queue_maxsize") or gloable_setting_dict.get(
+            "item_queue_maxsize") or 0
+        # item 队列 满了之后回调的迭代会挂起 不影响其他 worker 下载
+        self.item_queue = asyncio.Queue(maxsize=item_queue_maxsize)
+        # 处理 item 的常驻 task 数
+        self.pipline_worker_num = self.spider.cutome_setting_dict.get(
+            "pipline_worker_num") or gloable_setting_dict.get("pipline_worker_num")
         pipline_is_paralleled = self.spider.cutome_setting_dict.get("pipline_is_paralleled")
         pipline_is_paralleled = gloable_setting_dict.get(
             "pipline_is_paralleled") if pipline_is_paralleled is None else pipline_is_paralleled
         self.pipline_is_paralleled = pipline_is_paralleled
+        # 批量 pipline 的缓冲区
+        self.batch_piplines = [BatchPipline(func, size, max_wait) for _, func, size, max_wait in
+                               (self.piplines.batch_piplines if self.piplines else [])]
+
+        # 执行 run_in_process 标记的 pipline 和回调 第一次使用时创建
+        self.process_pool = None
+        self.process_pool_max_size = self.spider.cutome_setting_dict.get(
+            "process_pool_max_size") or gloable_setting_dict.get("process_pool_max_size")
 
         self.lock1 = asyncio.Lock()
         self.lock2 = asyncio.Lock()
-        self.worker_tasks = []
+
+        # 是否从最新的检查点恢复
+        self.resume = resume
+        checkpoint_dir = self.spider.cutome_setting_dict.get("checkpoint_dir") or gloable_setting_dict.get(
+            "checkpoint_dir")
+        self.checkpoint_interval = self.spider.cutome_setting_dict.get(
+            "checkpoint_interval") or gloable_setting_dict.get("checkpoint_interval")
+        self.checkpoint = Checkpoint(os.path.join(checkpoint_dir, self.spider.name), self.spider,
+                                     self.scheduler) if checkpoint_dir else None
 
     def _get_dynamic_class_setting(self, key):
         class_str = self.spider.cutome_setting_dict.get(key) or gloable_setting_dict.get(key)
@@ -84,15 +142,44 @@ class Engine:
         self.spider.on_start()
         self.reminder.go(Reminder.spider_start, self.spider)
         self.reminder.go(Reminder.engin_start, self)
-        async for request_ins in self.process_start_urls():
-            self.request_generator_queue.put_nowait(self.handle_request(request_ins))
+        restored = await self._restore_checkpoint() if self.resume else False
+        checkpoint_task = None
+        if self.checkpoint:
+            checkpoint_task = asyncio.ensure_future(self.checkpoint.run(self.checkpoint_interval))
+        pipline_workers = [
+            asyncio.ensure_future(self.start_pipline_worker())
+            for _ in range(self.pipline_worker_num)
+        ]
+        # 先启动 worker  待抓取请求有上限时 start_urls 也需要边抓取边放入
         workers = [
             asyncio.ensure_future(self.start_worker())
-            for _ in range(3)
+            for _ in range(self.worker_num)
         ]
-        await self.request_generator_queue.join()
+        if not restored:
+            async for request_ins in self.process_start_urls():
+                await self._schedule_request(request_ins)
+        await self._wait_idle()
+        # worker 是常驻的 可能阻塞在异步容器的 pop 上
         for t in workers:
-            await t
+            t.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        # 引擎关闭前处理完所有 item
+        await self.item_queue.join()
+        for t in pipline_workers:
+            t.cancel()
+        await asyncio.gather(*pipline_workers, return_exceptions=True)
+        for batch_pipline in self.batch_piplines:
+            await batch_pipline.close(self.spider)
+        if checkpoint_task:
+            # 正在写文件的保存会等写完才结束
+            checkpoint_task.cancel()
+            await asyncio.gather(checkpoint_task, return_exceptions=True)
+            try:
+                await self.checkpoint.save()
+            except Exception as e:
+                self.log.error(f"checkpoint save failed when engine close: {e}", exc_info=True)
+        if self.process_pool:
+            await asyncio.get_running_loop().run_in_executor(None, self.process_pool.shutdown)
 
         self.spider.state = "closed"
         self.reminder.go(Reminder.spider_close, self.spider)
@@ -100,34 +187,142 @@ class Engine:
         # for _t in works + handle_items:
         #     _t.cancel()
         self.reminder.go(Reminder.engin_close, self)
+        # 关闭信号中开始的清理(如 aioredis 归还连接池)在事件循环结束前完成
+        await self.scheduler.wait_closed()
+        self.downloader.retry.close()
+        await self.downloader.close()
         self.log.debug(f" engine stoped..")
 
     async def handle_request(
-            self, _request: Request
+            self, request: Request
     ):
         """
         Wrap request with middleware.
         :param request:
         :return:
         """
-        # pass_through
-        request = await self._pass_through_schedule(_request)
         callback_result, response = None, None
         try:
             setattr(request, "__spider__", self.spider)
+            if isinstance(request.callback, str):
+                # 从 redis 等远端容器取出的请求 回调函数只有名称
+                request.callback = name_to_callback(request.callback, self.spider, safe=True)
             response = await self.downloader.download(request)
             if response is None:
                 return
             if request.callback:
                 if inspect.iscoroutinefunction(request.callback):
                     callback_result = await request.callback(response)
+                elif process.is_run_in_process(request.callback):
+                    results = await self._run_in_process(process.call_callback,
+                                                         callback_to_name(request.callback),
+                                                         process.response_to_tuple(response))
+                    callback_result = process.results_from_process(results, self.spider)
                 else:
                     callback_result = request.callback(response)
         except Exception as e:
-            self.log.error(f"<Callback[{request.callback.__name__}]: {e}")
+            self.log.error(f"<Callback[{getattr(request.callback, '__name__', request.callback)}]: {e}")
+        finally:
+            # 请求出队后无论在哪一步结束 都通知调度容器释放 host 的并发名额
+            self.scheduler.release(request)
 
         return callback_result, response
 
+    async def _schedule_request(self, request: Request):
+        """
+        请求放入调度器(去重 入容器) 并通知空闲的 worker
+        待抓取的请求都在调度容器中 检查点可以完整保存
+        待抓取请求达到上限时挂起 直到有请求出队 回调产生再多的请求内存也保持平稳
+        :param request: 请求
+        :return: None
+        """
+        if self.request_queue_maxsize > 0:
+            await self._wait_space()
+        scheduled = self.scheduler.schedlue(request)
+        if inspect.isawaitable(scheduled):
+            scheduled = await scheduled
+        if scheduled:
+            if self.checkpoint:
+                self.checkpoint.push(request)
+            self.request_event.set()
+
+    async def _wait_space(self):
+        """
+        等待待抓取请求数低于上限
+        worker 正在处理的回调挂起时 转为后台的 producer 继续等待 worker 立即去取下一个请求
+        producer 已达上限时 worker 自己等待 所有 worker 都在等待时放行 避免死锁
+        :return: None
+        """
+        task = asyncio.current_task()
+        detach = self.jobs.get(task)
+        if detach is not None:
+            self.blocked_workers += 1
+            if self.blocked_workers >= self.worker_num:
+                self.space_event.set()
+        try:
+            while True:
+                if detach is not None and len(self.producers) < self.producer_num:
+                    # 转为 producer 之后不再占用 worker
+                    self._detach(task)
+                    self.blocked_workers -= 1
+                    detach = None
+                # 所有 worker 都在等待时没有人出队 放行避免死锁
+                if self.blocked_workers >= self.worker_num:
+                    return
+                size = self.scheduler.scheduler_container.size()
+                if inspect.isawaitable(size):
+                    size = await size
+                if size < self.request_queue_maxsize:
+                    return
+                self.space_event.clear()
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.space_event.wait(), 0.1)
+        finally:
+            if detach is not None:
+                self.blocked_workers -= 1
+
+    def _detach(self, job: asyncio.Task):
+        """
+        请求处理 task 脱离 worker 成为后台的 producer
+        :param job: 请求处理 task
+        :return: None
+        """
+        self.producers.add(job)
+        job.add_done_callback(self.producers.discard)
+        self.jobs.pop(job).set_result(None)
+
+    async def _restore_checkpoint(self) -> bool:
+        """
+        从最新的检查点恢复去重器和待抓取请求
+        :return: 是否恢复成功
+        """
+        if self.checkpoint is None:
+            self.log.warning("resume need the setting checkpoint_dir, so start from start_urls")
+            return False
+        requests = await asyncio.get_running_loop().run_in_executor(None, self.checkpoint.load)
+        if requests is None:
+            self.log.info(f"there is no checkpoint in {self.checkpoint.directory}, so start from start_urls")
+            return False
+        for request in requests:
+            # 检查点中的请求已经在去重器中 直接放入容器
+            push = self.scheduler.scheduler_container.push(request)
+            if inspect.isawaitable(push):
+                await push
+        return True
+
+    async def _requeue(self, request: Request):
+        """
+        到期的重试请求已经去重过 直接放入调度容器
+        :param request: 请求
+        :return: None
+        """
+        push = self.scheduler.scheduler_container.push(request)
+        if inspect.isawaitable(push):
+            await push
+        # 重新入队之后才确认原来的请求 重试期间宕机(如 redis 租约)不会丢失
+        self.scheduler.ack(request)
+        self.request_event.set()
+
     def _handle_exception(self, spider, e):
         if spider:
             try:
@@ -137,24 +332,108 @@ class Engine:
                 pass
 
     async def start_worker(self):
+        """
+        常驻 worker  不断从调度器取请求 下载完成后立即处理回调
+        worker 之间互不等待 一个慢请求只占用一个 worker
+        待抓取请求有上限时 请求在单独的 task 中处理 回调因待抓取请求已满挂起时 worker 不再等待它
+        :return: None
+        """
         while True:
-            request_item = await self.request_generator_queue.get()
-            self.worker_tasks.append(request_item)
-            if self.request_generator_queue.empty():
-                results = await asyncio.gather(
-                    *self.worker_tasks, return_exceptions=True
-                )
-                for task_result in results:
-                    if not isinstance(task_result, RuntimeError) and task_result:
-                        callback_results, response = task_result
-                        if isinstance(callback_results, (AsyncGeneratorType, GeneratorType)):
-                            await self._process_async_callback(
-                                callback_results, response
-                            )
-                    else:
-                        print("task_result",task_result)
-                self.worker_tasks = []
-            self.request_generator_queue.task_done()
+            request = await self._next_request()
+            if self.request_queue_maxsize <= 0:
+                await self._process_request(request)
+                continue
+            job = asyncio.ensure_future(self._process_request(request))
+            detach = asyncio.get_running_loop().create_future()
+            self.jobs[job] = detach
+            try:
+                await asyncio.wait([job, detach], return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                if self.jobs.pop(job, None) is not None:
+                    job.cancel()
+                raise
+            self.jobs.pop(job, None)
+
+    async def _process_request(self, request: Request):
+        """
+        下载一个请求 并迭代回调的结果
+        :param request: 请求
+        :return: None
+        """
+        try:
+            task_result = await self.handle_request(request)
+            if task_result:
+                callback_results, response = task_result
+                if isinstance(callback_results, (AsyncGeneratorType, GeneratorType)):
+                    await self._process_async_callback(
+                        callback_results, response
+                    )
+                if response is not None:
+                    # 流式下载的临时文件
+                    response.close()
+        except Exception as e:
+            self.log.error(f"worker occured an error: {e}", exc_info=True)
+        finally:
+            # 等待重试的请求还没有处理完 重新放入调度器后再确认
+            if not self.downloader.retry.holds(request):
+                # 回调产生的请求都已放入调度器 确认该请求
+                self.scheduler.ack(request)
+                if self.checkpoint:
+                    self.checkpoint.done(request)
+            self.working -= 1
+
+    async def _next_request(self) -> Request:
+        """
+        从调度器取一个请求 暂时没有可出队的请求时等待
+        :return: Request
+        """
+        while True:
+            try:
+                request = self.scheduler.get()
+                if inspect.isawaitable(request):
+                    request = await request
+            except Exception as e:
+                # 如容器中无法还原的请求 记录后继续 不能让 worker 退出
+                self.log.error(f"get request from scheduler occured an error: {e}", exc_info=True)
+                request = None
+            if request is not None:
+                # 出队和计数之间没有 await 空闲判断不会漏掉这个请求
+                self.working += 1
+                self.space_event.set()
+                return request
+            # 容器为空 或暂时没有可出队的请求(如 host 限流 延迟重试)
+            self.request_event.clear()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.request_event.wait(), 0.1)
+
+    async def _is_idle(self) -> bool:
+        if self.working > 0 or self.callback_tasks or self.downloader.retry.size() > 0:
+            return False
+        size = self.scheduler.scheduler_container.size()
+        if inspect.isawaitable(size):
+            size = await size
+        return size <= 0 and self.working <= 0 and not self.callback_tasks
+
+    async def _wait_idle(self):
+        """
+        等待所有请求处理完毕  连续两次检查都空闲才认为结束
+        避免请求刚从远端容器(如 redis)取出 还没开始处理时被误判
+        :return: None
+        """
+        idle_times = 0
+        while idle_times < 2:
+            await asyncio.sleep(0.1)
+            idle_times = idle_times + 1 if await self._is_idle() else 0
+
+    def _ensure_callback(self, aws_callback: typing.Coroutine, response):
+        task = asyncio.ensure_future(self._run_callback(aws_callback, response))
+        self.callback_tasks.add(task)
+        task.add_done_callback(self.callback_tasks.discard)
+
+    async def _run_callback(self, aws_callback: typing.Coroutine, response):
+        callback_results, response = await self.handle_callback(aws_callback, response)
+        if isinstance(callback_results, (AsyncGeneratorType, GeneratorType)):
+            await self._process_async_callback(callback_results, response)
 
     async def _process_async_callback(
             self, callback_results: AsyncGeneratorType, response: Response = None
@@ -165,23 +444,13 @@ class Engine:
                     if isinstance(callback_result, AsyncGeneratorType):
                         await self._process_async_callback(callback_result)
                     elif isinstance(callback_result, Request):
-                        self.request_generator_queue.put_nowait(
-                            self.handle_request(callback_result)
-                        )
+                        await self._schedule_request(callback_result)
                     elif isinstance(callback_result, typing.Coroutine):
-                        self.request_generator_queue.put_nowait(
-                            self.handle_callback(
-                                aws_callback=callback_result, response=response
-                            )
-                        )
+                        self._ensure_callback(callback_result, response)
                     elif isinstance(callback_result, Item):
-                        # Process target item
-                        # self._hand_piplines(self.spider, callback_result, paralleled=self.pipline_is_paralleled)
-                        print('item 暂时不处理')
-                        # await self.process_item(callback_result)
+                        await self.item_queue.put(callback_result)
                     else:
                         pass
-                    # await self.process_callback_result(callback_result=callback_result)
 
                 pass
             else:
@@ -189,25 +458,77 @@ class Engine:
                     if isinstance(callback_result, GeneratorType):
                         await self._process_async_callback(callback_result)
                     elif isinstance(callback_result, Request):
-                        self.request_generator_queue.put_nowait(
-                            self.handle_request(callback_result)
-                        )
+                        await self._schedule_request(callback_result)
                     elif isinstance(callback_result, typing.Coroutine):
-                        self.request_generator_queue.put_nowait(
-                            self.handle_callback(
-                                aws_callback=callback_result, response=response
-                            )
-                        )
+                        self._ensure_callback(callback_result, response)
                     elif isinstance(callback_result, Item):
-                        # Process target item
-                        # self._hand_piplines(self.spider, callback_result, paralleled=self.pipline_is_paralleled)
-                        print('item 暂时不处理')
-                        # await self.process_item(callback_result)
+                        await self.item_queue.put(callback_result)
                     else:
                         pass
         except Exception as e:
             self.log.error(e)
 
+    async def start_pipline_worker(self):
+        """
+        常驻的 item 处理 task  从 item 队列取 item 交给 piplines 处理
+        :return: None
+        """
+        while True:
+            item = await self.item_queue.get()
+            try:
+                await self._hand_piplines(item)
+            except Exception as e:
+                self.log.error(f"handle item occured an error: {e}", exc_info=True)
+            finally:
+                self.item_queue.task_done()
+
+    async def _hand_piplines(self, item: Item):
+        """
+        按 order 顺序执行 piplines
+        串行时上一个 pipline 的返回值传给下一个 返回的不是 Item 时丢弃
+        并行时所有 pipline 同时处理同一个 item
+        最后放入批量 pipline 的缓冲区
+        :param item: item
+        :return: None
+        """
+        if (self.piplines is None or len(self.piplines.piplines) <= 0) and not self.batch_piplines:
+            self.log.info("get a item but can not  find a piplinse to handle it so ignore it ")
+            return
+        piplines = self.piplines.piplines if self.piplines else []
+        if self.pipline_is_paralleled:
+            await asyncio.gather(*[self._call_pipline(pip, item) for _, pip in piplines])
+        else:
+            for _, pip in piplines:
+                result = await self._call_pipline(pip, item)
+                if not isinstance(result, Item):
+                    self.reminder.go(Reminder.item_dropped, item, pipline=pip)
+                    return
+                item = result
+        for batch_pipline in self.batch_piplines:
+            await batch_pipline.add(self.spider, item)
+
+    async def _call_pipline(self, pip, item: Item):
+        try:
+            if inspect.iscoroutinefunction(pip):
+                return await pip(self.spider, item)
+            if process.is_run_in_process(pip):
+                return await self._run_in_process(process.call_pipline, pip, item)
+            return await asyncio.get_running_loop().run_in_executor(None, pip, self.spider, item)
+        except Exception as e:
+            self.log.error(f"in pipline {getattr(pip, '__name__', pip)} occured an error: {e}", exc_info=True)
+            return None
+
+    async def _run_in_process(self, func, *args):
+        """
+        在进程池中执行 只传递 body 等基础数据 避免 cpu 密集的解析受 GIL 限制
+        :param func: smart.process 中的模块级函数
+        :param args: 参数
+        :return: 返回值
+        """
+        if self.process_pool is None:
+            self.process_pool = process.create_process_pool(self.spider, self.process_pool_max_size)
+        return await asyncio.get_running_loop().run_in_executor(self.process_pool, func, *args)
+
     async def handle_callback(self, aws_callback: typing.Coroutine, response):
         """
         Process coroutine callback function
@@ -219,13 +540,3 @@ class Engine:
         except Exception as e:
             self.log.exception(f"<Callback[{aws_callback.__name__}]: {e}")
         return callback_result, response
-
-    async def _pass_through_schedule(self, request):
-        if request:
-            none_or_iscoroutinefunction_ = self.scheduler.schedlue(request)
-            if inspect.isawaitable(none_or_iscoroutinefunction_):
-                await none_or_iscoroutinefunction_
-        request_or_iscoroutinefunction_ = self.scheduler.get()
-        if inspect.isawaitable(request_or_iscoroutinefunction_):
-            request_or_iscoroutinefunction_ = await request_or_iscoroutinefunction_
-        return request_or_iscoroutinefunction_
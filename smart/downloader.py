@@ -7,24 +7,32 @@
 # ------------------------------------------------------------------
 import asyncio
 import inspect
+import tempfile
+import time
 from abc import ABC, abstractmethod
 from asyncio import Queue, QueueEmpty
 from contextlib import suppress
 from typing import Optional
 import aiohttp
-from concurrent.futures import TimeoutError
 
 from aiohttp import TCPConnector
 
 from smart.log import log
 from smart.middlewire import Middleware
 from smart.response import Response
+from smart.retry import RetryManager
 from smart.scheduler import Scheduler
 from smart.setting import gloable_setting_dict
-from smart.signal import Reminder
+from smart.signal import Reminder, reminder
 from .request import Request
 
 
+class ResponseTooLarge(Exception):
+    """
+    响应体超过 max_body_size
+    """
+
+
 class BaseDown(ABC):
 
     @abstractmethod
@@ -35,9 +43,19 @@ class BaseDown(ABC):
 class AioHttpDown(BaseDown):
 
     async def fetch(self, request: Request) -> Response:
-        session, resp = None, None
+        session = None
         try:
             session = request.session or aiohttp.ClientSession(connector=TCPConnector(limit=1))
+            response = await self._do_fetch(session, request)
+        finally:
+            if request.session is None and session:
+                await session.close()
+
+        return response
+
+    async def _do_fetch(self, session, request: Request) -> Response:
+        resp = None
+        try:
             resp = await session.request(request.method,
                                          request.url,
                                          timeout=request.timeout,
@@ -46,37 +64,134 @@ class AioHttpDown(BaseDown):
                                          data=request.data or {},
                                          **request.extras or {}
                                          )
-            byte_content = await resp.read()
+            byte_content, file = await self._read_body(resp, request)
             headers = {}
             if resp.headers:
                 headers = {k: v for k, v in resp.headers.items()}
             response = Response(body=byte_content,
                                 status=resp.status,
                                 headers=headers,
-                                cookies=resp.cookies
+                                cookies=resp.cookies,
+                                file=file
                                 )
         finally:
             if resp:
                 resp.release()
-            if request.session is None and session:
-                await session.close()
-
         return response
 
+    @staticmethod
+    def _get_setting(request: Request, key: str):
+        spider = getattr(request, "__spider__", None)
+        value = spider.cutome_setting_dict.get(key) if spider else None
+        return gloable_setting_dict.get(key) if value is None else value
+
+    async def _read_body(self, resp, request: Request):
+        """
+        读取响应体 超过 max_body_size 时抛出 ResponseTooLarge
+        流式下载时按块写入 SpooledTemporaryFile 超过 stream_spool_size 才落盘
+        :param resp: aiohttp 响应
+        :param request: 请求
+        :return: (body, file)
+        """
+        max_body_size = self._get_setting(request, "max_body_size")
+        if max_body_size and resp.content_length and resp.content_length > max_body_size:
+            raise ResponseTooLarge(f"{request.url} content length {resp.content_length} > {max_body_size}")
+        if not request.stream:
+            if not max_body_size:
+                return await resp.read(), None
+            body = bytearray()
+            async for chunk in resp.content.iter_chunked(self._get_setting(request, "stream_chunk_size")):
+                body.extend(chunk)
+                if len(body) > max_body_size:
+                    raise ResponseTooLarge(f"{request.url} body size > {max_body_size}")
+            return bytes(body), None
+        spool_size = self._get_setting(request, "stream_spool_size")
+        file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        size = 0
+        loop = asyncio.get_running_loop()
+        try:
+            async for chunk in resp.content.iter_chunked(self._get_setting(request, "stream_chunk_size")):
+                size += len(chunk)
+                if max_body_size and size > max_body_size:
+                    raise ResponseTooLarge(f"{request.url} body size > {max_body_size}")
+                if size > spool_size:
+                    # 落盘(包括这次写入触发的转存)是同步写文件 放入线程池 不阻塞事件循环
+                    await loop.run_in_executor(None, file.write, chunk)
+                else:
+                    file.write(chunk)
+        except BaseException:
+            file.close()
+            raise
+        file.seek(0)
+        return b"", file
+
+
+class AioHttpPoolDown(AioHttpDown):
+    """
+    连接池下载器 每个引擎持有一个长连接的 session
+    复用 tcp/tls 连接和 dns 缓存 引擎关闭(engin_close)时释放
+    """
+
+    def __init__(self):
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.lock = asyncio.Lock()
+        reminder.engin_close.connect(self._on_engin_close)
+
+    async def fetch(self, request: Request) -> Response:
+        session = request.session or await self._get_session(request)
+        return await self._do_fetch(session, request)
+
+    async def _get_session(self, request: Request) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            async with self.lock:
+                if self.session is None or self.session.closed:
+                    connector = TCPConnector(limit=self._get_setting(request, "pool_limit"),
+                                             limit_per_host=self._get_setting(request, "pool_limit_per_host"),
+                                             keepalive_timeout=self._get_setting(request, "pool_keepalive_timeout"),
+                                             ttl_dns_cache=self._get_setting(request, "pool_dns_cache_ttl"))
+                    # cookie 由 request.cookies 显式传递 避免不同请求之间通过共享 session 串 cookie
+                    self.session = aiohttp.ClientSession(connector=connector,
+                                                         cookie_jar=aiohttp.DummyCookieJar())
+        return self.session
+
+    async def close(self):
+        """
+        关闭连接池 可重复调用
+        :return: None
+        """
+        session, self.session = self.session, None
+        if session and not session.closed:
+            await session.close()
+
+    def _on_engin_close(self, sender, **kwargs):
+        downloader = getattr(sender, "downloader", None)
+        if downloader is None or downloader.downer is not self:
+            return
+        if self.session and not self.session.closed:
+            with suppress(RuntimeError):
+                asyncio.get_running_loop().create_task(self.close())
+
 
 class Downloader:
 
     def __init__(self, scheduler: Scheduler, middwire: Middleware = None, reminder=None, seq=100,
-                 downer: BaseDown = AioHttpDown()):
+                 downer: BaseDown = AioHttpDown(), retry: RetryManager = None, throttle=None,
+                 queue_response: bool = True):
         self.log = log
         self.reminder = reminder
         self.scheduler = scheduler
         self.middwire = middwire
         self.response_queue: asyncio.Queue = Queue()
+        # 响应是否放入 response_queue 由引擎通过 get 取出  直接使用 download 返回值的引擎不放入 避免队列无限增长
+        self.queue_response = queue_response
         #  the file handle opens too_much to report an error
         self.semaphore = asyncio.Semaphore(seq)
         # the real to fetch resource from internet
         self.downer = downer
+        # 失败请求的延迟重试和按 host 熔断  默认到期后放回调度器
+        self.retry = retry or RetryManager(self._reschedule)
+        # 自动限速 smart.autothrottle.AutoThrottle 没有开启时为 None
+        self.throttle = throttle
 
     async def download(self, request: Request):
         spider = request.__spider__
@@ -100,23 +215,30 @@ class Downloader:
             self.reminder.go(Reminder.request_dropped, request, scheduler=self.scheduler)
             self.log.error(f'reached max retry times... {request}')
             return
-        request.retry = request.retry + 1
+        if not self.retry.allow(request):
+            # host 熔断中 延后到熔断结束
+            self.retry.defer(request)
+            return
+        # retry 的 setter 是累加的
+        request.retry = 1
         # when canceled
         loop = asyncio.get_running_loop()
         if loop.is_closed() or not loop.is_running():
             self.log.warning(f'loop is closed in download')
             return
+        response = None
         with suppress(asyncio.CancelledError):
+            # req_delay  在获取并发名额之前等待 避免延迟占用名额
+            if req_delay > 0:
+                await asyncio.sleep(req_delay)
             async  with self.semaphore:
                 await self._before_fetch(request)
 
                 fetch = self.downer.fetch
                 iscoroutinefunction = inspect.iscoroutinefunction(fetch)
                 # support sync or async request
+                start = time.monotonic()
                 try:
-                    # req_delay
-                    if req_delay > 0:
-                        await asyncio.sleep(req_delay)
                     self.log.info(f"send a request: url: {request.url}")
                     if iscoroutinefunction:
                         response = await fetch(request)
@@ -124,19 +246,17 @@ class Downloader:
                         self.log.debug(f'fetch may be an snyc func  so it will run in executor ')
                         response = await asyncio.get_event_loop() \
                             .run_in_executor(None, fetch, request)
-                except TimeoutError as e:
-                    # delay retry
-                    wait = self.scheduler.schedlue(request)
-                    if inspect.isawaitable(wait):
-                        await wait
-                    self.log.debug(
-                        f'req  to fetch is timeout now so this req will dely to sechdule for retry {request.url}')
-                    return
                 except asyncio.CancelledError as e:
                     self.log.debug(f' task is cancel..')
                     return
                 except BaseException as e:
-                    self.log.error(f'occured some exception in downloader e:{e}')
+                    if self.throttle:
+                        self.throttle.on_error(request)
+                    if self.retry.is_retry_exception(e):
+                        # 按退避时间延迟重试
+                        self.retry.retry(request, e.__class__.__name__)
+                    else:
+                        self.log.error(f'occured some exception in downloader e:{e}')
                     return
                 if response is None or not isinstance(response, Response):
                     self.log.error(
@@ -145,15 +265,45 @@ class Downloader:
                         'smart.Response instance or sub Response instance.  ')
                     return
                 self.reminder.go(Reminder.response_downloaded, response)
+                if self.throttle:
+                    self.throttle.on_response(request, time.monotonic() - start, response.status)
+                if self.retry.is_retry_status(response.status):
+                    response.close()
+                    self.retry.retry(request, response.status)
+                    return
+                self.retry.record_success(request)
                 if response.status not in ignore_response_codes:
                     await self._after_fetch(request, response)
 
+        if response is None:
+            # 等待 req_delay 时被取消
+            return
         if response.status not in ignore_response_codes:
             response.request = request
             response.__spider__ = spider
-            await self.response_queue.put(response)
+            if self.queue_response:
+                await self.response_queue.put(response)
+            else:
+                self.reminder.go(Reminder.response_received, response)
         return response
 
+    async def _reschedule(self, request: Request):
+        # 重试的请求已经去重过 直接放入调度容器
+        push = self.scheduler.scheduler_container.push(request)
+        if inspect.isawaitable(push):
+            await push
+
+    async def close(self):
+        """
+        释放下载器持有的资源 如连接池
+        :return: None
+        """
+        close = getattr(self.downer, "close", None)
+        if callable(close):
+            res = close()
+            if inspect.isawaitable(res):
+                await res
+
     def get(self) -> Optional[Response]:
         with suppress(QueueEmpty):
             response = self.response_queue.get_nowait()
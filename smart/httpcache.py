@@ -0,0 +1,259 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      httpcache
+# Author:    liangbaikai
+# Date:      2021/1/31
+# Desc:      on-disk http cache with conditional revalidation
+# ------------------------------------------------------------------
+import asyncio
+import importlib
+import inspect
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from smart.downloader import BaseDown
+from smart.log import log
+from smart.request import Request
+from smart.response import Response
+from smart.setting import gloable_setting_dict
+from smart.tool import request_fingerprint
+
+
+class HttpCacheStore:
+    """
+    基于 sqlite 的响应缓存 一个文件保存所有响应 多个进程可以同时使用
+    方法都是同步的 由 HttpCacheDown 在单独的线程中调用
+    缓存大小在内存中累计 超过最大字节数时才淘汰 淘汰时从文件中重新统计(包括其他进程写入的响应)
+    """
+
+    def __init__(self, path: str, max_size: int, expire: float):
+        """
+        初始方法
+        :param path: sqlite 文件路径
+        :param max_size: 缓存的最大字节数 超过后淘汰最久没有访问的响应
+        :param expire: 缓存的最长保存时间 s 超过后删除
+        """
+        self.max_size = max_size
+        self.expire = expire
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS response (
+            fingerprint BLOB PRIMARY KEY,
+            url TEXT,
+            status INTEGER,
+            headers TEXT,
+            body BLOB,
+            etag TEXT,
+            last_modified TEXT,
+            stored_at REAL,
+            accessed_at REAL,
+            size INTEGER)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS response_accessed_at ON response (accessed_at)")
+        self.conn.commit()
+        # 缓存的总字节数 打开时统计一次 之后随写入和删除增减
+        self.total_size = 0
+        self.evict()
+
+    def get(self, fingerprint: bytes) -> Optional[Tuple]:
+        """
+        :param fingerprint: 请求指纹
+        :return: (url, status, headers, body, etag, last_modified, stored_at) 没有或已过期返回 None
+        """
+        row = self.conn.execute(
+            "SELECT url, status, headers, body, etag, last_modified, stored_at FROM response "
+            "WHERE fingerprint=?", (fingerprint,)).fetchone()
+        if row is None:
+            return None
+        if self.expire and time.time() - row[6] > self.expire:
+            self.delete(fingerprint)
+            return None
+        self.conn.execute("UPDATE response SET accessed_at=? WHERE fingerprint=?", (time.time(), fingerprint))
+        self.conn.commit()
+        return row[0], row[1], json.loads(row[2]), row[3], row[4], row[5], row[6]
+
+    def put(self, fingerprint: bytes, url: str, status: int, headers: dict, body: bytes):
+        """
+        保存响应 超过最大字节数时淘汰
+        """
+        now = time.time()
+        etag, last_modified = _header(headers, "etag"), _header(headers, "last-modified")
+        # 替换已有的响应时 减去原来的大小
+        self.total_size += len(body) - self._row_size(fingerprint)
+        self.conn.execute("INSERT OR REPLACE INTO response VALUES (?,?,?,?,?,?,?,?,?,?)",
+                          (fingerprint, url, status, json.dumps(headers), body, etag, last_modified,
+                           now, now, len(body)))
+        self.conn.commit()
+        if self.max_size and self.total_size > self.max_size:
+            self.evict()
+
+    def touch(self, fingerprint: bytes):
+        """
+        重新验证(304)后 缓存重新变为新鲜
+        """
+        now = time.time()
+        self.conn.execute("UPDATE response SET stored_at=?, accessed_at=? WHERE fingerprint=?",
+                          (now, now, fingerprint))
+        self.conn.commit()
+
+    def delete(self, fingerprint: bytes):
+        self.total_size -= self._row_size(fingerprint)
+        self.conn.execute("DELETE FROM response WHERE fingerprint=?", (fingerprint,))
+        self.conn.commit()
+
+    def _row_size(self, fingerprint: bytes) -> int:
+        row = self.conn.execute("SELECT size FROM response WHERE fingerprint=?", (fingerprint,)).fetchone()
+        return row[0] if row else 0
+
+    def size(self) -> int:
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM response").fetchone()[0]
+
+    def evict(self):
+        """
+        删除过期的响应 超过最大字节数时按最近访问时间淘汰到 90%
+        需要扫描整个缓存 只在打开时和超过最大字节数时执行
+        """
+        if self.expire:
+            self.conn.execute("DELETE FROM response WHERE stored_at<?", (time.time() - self.expire,))
+        size = self.size()
+        if self.max_size:
+            if size > self.max_size:
+                target = self.max_size * 0.9
+                rows = self.conn.execute("SELECT fingerprint, size FROM response ORDER BY accessed_at")
+                evicted = []
+                for fingerprint, row_size in rows:
+                    if size <= target:
+                        break
+                    evicted.append((fingerprint,))
+                    size -= row_size
+                self.conn.executemany("DELETE FROM response WHERE fingerprint=?", evicted)
+        self.conn.commit()
+        self.total_size = size
+
+    def close(self):
+        self.conn.close()
+
+
+def _header(headers: dict, name: str) -> Optional[str]:
+    for key, value in (headers or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+class HttpCacheDown(BaseDown):
+    """
+    带本地缓存的下载器 包装 http_cache_downer_class 配置的下载器
+    新鲜(保存时间不超过 http_cache_max_age)的响应直接返回 不访问网络
+    过期的响应带上 If-None-Match/If-Modified-Since 请求 304 时返回缓存
+    只缓存 GET 请求的 200 响应 流式下载和 Cache-Control: no-store 的响应不缓存
+    """
+
+    def __init__(self):
+        self.downer = None
+        self.store: Optional[HttpCacheStore] = None
+        # 第一个请求开始的初始化 其他请求等待它完成
+        self.initing: Optional[asyncio.Future] = None
+        self.max_age = None
+        self.digest_size = None
+        # sqlite 连接只在这一个线程中使用
+        self.executor = ThreadPoolExecutor(1)
+        self.log = log
+
+    async def _init(self, request: Request):
+        spider = getattr(request, "__spider__", None)
+        setting = spider.cutome_setting_dict if spider else {}
+
+        def get_setting(key):
+            value = setting.get(key)
+            return gloable_setting_dict.get(key) if value is None else value
+
+        class_str = get_setting("http_cache_downer_class")
+        _module = importlib.import_module(".".join(class_str.split(".")[:-1]))
+        self.downer = getattr(_module, class_str.split(".")[-1])()
+        self.max_age = get_setting("http_cache_max_age")
+        self.digest_size = get_setting("fingerprint_digest_size")
+        # 打开缓存时会统计大小和淘汰 在线程中执行 不阻塞事件循环
+        self.store = await self._run(HttpCacheStore, os.path.join(get_setting("http_cache_dir"), "cache.sqlite"),
+                                     get_setting("http_cache_max_size"), get_setting("http_cache_expire"))
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _fetch(self, request: Request) -> Response:
+        if inspect.iscoroutinefunction(self.downer.fetch):
+            return await self.downer.fetch(request)
+        return await asyncio.get_running_loop().run_in_executor(None, self.downer.fetch, request)
+
+    async def fetch(self, request: Request) -> Response:
+        if self.store is None:
+            if self.initing is None:
+                self.initing = asyncio.ensure_future(self._init(request))
+            try:
+                # 一个请求被取消时不取消初始化
+                await asyncio.shield(self.initing)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # 初始化失败 下一个请求重新初始化
+                self.initing = None
+                raise
+        if request.method.lower() != "get" or request.stream:
+            return await self._fetch(request)
+        fingerprint = request_fingerprint(request.url, request.method, request.data, digest_size=self.digest_size)
+        entry = await self._run(self.store.get, fingerprint)
+        if entry is not None:
+            url, status, headers, body, etag, last_modified, stored_at = entry
+            if time.time() - stored_at <= self.max_age:
+                self.log.debug(f"http cache hit {request.url}")
+                return Response(body=body, status=status, headers=headers)
+            response = await self._revalidate(request, etag, last_modified)
+            if response.status == 304:
+                self.log.debug(f"http cache revalidated {request.url}")
+                await self._run(self.store.touch, fingerprint)
+                return Response(body=body, status=status, headers=headers)
+        else:
+            response = await self._fetch(request)
+        cache_control = _header(response.headers, "cache-control") or ""
+        if response.status == 200 and response.file is None and "no-store" not in cache_control.lower():
+            await self._run(self.store.put, fingerprint, request.url, response.status,
+                            dict(response.headers or {}), response.body or b"")
+        return response
+
+    async def _revalidate(self, request: Request, etag: Optional[str], last_modified: Optional[str]) -> Response:
+        # 只在这次请求中带上验证头 不修改请求本身 重试时不会带上
+        header = request.header
+        validators = {}
+        if etag:
+            validators["If-None-Match"] = etag
+        if last_modified:
+            validators["If-Modified-Since"] = last_modified
+        request.header = {**(header or {}), **validators}
+        try:
+            return await self._fetch(request)
+        finally:
+            request.header = header
+
+    async def close(self):
+        """
+        关闭缓存和被包装的下载器
+        :return: None
+        """
+        if self.initing is not None and not self.initing.done():
+            await asyncio.gather(self.initing, return_exceptions=True)
+        if self.downer is not None:
+            close = getattr(self.downer, "close", None)
+            if callable(close):
+                res = close()
+                if inspect.isawaitable(res):
+                    await res
+        if self.store is not None:
+            store, self.store = self.store, None
+            await self._run(store.close)
+        self.executor.shutdown(wait=False)
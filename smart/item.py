@@ -131,6 +131,9 @@ class Item(metaclass=ItemMeta):
             self.__dict__["results"][name] = value
 
     def __getattr__(self, item):
+        # 魔术方法不当作字段 否则 pickle 等协议查找 __setstate__ 时会无限递归
+        if item.startswith("__") and item.endswith("__"):
+            raise AttributeError(item)
         return self.__getitem__(item)
 
     def __iter__(self):
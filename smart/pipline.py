@@ -5,9 +5,13 @@
 # Date:      2020/12/28
 # Desc:      there is a  item Piplines
 # ------------------------------------------------------------------
+import asyncio
+import inspect
 from copy import copy
 from functools import wraps
-from typing import Union, Callable
+from typing import Union, Callable, List
+
+from smart.log import log
 
 
 class Piplines:
@@ -18,6 +22,8 @@ class Piplines:
     def __init__(self):
         # item piplines
         self.piplines = []
+        # 批量 piplines (order, func, size, max_wait)
+        self.batch_piplines = []
 
     def pipline(self, order_or_func: Union[int, Callable]):
         """
@@ -46,9 +52,101 @@ class Piplines:
             return outWrap(cp_order)
         return outWrap
 
+    def batch(self, order: int = 0, size: int = 500, max_wait: float = 1.0):
+        """
+        一个批量 item pipline 函数签名为 (spider_ins, items: List[Item])
+        在所有普通 pipline 处理完之后 item 进入批量缓冲区
+        攒够 size 个 或第一个 item 进入后超过 max_wait 秒 或引擎关闭时调用一次
+        适合数据库 文件等支持批量写入的场景
+        eg: @piplines.batch(1, size=500, max_wait=1.0)
+        :param order: 优先级
+        :param size: 每批最多的 item 数
+        :param max_wait: 最长等待时间 s
+        :return:
+        """
+        if size <= 0:
+            raise ValueError("batch pipline size must >0")
+
+        def outWrap(func):
+            self.batch_piplines.append((order, func, size, max_wait))
+            self.batch_piplines = sorted(self.batch_piplines, key=lambda key: key[0])
+            return func
+
+        return outWrap
+
     def __add__(self, other):
         pls = Piplines()
         pls.piplines.extend(self.piplines)
         pls.piplines.extend(other.piplines)
         pls.piplines = sorted(pls.piplines, key=lambda key: key[0])
+        pls.batch_piplines.extend(self.batch_piplines)
+        pls.batch_piplines.extend(other.batch_piplines)
+        pls.batch_piplines = sorted(pls.batch_piplines, key=lambda key: key[0])
         return pls
+
+
+class BatchPipline:
+    """
+    批量 pipline 的缓冲区 由引擎创建
+    """
+
+    def __init__(self, func: Callable, size: int, max_wait: float):
+        self.func = func
+        self.size = size
+        self.max_wait = max_wait
+        self.items = []
+        self.timer = None
+        # 正在执行的 flush
+        self.tasks = set()
+        self.log = log
+
+    async def add(self, spider_ins, item):
+        """
+        添加一个 item 攒够 size 个时立即 flush
+        :param spider_ins: 爬虫
+        :param item: item
+        :return: None
+        """
+        self.items.append(item)
+        if len(self.items) >= self.size:
+            await self.flush(spider_ins)
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush_later, spider_ins)
+
+    def _flush_later(self, spider_ins):
+        self.timer = None
+        task = asyncio.ensure_future(self.flush(spider_ins))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self, spider_ins):
+        """
+        把缓冲区中的 item 交给批量 pipline
+        :param spider_ins: 爬虫
+        :return: None
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        items: List = self.items
+        if not items:
+            return
+        self.items = []
+        try:
+            if inspect.iscoroutinefunction(self.func):
+                await self.func(spider_ins, items)
+            else:
+                await asyncio.get_running_loop().run_in_executor(None, self.func, spider_ins, items)
+        except Exception as e:
+            self.log.error(f"in batch pipline {getattr(self.func, '__name__', self.func)} "
+                           f"occured an error: {e}, {len(items)} items lost", exc_info=True)
+
+    async def close(self, spider_ins):
+        """
+        引擎关闭时调用 flush 剩余的 item 并等待所有 flush 完成
+        :param spider_ins: 爬虫
+        :return: None
+        """
+        await self.flush(spider_ins)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,121 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      process
+# Author:    liangbaikai
+# Date:      2021/1/29
+# Desc:      run cpu heavy sync piplines and callbacks in a process pool
+# ------------------------------------------------------------------
+import inspect
+from concurrent.futures import ProcessPoolExecutor
+from types import GeneratorType
+from typing import Callable, List, Optional, Tuple
+
+from smart.item import Item
+from smart.log import log
+from smart.request import Request
+from smart.response import Response
+from smart.serialize import request_to_tuple, request_from_tuple, name_to_callback
+
+# 子进程中的爬虫 由进程池的 initializer 设置
+_spider = None
+
+
+def run_in_process(func: Callable) -> Callable:
+    """
+    标记同步的 pipline 或回调函数在进程池中执行 适合 lxml 解析等 cpu 密集的场景
+    函数必须是模块级函数或爬虫的方法 参数和返回值需要可以 pickle
+    进程中的 spider 是创建进程池时的一份拷贝 在进程中修改爬虫的属性不会影响主进程
+    eg:
+        @piplines.pipline(1)
+        @run_in_process
+        def clean(spider_ins, item): ...
+
+        @run_in_process
+        def parse(self, response): ...
+    :param func: 同步函数
+    :return: 原函数
+    """
+    if inspect.iscoroutinefunction(func) or inspect.isasyncgenfunction(func):
+        raise ValueError(f"{func.__name__} is async, only sync func can run in process")
+    func.run_in_process = True
+    return func
+
+
+def is_run_in_process(func: Callable) -> bool:
+    return bool(getattr(func, "run_in_process", False))
+
+
+def create_process_pool(spider, max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """
+    创建进程池 每个子进程持有一份 spider
+    :param spider: 爬虫
+    :param max_workers: 进程数 默认 cpu 核数
+    :return: ProcessPoolExecutor
+    """
+    return ProcessPoolExecutor(max_workers, initializer=_init_process, initargs=(spider,))
+
+
+def _init_process(spider):
+    global _spider
+    _spider = spider
+
+
+def call_pipline(pip: Callable, item: Item):
+    """
+    在子进程中执行 pipline
+    :param pip: pipline 函数
+    :param item: item
+    :return: pipline 的返回值
+    """
+    return pip(_spider, item)
+
+
+def response_to_tuple(response: Response) -> tuple:
+    """
+    response 只传递 body 等基础数据 selector 在子进程中重新构建
+    :param response: 响应
+    :return: tuple
+    """
+    cookies = {key: getattr(value, "value", value) for key, value in (response.cookies or {}).items()}
+    return request_to_tuple(response.request), response.body, response.status, response.headers, cookies
+
+
+def call_callback(callback_name: str, data: tuple) -> List[Tuple[str, object]]:
+    """
+    在子进程中执行回调函数 生成器在子进程中迭代完 结果以列表返回
+    请求转为 tuple 回调函数只传递名称
+    :param callback_name: callback_to_name 的结果
+    :param data: response_to_tuple 的结果
+    :return: [("request", tuple) | ("other", Item 等)]
+    """
+    request_data, body, status, headers, cookies = data
+    request = request_from_tuple(request_data, _spider)
+    response = Response(body=body, status=status, request=request, headers=headers, cookies=cookies)
+    results = []
+    _collect(name_to_callback(callback_name, _spider)(response), results)
+    return results
+
+
+def _collect(result, results: list):
+    if isinstance(result, GeneratorType):
+        for each in result:
+            _collect(each, results)
+    elif isinstance(result, Request):
+        results.append(("request", request_to_tuple(result)))
+    elif inspect.iscoroutine(result):
+        result.close()
+        log.warning("coroutine yielded by a callback run in process is ignored")
+    elif result is not None:
+        results.append(("other", result))
+
+
+def results_from_process(results: List[Tuple[str, object]], owner):
+    """
+    还原子进程返回的回调结果
+    :param results: call_callback 的结果
+    :param owner: 回调函数所属对象 一般是 spider
+    :return: Generator
+    """
+    for kind, value in results:
+        yield request_from_tuple(value, owner) if kind == "request" else value
+
@@ -8,13 +8,16 @@
 from dataclasses import dataclass, InitVar
 from typing import Callable, Any
 
-from smart.tool import is_valid_url
+from smart.tool import is_valid_url, dataclass_slots
 
 
+@dataclass_slots("url", "__spider__")
 @dataclass
 class Request:
     """
     请求对象  分分布式条件下需要保证此对象能被序列化
+    使用 __slots__ 没有 __dict__ 不能随意添加属性 需要传递的值放在 meta 中
+    需要添加属性时可以继承此类 子类会有 __dict__
     """
 
     # 请求地址
@@ -41,6 +44,11 @@ class Request:
     meta: dict = None
     # 是否过滤请求 默认过滤
     dont_filter: bool = False
+    # 优先级 数值越大越先被调度 需要配合优先级调度容器使用
+    priority: int = 0
+    # 流式下载 响应体按块读取 超过 stream_spool_size 的部分写入临时文件 通过 response.file 读取
+    # 适合图片 pdf 等大文件 避免整个文件读入内存
+    stream: bool = False
     # 已经重试请求的次数 超过最大重试次数 将被丢弃 触发对应的信号机制
     _retry: int = 0
 
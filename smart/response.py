@@ -5,20 +5,45 @@
 # Date:      2020/12/21
 # Desc:      response desc
 # ------------------------------------------------------------------
+import codecs
 import json
+import re
+import shutil
 from dataclasses import dataclass
-from typing import List, Dict, Union, Any, Optional
+from typing import List, Dict, Union, Any, Optional, IO, Iterator
 
 import cchardet
 from jsonpath import jsonpath
 from parsel import Selector, SelectorList
 
-from smart.tool import get_index_url
+from smart.tool import get_index_url, dataclass_slots
 from .request import Request
 
+# 在 body 开头多少字节内查找 <meta charset> 或 xml 声明
+CHARSET_SNIFF_SIZE = 4096
+# cchardet 只探测 body 开头的字节 避免对很大的页面整体探测
+CHARSET_DETECT_SIZE = 64 * 1024
+_HEADER_CHARSET_RE = re.compile(r"charset\s*=\s*[\"']?([\w.:-]+)", re.I)
+_BODY_CHARSET_RE = re.compile(br"""(?:<meta[^>]+charset\s*=\s*["']?|<\?xml[^>]+encoding\s*=\s*["'])([\w.:-]+)""", re.I)
 
+
+def _valid_charset(charset) -> Optional[str]:
+    if isinstance(charset, bytes):
+        charset = charset.decode("ascii", "ignore")
+    if not charset:
+        return None
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return None
+
+
+@dataclass_slots("__spider__")
 @dataclass
 class Response:
+    """
+    响应对象 使用 __slots__ 没有 __dict__ 需要添加属性时可以继承此类
+    """
     # 响应数据
     body: bytes
     # 响应状态码
@@ -30,6 +55,11 @@ class Response:
     # 响应cookies
     cookies: dict = None
     _selector: Selector = None
+    # 解码后的文本 只解码一次
+    _text: str = None
+    # 流式下载(request.stream)时的响应体 小的在内存中 大的在临时文件中 body 为 b""
+    # 回调处理完后关闭 需要在回调中读取或保存
+    file: IO[bytes] = None
 
     def xpath(self, xpath_str) -> Union[SelectorList]:
         """
@@ -119,6 +149,44 @@ class Response:
                 full_urls.append(link)
         return full_urls
 
+    def iter_content(self, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        """
+        按块读取响应体 流式下载时从 file 读取 不会把整个响应体读入内存
+        :param chunk_size: 块大小
+        :return: Iterator[bytes]
+        """
+        if self.file is None:
+            if self.body:
+                yield self.body
+            return
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def save(self, path: str):
+        """
+        响应体保存到文件
+        :param path: 文件路径
+        :return: None
+        """
+        with open(path, "wb") as f:
+            if self.file is None:
+                f.write(self.body or b"")
+            else:
+                self.file.seek(0)
+                shutil.copyfileobj(self.file, f)
+
+    def close(self):
+        """
+        关闭流式下载的临时文件
+        :return: None
+        """
+        if self.file is not None:
+            self.file.close()
+
     @property
     def selector(self) -> Selector:
         """
@@ -152,18 +220,35 @@ class Response:
     @property
     def text(self) -> Optional[str]:
         """
-        文本数据
+        文本数据 只解码一次
+        编码优先级: request.encoding > 响应头 Content-Type 的 charset > 页面开头的 <meta charset> > cchardet 探测
         :return: Optional[str]
         """
+        if self._text is not None:
+            return self._text
         if not self.body:
             return None
         # if request encoding is none and then  auto detect encoding
-        self.request.encoding = self.encoding or cchardet.detect(self.body)["encoding"]
+        self.request.encoding = self.encoding or self._detect_encoding()
         if self.request.encoding is None:
             raise UnicodeDecodeError(
                 "body can not detect an encoding,it may be a binary data or you can set request.encoding to try it  ")
         # minimum possible may be UnicodeDecodeError
-        return self.body.decode(self.encoding)
+        self._text = self.body.decode(self.encoding)
+        return self._text
+
+    def _detect_encoding(self) -> Optional[str]:
+        content_type = self.content_type
+        if content_type:
+            match = _HEADER_CHARSET_RE.search(content_type)
+            charset = _valid_charset(match and match.group(1))
+            if charset:
+                return charset
+        match = _BODY_CHARSET_RE.search(self.body, 0, CHARSET_SNIFF_SIZE)
+        charset = _valid_charset(match and match.group(1))
+        if charset:
+            return charset
+        return cchardet.detect(self.body[:CHARSET_DETECT_SIZE])["encoding"]
 
     @property
     def url(self) -> str:
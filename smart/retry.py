@@ -0,0 +1,194 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      retry
+# Author:    liangbaikai
+# Date:      2021/1/31
+# Desc:      delayed retry with exponential backoff and per host circuit breaker
+# ------------------------------------------------------------------
+import asyncio
+import heapq
+import importlib
+import itertools
+import random
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from smart.log import log
+from smart.request import Request
+from smart.setting import gloable_setting_dict
+from smart.signal import Reminder, reminder
+from smart.tool import get_domain
+
+
+def _load_class(class_str: str):
+    _module = importlib.import_module(".".join(class_str.split(".")[:-1]))
+    return getattr(_module, class_str.split(".")[-1])
+
+
+class RetryManager:
+    """
+    重试管理
+    需要重试的请求按到期时间放在堆中 到期后才放回调度器 不占用待抓取队列
+    重试间隔指数增长并带随机抖动 同一个 host 连续失败达到阈值后熔断一段时间
+    熔断期间该 host 的请求延后到熔断结束 结束后第一次失败会再次熔断
+    """
+
+    def __init__(self, schedule: Callable[[Request], Awaitable], spider=None):
+        """
+        初始方法
+        :param schedule: 请求到期后放回调度器的协程函数 一般是引擎的 _requeue
+        :param spider: 爬虫 优先读取爬虫的配置
+        """
+        self.schedule = schedule
+        setting = spider.cutome_setting_dict if spider else {}
+
+        def get_setting(key):
+            value = setting.get(key)
+            return gloable_setting_dict.get(key) if value is None else value
+
+        self.max_retry = get_setting("req_max_retry")
+        self.http_codes = set(get_setting("retry_http_codes") or ())
+        self.exceptions = tuple(_load_class(name) if isinstance(name, str) else name
+                                for name in get_setting("retry_exceptions") or ())
+        self.backoff_base = get_setting("retry_backoff_base")
+        self.backoff_max = get_setting("retry_backoff_max")
+        self.jitter = get_setting("retry_jitter")
+        self.breaker_threshold = get_setting("circuit_breaker_threshold")
+        self.breaker_cooldown = get_setting("circuit_breaker_cooldown")
+        # (到期时间, 序号, 请求)
+        self.heap: List[Tuple[float, int, Request]] = []
+        # id(request) -> request 堆中和正在放回调度器的请求
+        self.held: Dict[int, Request] = {}
+        self.counter = itertools.count()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        # 已到期 正在放回调度器的请求
+        self.tasks = set()
+        # host -> [连续失败次数, 熔断结束时间]
+        self.hosts: Dict[str, list] = {}
+        self.log = log
+
+    def size(self) -> int:
+        return len(self.heap) + len(self.tasks)
+
+    def holds(self, request: Request) -> bool:
+        """
+        请求是否在等待重试(或熔断结束) 还没有处理完
+        :param request: 请求
+        :return: bool
+        """
+        return self.held.get(id(request)) is request
+
+    def is_retry_status(self, status: int) -> bool:
+        return status in self.http_codes
+
+    def is_retry_exception(self, e: BaseException) -> bool:
+        return bool(self.exceptions) and isinstance(e, self.exceptions)
+
+    def allow(self, request: Request) -> bool:
+        """
+        host 是否处于熔断中
+        :param request: 请求
+        :return: 可以发送返回 True
+        """
+        state = self.hosts.get(get_domain(request.url))
+        return state is None or state[1] <= time.time()
+
+    def record_success(self, request: Request):
+        self.hosts.pop(get_domain(request.url), None)
+
+    def record_failure(self, request: Request):
+        if not self.breaker_threshold:
+            return
+        host = get_domain(request.url)
+        state = self.hosts.setdefault(host, [0, 0])
+        state[0] += 1
+        if state[0] >= self.breaker_threshold:
+            state[1] = time.time() + self.breaker_cooldown
+            self.log.warning(f"host {host} failed {state[0]} times continuously, "
+                             f"circuit breaker opened for {self.breaker_cooldown} s")
+
+    def backoff(self, request: Request) -> float:
+        """
+        第 n 次重试的等待时间  base * 2^(n-1) 不超过 backoff_max 再乘以 [1-jitter, 1] 的随机数
+        :param request: 请求
+        :return: s
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2 ** max(request.retry - 1, 0))
+        return delay * (1 - self.jitter * random.random())
+
+    def retry(self, request: Request, reason=None) -> bool:
+        """
+        记录失败 按退避时间延后重试 达到最大重试次数时丢弃
+        :param request: 请求
+        :param reason: 原因 用于日志
+        :return: 是否会重试
+        """
+        self.record_failure(request)
+        if request.retry >= self.max_retry:
+            reminder.go(Reminder.request_dropped, request, reason=reason)
+            self.log.error(f"reached max retry times {self.max_retry}, drop {request.url} reason: {reason}")
+            return False
+        delay = self.backoff(request)
+        state = self.hosts.get(get_domain(request.url))
+        if state and state[1] > time.time():
+            delay = max(delay, state[1] - time.time())
+        self.log.debug(f"{request.url} will retry after {round(delay, 3)} s reason: {reason}")
+        self._push(time.time() + delay, request)
+        return True
+
+    def defer(self, request: Request):
+        """
+        host 熔断中 请求延后到熔断结束 不计入重试次数
+        :param request: 请求
+        :return: None
+        """
+        state = self.hosts.get(get_domain(request.url))
+        due = state[1] if state else time.time()
+        # 熔断结束时不要同时放出所有请求
+        self._push(due + self.breaker_cooldown * self.jitter * random.random(), request)
+
+    def _push(self, due: float, request: Request):
+        heapq.heappush(self.heap, (due, next(self.counter), request))
+        self.held[id(request)] = request
+        if self.heap[0][2] is request:
+            self._reset_timer()
+
+    def _reset_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.heap:
+            loop = asyncio.get_event_loop()
+            # 堆中是 time.time() 转为事件循环的时间
+            delay = max(self.heap[0][0] - time.time(), 0)
+            self.timer = loop.call_at(loop.time() + delay, self._on_due)
+
+    def _on_due(self):
+        self.timer = None
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, request = heapq.heappop(self.heap)
+            if not self.allow(request):
+                # 等待期间 host 熔断了
+                self.defer(request)
+                continue
+            task = asyncio.ensure_future(self._schedule(request))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        self._reset_timer()
+
+    async def _schedule(self, request: Request):
+        # 放回调度器之前移除 放回后可能立即被 worker 取出并处理完
+        self.held.pop(id(request), None)
+        await self.schedule(request)
+
+    def close(self):
+        """
+        引擎关闭时取消定时器
+        :return: None
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        for task in self.tasks:
+            task.cancel()
@@ -8,9 +8,11 @@
 import asyncio
 import importlib
 import inspect
+import multiprocessing
 import sys
 import time
 from asyncio import CancelledError
+from collections import Counter
 from concurrent.futures.thread import ThreadPoolExecutor
 from typing import List
 from urllib.request import urlopen
@@ -20,6 +22,7 @@ from smart.core9 import Engine
 from smart.middlewire import Middleware
 from smart.pipline import Piplines
 from smart.setting import gloable_setting_dict
+from smart.shard import ShardContext, ShardEngine, default_shard_num
 from smart.spider import Spider
 from smart.tool import is_valid_url
 
@@ -50,7 +53,8 @@ class CrawStater:
         self.log = log
         self.spider_names = []
 
-    def run_many(self, spiders: List[Spider], middlewire: Middleware = None, pipline: Piplines = None):
+    def run_many(self, spiders: List[Spider], middlewire: Middleware = None, pipline: Piplines = None,
+                 resume: bool = False):
         if not spiders or len(spiders) <= 0:
             raise ValueError("need spiders")
         for spider in spiders:
@@ -58,26 +62,27 @@ class CrawStater:
                 raise ValueError("need a  Spider sub instance")
             _middle = spider.cutome_setting_dict.get("middleware_instance") or middlewire
             _pip = spider.cutome_setting_dict.get("piplines_instance") or pipline
-            core = Engine(spider, _middle, _pip)
+            core = Engine(spider, _middle, _pip, resume=resume)
             self.cores.append(core)
             self.spider_names.append(spider.name)
         self._check_internet_state()
         self._run()
 
-    def run_single(self, spider: Spider, middlewire: Middleware = None, pipline: Piplines = None):
+    def run_single(self, spider: Spider, middlewire: Middleware = None, pipline: Piplines = None,
+                   resume: bool = False):
         if not spider:
             raise ValueError("need a  Spider class or Spider sub instance")
         if not isinstance(spider, Spider):
             raise ValueError("need a   Spider sub instance")
         _middle = spider.cutome_setting_dict.get("middleware_instance") or middlewire
         _pip = spider.cutome_setting_dict.get("piplines_instance") or pipline
-        core = Engine(spider, _middle, _pip)
+        core = Engine(spider, _middle, _pip, resume=resume)
         self.cores.append(core)
         self.spider_names.append(spider.name)
         self._run()
 
     def run(self, spider_module: str, spider_names: List[str] = [], middlewire: Middleware = None,
-            pipline: Piplines = None):
+            pipline: Piplines = None, resume: bool = False):
 
         spider_module = importlib.import_module(f'{spider_module}')
         spider = [x for x in inspect.getmembers(spider_module,
@@ -92,11 +97,58 @@ class CrawStater:
                     _spider = tuple_item[1]()
                     if not isinstance(_spider, Spider):
                         raise ValueError("need a   Spider sub instance")
-                    core = Engine(_spider, _middle, _pip)
+                    core = Engine(_spider, _middle, _pip, resume=resume)
                     self.cores.append(core)
                     self.spider_names.append(_spider.name)
             self._run()
 
+    def run_multiprocess(self, spider: Spider, processes: int = None, middlewire: Middleware = None,
+                         pipline: Piplines = None) -> dict:
+        """
+        多进程运行一个爬虫 每个进程一个事件循环和引擎 按 host 分片抓取
+        middlewire pipline 在每个进程中各自执行
+        :param spider: 爬虫实例
+        :param processes: 进程数 默认 shard_process_num 或 cpu 核数
+        :param middlewire: 中间件
+        :param pipline: pipline
+        :return: 汇总的统计数据
+        """
+        if not isinstance(spider, Spider):
+            raise ValueError("need a   Spider sub instance")
+        processes = processes or default_shard_num()
+        _middle = spider.cutome_setting_dict.get("middleware_instance") or middlewire
+        _pip = spider.cutome_setting_dict.get("piplines_instance") or pipline
+        # fork 时 spider middlewire pipline 不需要 pickle
+        methods = multiprocessing.get_all_start_methods()
+        mp_context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        context = ShardContext(processes, mp_context)
+        start = time.time()
+        workers = [mp_context.Process(target=_run_shard, args=(spider, _middle, _pip, context, shard),
+                                      name=f"{spider.name}-shard-{shard}")
+                   for shard in range(processes)]
+        for worker in workers:
+            worker.start()
+        stats, reported = Counter(), 0
+        try:
+            while reported < processes:
+                try:
+                    _, shard_stats = context.results.get(True, 1)
+                except Exception:
+                    if not any(worker.is_alive() for worker in workers):
+                        break
+                    continue
+                stats.update(shard_stats)
+                reported += 1
+        except KeyboardInterrupt:
+            self.log.debug("in multiprocess run, occured KeyboardInterrupt")
+        for worker in workers:
+            worker.join()
+        if reported < processes:
+            self.log.error(f"only {reported} of {processes} shards of {spider.name} ended normally")
+        self.log.info(f'craw succeed {spider.name} with {processes} processes ended.. '
+                      f'it cost {round(time.time() - start, 3)} s, stats: {dict(stats)}')
+        return dict(stats)
+
     def stop(self):
         self.log.info(f'warning stop be called,  {",".join(self.spider_names)} will stop ')
         for core in self.cores:
@@ -174,3 +226,13 @@ class CrawStater:
                 raise RuntimeError(error_msg)
         except Exception:
             raise RuntimeError(error_msg)
+
+
+def _run_shard(spider: Spider, middlewire: Middleware, pipline: Piplines, context: ShardContext, shard: int):
+    """
+    分片进程的入口 创建自己的事件循环(有 uvloop 时使用 uvloop)
+    """
+    stater = CrawStater()
+    stater.cores.append(ShardEngine(spider, middlewire, pipline, context=context, shard=shard))
+    stater.spider_names.append(f"{spider.name}-shard-{shard}")
+    stater._run()
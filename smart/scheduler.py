@@ -6,17 +6,27 @@
 # Desc:      request scheduler, request filter
 # ------------------------------------------------------------------
 import asyncio
+import heapq
 import inspect
+import itertools
+import os
+import pickle
+import shutil
+import tempfile
 import time
 from collections import deque
-from typing import Optional, Any
+from typing import Optional, Any, Dict, Callable
 
+from smart.bloom import ScalableBloomFilter
 from smart.log import log
 from smart.request import Request
 
 from abc import ABC, abstractmethod
 
-from smart.tool import mutations_bkdr_hash
+from smart.serialize import request_to_tuple, request_from_tuple, is_restorable_callback
+from smart.setting import gloable_setting_dict
+from smart.signal import reminder
+from smart.tool import get_domain, request_fingerprint, to_fingerprint, fingerprint_digest_size
 
 
 class BaseSchedulerContainer(ABC):
@@ -24,6 +34,8 @@ class BaseSchedulerContainer(ABC):
     request  保存的容器
     可以是一个队列 数据库 或者 redis
     """
+    # 请求是否保存在进程外(如 redis) 进程退出后不会丢失 检查点不需要保存待抓取的请求
+    persistent = False
 
     @abstractmethod
     def push(self, request: Request):
@@ -37,12 +49,58 @@ class BaseSchedulerContainer(ABC):
     def size(self) -> int:
         pass
 
+    def open(self, spider):
+        """
+        引擎创建调度器后调用 需要读取爬虫配置(cutome_setting_dict)的容器重写此方法 默认什么都不做
+        :param spider: 爬虫
+        :return: None
+        """
+        pass
+
+    def release(self, request: Request):
+        """
+        请求处理结束(下载完成 失败或被丢弃)时调用
+        需要跟踪在途请求的容器可以重写此方法 默认什么都不做
+        :param request: 请求
+        :return: None
+        """
+        pass
+
+    def ack(self, request: Request):
+        """
+        请求的回调处理结束(产生的新请求已放入调度器)时调用
+        至少一次投递的容器(如 redis 租约队列)在这里确认请求 默认什么都不做
+        :param request: 请求
+        :return: None
+        """
+        pass
+
+    def set_host_limit(self, host: str, concurrency: int, delay: float) -> bool:
+        """
+        设置某个 host 的在途请求数和请求间隔 自动限速使用
+        按 host 限流的容器重写此方法 默认不支持
+        :param host: host
+        :param concurrency: 最大在途请求数
+        :param delay: 最小请求间隔 s
+        :return: 是否支持
+        """
+        return False
+
+    async def wait_closed(self):
+        """
+        引擎关闭信号之后调用 等待容器在关闭信号中开始的异步清理(如归还连接池)完成
+        :return: None
+        """
+        pass
+
 
 class BaseDuplicateFilter(ABC):
     """
     请求去重过滤器
-    目前内置的是一个基于set的去重 你可以扩展成布隆过滤器
+    内置基于set的去重 SampleDuplicateFilter 和布隆过滤器去重 BloomDuplicateFilter
     """
+    # 由 url 计算的指纹的字节数 open 时读取爬虫的配置 为 None 时使用全局配置
+    digest_size = None
 
     @abstractmethod
     def add(self, url) -> Any:
@@ -56,29 +114,189 @@ class BaseDuplicateFilter(ABC):
     def length(self) -> int:
         pass
 
+    def open(self, spider):
+        """
+        引擎创建调度器后调用 读取爬虫的配置
+        :param spider: 爬虫
+        :return: None
+        """
+        self.digest_size = fingerprint_digest_size(spider)
+
+    def add_if_absent(self, url) -> Optional[bool]:
+        """
+        不存在时加入 远端去重器(如 redis)重写为一次原子操作 省去 contains 的网络往返
+        不支持时返回 None 调度器改用 contains + add
+        :param url: url 或指纹
+        :return: 是否是新加入的
+        """
+        return None
+
+    def checkpoint(self, directory: str) -> Optional[Callable[..., None]]:
+        """
+        检查点使用 在事件循环中调用 拷贝需要保存的状态
+        返回一个在线程池中执行的写文件函数  返回 None 表示不需要保存(如状态本身保存在 redis 中)
+        待抓取请求没有写入时 在事件循环中以 discard=True 调用它 不写文件 放回拷贝时取出的状态
+        :param directory: 检查点目录
+        :return: Optional[Callable]
+        """
+        return None
+
+    def restore(self, directory: str) -> bool:
+        """
+        从检查点目录恢复
+        :param directory: 检查点目录
+        :return: 是否恢复成功
+        """
+        return False
+
+    async def wait_closed(self):
+        """
+        引擎关闭信号之后调用 等待去重器在关闭信号中开始的异步清理完成
+        :return: None
+        """
+        pass
+
 
 class SampleDuplicateFilter(BaseDuplicateFilter):
     """
-    基于set的请求去重器
+    基于set的请求去重器 保存二进制请求指纹
     """
 
+    # 检查点文件 定长指纹追加写入
+    checkpoint_file = "duplicate.fp"
+
     def __init__(self):
         self.set_container = set()
+        # 上次检查点之后新增的指纹 开启检查点后才记录
+        self.journal = None
 
     def add(self, url):
         if url:
-            self.set_container.add(mutations_bkdr_hash(url))
+            fingerprint = to_fingerprint(url, self.digest_size)
+            if self.journal is not None and fingerprint not in self.set_container:
+                self.journal.append(fingerprint)
+            self.set_container.add(fingerprint)
 
     def contains(self, url):
         if not url:
             return False
-        if mutations_bkdr_hash(url) in self.set_container:
+        if to_fingerprint(url, self.digest_size) in self.set_container:
             return True
         return False
 
     def length(self):
         return len(self.set_container)
 
+    def checkpoint(self, directory: str) -> Optional[Callable[..., None]]:
+        path = os.path.join(directory, self.checkpoint_file)
+        if self.journal is None:
+            # 第一次保存全量 之后只追加增量
+            fingerprints, mode = list(self.set_container), "wb"
+        else:
+            fingerprints, mode = self.journal, "ab"
+        self.journal = []
+
+        def put_back():
+            # 指纹放回 journal 下次重新写
+            if mode == "wb":
+                self.journal = None
+            else:
+                self.journal[:0] = fingerprints
+
+        def write(discard: bool = False):
+            if discard:
+                return put_back()
+            with open(path, mode) as f:
+                start = f.tell()
+                try:
+                    f.write(b"".join(len(fingerprint).to_bytes(1, "little") + fingerprint
+                                     for fingerprint in fingerprints))
+                    f.flush()
+                except BaseException:
+                    # 写入失败 去掉不完整的记录
+                    f.truncate(start)
+                    put_back()
+                    raise
+
+        return write
+
+    def restore(self, directory: str) -> bool:
+        path = os.path.join(directory, self.checkpoint_file)
+        if not os.path.exists(path):
+            return False
+        with open(path, "rb") as f:
+            data = f.read()
+        offset, total = 0, len(data)
+        while offset < total:
+            size = data[offset]
+            end = offset + 1 + size
+            # 进程在写文件时退出 最后一条记录可能不完整
+            if end > total:
+                break
+            self.set_container.add(data[offset + 1:end])
+            offset = end
+        self.journal = []
+        return True
+
+
+class BloomDuplicateFilter(BaseDuplicateFilter):
+    """
+    基于可扩容布隆过滤器的请求去重器
+    每个 url 只占用约 -ln(p)/(ln2)^2 个 bit  存在 error_rate 的误判(新请求被当作重复过滤)
+    """
+
+    def __init__(self, capacity: int = None, error_rate: float = None, path: str = None):
+        """
+        初始方法
+        :param capacity: 初始容量 写满后自动扩容
+        :param error_rate: 误判率
+        :param path: 持久化文件路径 文件存在时从文件加载
+        """
+        capacity = capacity or gloable_setting_dict.get("bloom_filter_capacity")
+        error_rate = error_rate or gloable_setting_dict.get("bloom_filter_error_rate")
+        self.path = path or gloable_setting_dict.get("bloom_filter_path")
+        if self.path and os.path.exists(self.path):
+            self.bloom = ScalableBloomFilter.load(self.path)
+            log.info(f"bloom filter loaded from {self.path}, length {len(self.bloom)}")
+        else:
+            self.bloom = ScalableBloomFilter(capacity, error_rate)
+
+    def add(self, url):
+        if url:
+            self.bloom.add(to_fingerprint(url, self.digest_size))
+
+    def contains(self, url):
+        if not url:
+            return False
+        return to_fingerprint(url, self.digest_size) in self.bloom
+
+    def length(self):
+        return len(self.bloom)
+
+    def save(self, path: str = None):
+        """
+        将 bit 数组保存到文件
+        :param path: 文件路径 默认构造时的 path
+        :return: None
+        """
+        path = path or self.path
+        if not path:
+            raise ValueError("bloom filter save need a path")
+        self.bloom.save(path)
+
+    def checkpoint(self, directory: str) -> Optional[Callable[..., None]]:
+        bloom = self.bloom.copy()
+        path = os.path.join(directory, "duplicate.bloom")
+        # 每次保存全量 没有需要放回的状态
+        return lambda discard=False: None if discard else bloom.save(path)
+
+    def restore(self, directory: str) -> bool:
+        path = os.path.join(directory, "duplicate.bloom")
+        if not os.path.exists(path):
+            return False
+        self.bloom = ScalableBloomFilter.load(path)
+        return True
+
 
 class DequeSchedulerContainer(BaseSchedulerContainer):
     """
@@ -120,6 +338,268 @@ class AsyncQequeSchedulerContainer(BaseSchedulerContainer):
         return self.url_queue.qsize()
 
 
+class DiskSpillSchedulerContainer(BaseSchedulerContainer):
+    """
+    内存 + 磁盘 保存request  先进先出
+    内存中最多保存 memory_size 个请求 超出的序列化后追加写入磁盘分段文件
+    内存中的请求消费完后 按顺序从最早的分段文件读回 读完的分段文件删除
+    带 session 的请求 回调函数无法按名称还原(如 lambda)或无法序列化的请求 始终保存在内存中
+    """
+
+    def __init__(self, memory_size: int = None, spill_dir: str = None, segment_size: int = None):
+        """
+        初始方法
+        :param memory_size: 内存中最多保存的请求数
+        :param spill_dir: 分段文件所在目录的父目录 默认系统临时目录
+        :param segment_size: 每个分段文件保存的请求数
+        """
+        self.memory_size = memory_size or gloable_setting_dict.get("spill_memory_size")
+        self.segment_size = segment_size or gloable_setting_dict.get("spill_segment_size")
+        spill_dir = spill_dir or gloable_setting_dict.get("spill_dir")
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix="smart-spill-", dir=spill_dir)
+        self.url_queue = deque()
+        # 已写完 等待读取的分段文件
+        self.segments = deque()
+        self.segment_seq = itertools.count()
+        self.writer = None
+        self.writer_path = None
+        self.writer_count = 0
+        self.reader = None
+        self.reader_path = None
+        # 磁盘上的请求数
+        self.spilled = 0
+        # 回调函数所属对象(一般是 spider) 磁盘中只保存其 id 和回调函数名
+        self.owners = {}
+        reminder.engin_close.connect(self._on_engin_close)
+
+    def push(self, request: Request):
+        if request.session is not None or (self.spilled <= 0 and len(self.url_queue) < self.memory_size):
+            self.url_queue.append(request)
+            return
+        if not is_restorable_callback(request.callback) or not self._write(request):
+            self.url_queue.append(request)
+
+    def pop(self) -> Optional[Request]:
+        if not self.url_queue and self.spilled > 0:
+            self._read()
+        if self.url_queue:
+            return self.url_queue.popleft()
+        return None
+
+    def size(self) -> int:
+        return len(self.url_queue) + self.spilled
+
+    def close(self):
+        """
+        关闭并删除所有分段文件
+        :return: None
+        """
+        for f in (self.writer, self.reader):
+            if f:
+                f.close()
+        self.writer = self.reader = None
+        self.segments.clear()
+        self.spilled = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _write(self, request: Request) -> bool:
+        owner = getattr(request.callback, "__self__", None)
+        owner_id = None if owner is None else id(owner)
+        try:
+            # 先序列化为 bytes 失败时不会在分段文件中留下半条记录
+            data = pickle.dumps((owner_id, request_to_tuple(request)), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            log.warning(f"can not spill {request.url} to disk: {e}, keep it in memory")
+            return False
+        if owner is not None:
+            self.owners[owner_id] = owner
+        if self.writer is None:
+            self.writer_path = os.path.join(self.directory, f"{next(self.segment_seq):010d}.seg")
+            self.writer = open(self.writer_path, "wb")
+            self.writer_count = 0
+        self.writer.write(data)
+        self.writer_count += 1
+        self.spilled += 1
+        if self.writer_count >= self.segment_size:
+            self._rotate()
+        return True
+
+    def _rotate(self):
+        self.writer.close()
+        self.segments.append(self.writer_path)
+        self.writer = None
+
+    def _read(self):
+        while self.spilled > 0 and len(self.url_queue) < self.memory_size:
+            if self.reader is None:
+                if not self.segments:
+                    # 正在写的分段也需要读取 先关闭它
+                    self._rotate()
+                self.reader_path = self.segments.popleft()
+                self.reader = open(self.reader_path, "rb")
+            try:
+                owner_id, data = pickle.load(self.reader)
+            except EOFError:
+                self.reader.close()
+                os.remove(self.reader_path)
+                self.reader = None
+                continue
+            self.spilled -= 1
+            try:
+                self.url_queue.append(request_from_tuple(data, self.owners.get(owner_id)))
+            except Exception as e:
+                # 无法还原的记录丢弃 不影响后面的请求
+                log.error(f"bad request {data[0]} in spill file: {e}")
+
+    def _on_engin_close(self, sender, **kwargs):
+        scheduler = getattr(sender, "scheduler", None)
+        if scheduler is not None and getattr(scheduler, "scheduler_container", None) is self:
+            self.close()
+
+
+class PrioritySchedulerContainer(BaseSchedulerContainer):
+    """
+    堆 保存request  按 request.priority 从大到小出队 优先级相同的先进先出
+    push/pop 都是 O(log n) 内存紧张时可以让深层页面优先级更高 深度优先消化请求
+    """
+
+    def __init__(self):
+        self.url_queue = []
+        # 入队序号 保证同优先级的稳定顺序 也避免比较 request 本身
+        self.counter = itertools.count()
+
+    def push(self, request: Request):
+        heapq.heappush(self.url_queue, (-request.priority, next(self.counter), request))
+
+    def pop(self) -> Optional[Request]:
+        if self.url_queue:
+            return heapq.heappop(self.url_queue)[2]
+        return None
+
+    def size(self) -> int:
+        return len(self.url_queue)
+
+
+class AsyncPrioritySchedulerContainer(BaseSchedulerContainer):
+    """
+    asyncio.PriorityQueue 保存request  按 request.priority 从大到小出队 优先级相同的先进先出
+    """
+
+    def __init__(self):
+        self.url_queue = asyncio.PriorityQueue()
+        self.counter = itertools.count()
+
+    async def push(self, request: Request):
+        await self.url_queue.put((-request.priority, next(self.counter), request))
+
+    async def pop(self) -> Optional[Request]:
+        res = await self.url_queue.get()
+        self.url_queue.task_done()
+        return res[2]
+
+    def size(self) -> int:
+        return self.url_queue.qsize()
+
+
+class DomainSchedulerContainer(BaseSchedulerContainer):
+    """
+    按 host 分队列保存 request
+    每个 host 单独限制在途请求数和最小请求间隔 出队时在就绪的 host 之间轮询
+    慢 host 不会占用其他 host 的下载机会 吞吐随抓取的域名数增长
+    没有就绪的 host 时 pop 返回 None
+    """
+
+    def __init__(self, domain_concurrency: int = None, domain_delay: float = None):
+        """
+        初始方法
+        :param domain_concurrency: 每个 host 的最大在途请求数 <=0 不限制 为 None 时读取配置
+        :param domain_delay: 同一个 host 两次请求之间的最小间隔 s 为 None 时读取配置
+        """
+        # 没有指定的参数 在 open 时改为爬虫的配置
+        self.unset = {key for key, value in (("domain_concurrency", domain_concurrency),
+                                             ("domain_delay", domain_delay)) if value is None}
+        self.domain_concurrency = gloable_setting_dict.get(
+            "domain_concurrency") if domain_concurrency is None else domain_concurrency
+        self.domain_delay = gloable_setting_dict.get("domain_delay") if domain_delay is None else domain_delay
+        # host -> 该 host 排队中的请求
+        self.queues: Dict[str, deque] = {}
+        # 有排队请求的 host 轮询环
+        self.hosts = deque()
+        # host -> 在途请求数
+        self.working: Dict[str, int] = {}
+        # host -> 下次允许发出请求的时间
+        self.next_times: Dict[str, float] = {}
+        # host -> (在途请求数, 请求间隔) 覆盖全局的 domain_concurrency domain_delay
+        self.limits: Dict[str, tuple] = {}
+        self.total = 0
+
+    def open(self, spider):
+        for key in self.unset:
+            value = spider.cutome_setting_dict.get(key)
+            if value is not None:
+                setattr(self, key, value)
+
+    def push(self, request: Request):
+        host = get_domain(request.url)
+        queue = self.queues.get(host)
+        if queue is None:
+            queue = self.queues[host] = deque()
+            self.hosts.append(host)
+        queue.append(request)
+        self.total += 1
+
+    def pop(self) -> Optional[Request]:
+        now = time.monotonic()
+        for _ in range(len(self.hosts)):
+            host = self.hosts[0]
+            # 当前 host 移到环尾 保证轮询
+            self.hosts.rotate(-1)
+            if not self._is_ready(host, now):
+                continue
+            queue = self.queues[host]
+            request = queue.popleft()
+            if not queue:
+                # 刚被 rotate 到环尾
+                self.hosts.pop()
+                del self.queues[host]
+            self.total -= 1
+            self.working[host] = self.working.get(host, 0) + 1
+            delay = self.limits.get(host, (None, self.domain_delay))[1]
+            if delay > 0:
+                self.next_times[host] = now + delay
+            return request
+        return None
+
+    def release(self, request: Request):
+        host = get_domain(request.url)
+        working = self.working.get(host, 0) - 1
+        if working > 0:
+            self.working[host] = working
+        else:
+            self.working.pop(host, None)
+            if host not in self.queues and self.next_times.get(host, 0) <= time.monotonic():
+                self.next_times.pop(host, None)
+
+    def set_host_limit(self, host: str, concurrency: int, delay: float) -> bool:
+        self.limits[host] = (concurrency, delay)
+        next_time = self.next_times.get(host)
+        if next_time is not None:
+            # 间隔变小时立即生效
+            self.next_times[host] = min(next_time, time.monotonic() + delay)
+        return True
+
+    def size(self) -> int:
+        return self.total
+
+    def _is_ready(self, host: str, now: float) -> bool:
+        concurrency = self.limits.get(host, (self.domain_concurrency,))[0]
+        if 0 < concurrency <= self.working.get(host, 0):
+            return False
+        return self.next_times.get(host, 0) <= now
+
+
 class BaseScheduler(ABC):
     """
     请求调度器基类
@@ -133,6 +613,59 @@ class BaseScheduler(ABC):
     def get(self) -> Optional[Request]:
         pass
 
+    # 请求指纹的字节数 open 时读取爬虫的配置 为 None 时使用全局配置
+    digest_size = None
+
+    def _fingerprint(self, request: Request) -> bytes:
+        """
+        请求指纹 重试次数不同的同一请求指纹不同
+        :param request: 请求
+        :return: bytes
+        """
+        return request_fingerprint(request.url, request.method, request.data, request.retry,
+                                   self.digest_size or fingerprint_digest_size())
+
+    def open(self, spider):
+        """
+        引擎创建调度器后调用 调度器 去重器和调度容器读取爬虫的配置
+        :param spider: 爬虫
+        :return: None
+        """
+        self.digest_size = fingerprint_digest_size(spider)
+        for component in (getattr(self, "duplicate_filter", None), getattr(self, "scheduler_container", None)):
+            if component is not None:
+                component.open(spider)
+
+    def release(self, request: Request):
+        """
+        请求处理结束时调用 通知调度容器释放该请求占用的资源(如 host 的并发名额)
+        :param request: 请求
+        :return: None
+        """
+        container = getattr(self, "scheduler_container", None)
+        if container is not None:
+            container.release(request)
+
+    def ack(self, request: Request):
+        """
+        请求的回调处理结束时调用 通知调度容器确认该请求
+        :param request: 请求
+        :return: None
+        """
+        container = getattr(self, "scheduler_container", None)
+        if container is not None:
+            container.ack(request)
+
+    async def wait_closed(self):
+        """
+        等待调度容器和去重器的关闭清理完成 事件循环结束前调用
+        :return: None
+        """
+        for component in (getattr(self, "scheduler_container", None), getattr(self, "duplicate_filter", None)):
+            wait_closed = getattr(component, "wait_closed", None)
+            if wait_closed is not None:
+                await wait_closed()
+
 
 class Scheduler(BaseScheduler):
     """
@@ -160,11 +693,15 @@ class Scheduler(BaseScheduler):
         # dont_filter=true的请求不过滤
         if not request.dont_filter:
             # retry 失败的 重试实现延迟调度
-            _url = request.url + ":" + str(request.retry)
-            if self.duplicate_filter.contains(_url):
-                self.log.debug(f"duplicate_filter filted ... url {_url} ")
+            fingerprint = self._fingerprint(request)
+            added = self.duplicate_filter.add_if_absent(fingerprint)
+            if added is None:
+                added = not self.duplicate_filter.contains(fingerprint)
+                if added:
+                    self.duplicate_filter.add(fingerprint)
+            if not added:
+                self.log.debug(f"duplicate_filter filted ... url {request.url} ")
                 return False
-            self.duplicate_filter.add(_url)
         push = self.scheduler_container.push(request)
         if inspect.isawaitable(push):
             asyncio.create_task(push)
@@ -214,16 +751,22 @@ class AsyncScheduler(BaseScheduler):
         # dont_filter=true的请求不过滤
         if not request.dont_filter:
             # retry 失败的 重试实现延迟调度
-            _url = request.url + ":" + str(request.retry)
-            contains = self.duplicate_filter.contains(_url)
-            if inspect.isawaitable(contains):
-                contains = await contains
-            if contains:
-                self.log.debug(f"duplicate_filter filted ... url{_url} ")
+            fingerprint = self._fingerprint(request)
+            added = self.duplicate_filter.add_if_absent(fingerprint)
+            if inspect.isawaitable(added):
+                added = await added
+            if added is None:
+                contains = self.duplicate_filter.contains(fingerprint)
+                if inspect.isawaitable(contains):
+                    contains = await contains
+                added = not contains
+                if added:
+                    filter_add = self.duplicate_filter.add(fingerprint)
+                    if inspect.isawaitable(filter_add):
+                        await filter_add
+            if not added:
+                self.log.debug(f"duplicate_filter filted ... url{request.url} ")
                 return False
-            filter_add = self.duplicate_filter.add(_url)
-            if inspect.isawaitable(filter_add):
-                await filter_add
 
         push = self.scheduler_container.push(request)
         if inspect.isawaitable(push):
@@ -0,0 +1,290 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      serialize
+# Author:    liangbaikai
+# Date:      2021/1/27
+# Desc:      request serialize, callback is referenced by name
+# ------------------------------------------------------------------
+import importlib
+import marshal
+import operator
+import struct
+from typing import Any, Callable, Optional
+
+from smart.request import Request
+
+
+def callback_to_name(callback: Optional[Callable]) -> Optional[str]:
+    """
+    回调函数转为名称  绑定方法(如 spider.parse)只保留方法名 普通函数保存为 module:qualname
+    :param callback: 回调函数
+    :return: str
+    """
+    if callback is None:
+        return None
+    if isinstance(callback, str):
+        return callback
+    if getattr(callback, "__self__", None) is not None:
+        return callback.__name__
+    return f"{callback.__module__}:{callback.__qualname__}"
+
+
+def is_owner_callback_name(name: Optional[str], owner: Any) -> bool:
+    """
+    回调函数名称是否是 owner 的方法名 或 owner 所在模块中的 module:qualname
+    :param name: callback_to_name 的结果
+    :param owner: 回调函数所属对象
+    :return: bool
+    """
+    if name is None or ":" not in name:
+        return True
+    return owner is not None and name.split(":", 1)[0] == type(owner).__module__
+
+
+def name_to_callback(name: Optional[str], owner: Any = None, safe: bool = False) -> Optional[Callable]:
+    """
+    名称还原为回调函数 方法名从 owner(一般是 spider) 上获取
+    :param name: callback_to_name 的结果
+    :param owner: 回调函数所属对象
+    :param safe: 名称来自 redis 等外部数据时为 True module:qualname 只允许 owner 所在的模块 避免导入任意模块
+    :return: Callable
+    """
+    if name is None:
+        return None
+    if ":" in name:
+        if safe and not is_owner_callback_name(name, owner):
+            raise ValueError(f"callback {name} is not in the module of {type(owner).__name__}")
+        module_name, qualname = name.split(":", 1)
+        target = importlib.import_module(module_name)
+        for attr in qualname.split("."):
+            target = getattr(target, attr)
+        return target
+    if owner is None:
+        raise ValueError(f"can not find the owner of callback {name}")
+    return getattr(owner, name)
+
+
+def is_restorable_callback(callback: Optional[Callable]) -> bool:
+    """
+    回调函数能否按 callback_to_name 的名称还原 lambda 嵌套函数 functools.partial 等不能
+    :param callback: 回调函数
+    :return: bool
+    """
+    if callback is None or isinstance(callback, str):
+        return True
+    try:
+        return name_to_callback(callback_to_name(callback), getattr(callback, "__self__", None)) == callback
+    except Exception:
+        return False
+
+
+def request_to_tuple(request: Request) -> tuple:
+    """
+    request 转为只包含基础类型的 tuple  session 无法序列化会被丢弃
+    :param request: 请求
+    :return: tuple
+    """
+    return (request.url, callback_to_name(request.callback), request.method, request.timeout,
+            request.encoding, request.header, request.cookies, request.data, request.extras,
+            request.meta, request.dont_filter, request.priority, request.retry, request.stream)
+
+
+def request_from_tuple(data: tuple, owner: Any = None) -> Request:
+    """
+    request_to_tuple 的逆操作
+    :param data: tuple
+    :param owner: 回调函数所属对象
+    :return: Request
+    """
+    (url, callback, method, timeout, encoding, header, cookies, post_data, extras,
+     meta, dont_filter, priority, retry) = data[:13]
+    # 兼容没有 stream 字段的旧数据
+    stream = data[13] if len(data) > 13 else False
+    return Request(url, callback=name_to_callback(callback, owner), method=method, timeout=timeout,
+                   encoding=encoding, header=header, cookies=cookies, data=post_data, extras=extras,
+                   meta=meta, dont_filter=dont_filter, priority=priority, stream=stream, _retry=retry)
+
+
+# 请求的二进制格式
+# 魔数 版本号 后跟 marshal 编码的 tuple: (url, 字段位图, 位图中每个字段的值) 等于默认值的字段不写入
+# marshal 是 C 实现 编解码都比 pickle 快 体积也比 pickle 小 但不能防御恶意数据 redis 中的数据必须可信
+# 值只支持 None bool int float str bytes list tuple dict 内置类型的子类会先转为内置类型
+# 格式变化时增加 WIRE_VERSION 并保留旧版本的解析
+WIRE_MAGIC = 0xA5
+WIRE_VERSION = 2
+# marshal 的格式版本 固定下来避免不同 python 版本写出不同的数据
+MARSHAL_VERSION = 4
+# (字段名, 默认值) 顺序即位图中的位 只能在末尾追加
+WIRE_FIELDS = (("callback", None), ("method", "get"), ("timeout", None), ("encoding", None),
+               ("header", None), ("cookies", None), ("data", None), ("extras", None), ("meta", None),
+               ("dont_filter", False), ("priority", 0), ("_retry", 0), ("stream", False))
+
+_WIRE_GETTER = operator.attrgetter(*(name for name, _ in WIRE_FIELDS))
+_WIRE_DEFAULTS = tuple(default for _, default in WIRE_FIELDS)
+
+_HEAD = struct.Struct("<BB")
+_UINT16 = struct.Struct("<H")
+_UINT32 = struct.Struct("<I")
+_INT64 = struct.Struct("<q")
+_DOUBLE = struct.Struct("<d")
+
+
+def _to_plain(value: Any) -> Any:
+    # marshal 只接受内置类型本身 OrderedDict IntEnum 等子类转为对应的内置类型
+    if value is None or type(value) in (bool, str, bytes, int, float):
+        return value
+    if isinstance(value, dict):
+        return {_to_plain(key): _to_plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [_to_plain(item) for item in value]
+        return tuple(items) if isinstance(value, tuple) else items
+    if isinstance(value, str):
+        return str.__str__(value)
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    raise TypeError(f"can not serialize {type(value).__name__} in request")
+
+
+# 以下是版本 1 的解析 版本 1 中每个值由一个类型字节和数据组成
+def _unpack_size(data: bytes, pos: int):
+    size = data[pos]
+    if size < 0xFF:
+        return size, pos + 1
+    return _UINT32.unpack_from(data, pos + 1)[0], pos + 5
+
+
+def _unpack_str(data: bytes, pos: int):
+    size, pos = _unpack_size(data, pos)
+    return data[pos:pos + size].decode("utf-8"), pos + size
+
+
+def _unpack_bytes(data: bytes, pos: int):
+    size, pos = _unpack_size(data, pos)
+    return data[pos:pos + size], pos + size
+
+
+def _unpack_int(data: bytes, pos: int):
+    return _INT64.unpack_from(data, pos)[0], pos + 8
+
+
+def _unpack_big_int(data: bytes, pos: int):
+    size, pos = _unpack_size(data, pos)
+    return int.from_bytes(data[pos:pos + size], "little", signed=True), pos + size
+
+
+def _unpack_float(data: bytes, pos: int):
+    return _DOUBLE.unpack_from(data, pos)[0], pos + 8
+
+
+def _unpack_dict(data: bytes, pos: int):
+    size, pos = _unpack_size(data, pos)
+    value = {}
+    for _ in range(size):
+        key, pos = _unpack_value(data, pos)
+        value[key], pos = _unpack_value(data, pos)
+    return value, pos
+
+
+def _unpack_list(data: bytes, pos: int):
+    size, pos = _unpack_size(data, pos)
+    value = []
+    for _ in range(size):
+        item, pos = _unpack_value(data, pos)
+        value.append(item)
+    return value, pos
+
+
+def _unpack_tuple(data: bytes, pos: int):
+    value, pos = _unpack_list(data, pos)
+    return tuple(value), pos
+
+
+_UNPACKERS = {0x73: _unpack_str, 0x62: _unpack_bytes, 0x69: _unpack_int, 0x49: _unpack_big_int,
+              0x64: _unpack_float, 0x6D: _unpack_dict, 0x6C: _unpack_list, 0x74: _unpack_tuple,
+              0x4E: lambda data, pos: (None, pos), 0x54: lambda data, pos: (True, pos),
+              0x46: lambda data, pos: (False, pos)}
+
+
+def _unpack_value(data: bytes, pos: int):
+    unpacker = _UNPACKERS.get(data[pos])
+    if unpacker is None:
+        raise ValueError(f"unknown type {data[pos]} in serialized request")
+    return unpacker(data, pos + 1)
+
+
+def dumps_request(request: Request) -> bytes:
+    """
+    序列化 request 为紧凑的二进制格式 回调函数只保存名称 session 不会被序列化
+    header meta 等只能包含 None bool int float str bytes list tuple dict 否则抛出 TypeError
+    :param request: 请求
+    :return: bytes
+    """
+    values = _WIRE_GETTER(request)
+    fields = [request.url, 0]
+    bitmap = 0
+    if values[0] is not None:
+        bitmap = 1
+        fields.append(callback_to_name(values[0]))
+    for bit in range(1, len(values)):
+        value = values[bit]
+        if value != _WIRE_DEFAULTS[bit]:
+            bitmap |= 1 << bit
+            fields.append(value)
+    fields[1] = bitmap
+    try:
+        body = marshal.dumps(tuple(fields), MARSHAL_VERSION)
+    except ValueError:
+        body = marshal.dumps(_to_plain(tuple(fields)), MARSHAL_VERSION)
+    return _HEAD.pack(WIRE_MAGIC, WIRE_VERSION) + body
+
+
+def _loads_v1(data: bytes):
+    url, pos = _unpack_value(data, _HEAD.size)
+    bitmap = _UINT16.unpack_from(data, pos)[0]
+    pos += _UINT16.size
+    fields = [url, bitmap]
+    for bit in range(len(WIRE_FIELDS)):
+        if bitmap >> bit & 1:
+            value, pos = _unpack_value(data, pos)
+            fields.append(value)
+    return fields
+
+
+def loads_request(data: bytes, owner: Any = None) -> Request:
+    """
+    反序列化 request
+    module:qualname 形式的回调函数只从 owner 所在的模块获取 不会导入数据中的任意模块
+    没有 owner 时回调函数保留为字符串 由引擎在处理请求时从 spider 上获取
+    :param data: dumps_request 的结果
+    :param owner: 回调函数所属对象
+    :return: Request
+    """
+    magic, version = _HEAD.unpack_from(data, 0)
+    if magic != WIRE_MAGIC:
+        raise ValueError("data is not a serialized request")
+    if version > WIRE_VERSION:
+        raise ValueError(f"unsupported request wire version {version}, upgrade smart-spider")
+    if version == 1:
+        fields = _loads_v1(data)
+    else:
+        try:
+            fields = marshal.loads(memoryview(data)[_HEAD.size:])
+        except (EOFError, TypeError) as e:
+            raise ValueError(f"bad serialized request: {e}")
+        if type(fields) is not tuple or len(fields) < 2:
+            raise ValueError("bad serialized request")
+    url, bitmap = fields[0], fields[1]
+    kwargs = {}
+    index = 2
+    for bit, (name, _) in enumerate(WIRE_FIELDS):
+        if bitmap >> bit & 1:
+            kwargs[name] = fields[index]
+            index += 1
+    callback = kwargs.get("callback")
+    if callback is not None and owner is not None:
+        kwargs["callback"] = name_to_callback(callback, owner, safe=True)
+    return Request(url, **kwargs)
@@ -13,6 +13,12 @@ gloable_setting_dict = {
     "req_timeout": 10,
     # 每个爬虫的请求并发数
     "req_per_concurrent": 200,
+    # 引擎常驻 worker 数 每个 worker 独立地 出队->下载->处理回调  为 None 时与 req_per_concurrent 相同
+    "worker_num": None,
+    # 待抓取请求数上限 达到上限时回调的迭代会挂起 直到有请求被下载  0 不限制
+    "request_queue_maxsize": 0,
+    # 待抓取请求已满时 转到后台继续迭代的回调数上限 worker 不必等待它们 为 None 时与 worker_num 相同
+    "producer_num": None,
     # 每个请求的最大重试次数
     "req_max_retry": 3,
     # 默认请求头
@@ -21,25 +27,136 @@ gloable_setting_dict = {
         # 百度搜索引擎爬虫ua
         "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0.3865.120 Safari/537.36"
     },
+    # 请求指纹的字节数 8 或 16  8 字节更省内存 但十亿级 url 时有碰撞的可能
+    "fingerprint_digest_size": 16,
     # 请求url 去重处理器
     # 自己实现需要继承 BaseDuplicateFilter 实现相关抽象方法 系统默认SampleDuplicateFilter
     "duplicate_filter_class": "smart.scheduler.SampleDuplicateFilter",
+    # 以下为布隆过滤器去重器 smart.scheduler.BloomDuplicateFilter 的配置
+    # 初始容量 写满后自动扩容
+    "bloom_filter_capacity": 1000000,
+    # 误判率
+    "bloom_filter_error_rate": 0.0001,
+    # 持久化文件路径 文件存在时启动时加载
+    "bloom_filter_path": None,
     # 请求url调度器容器
     # 自己实现需要继承 BaseSchedulerContainer 实现相关抽象方法  系统默认DequeSchedulerContainer
     "scheduler_container_class": "smart.scheduler.DequeSchedulerContainer",
+    # 以下为按域名调度容器 smart.scheduler.DomainSchedulerContainer 的配置
+    # 每个 host 的最大在途请求数 <=0 不限制
+    "domain_concurrency": 8,
+    # 同一个 host 两次请求之间的最小间隔 s
+    "domain_delay": 0,
+    # 以下为磁盘溢出调度容器 smart.scheduler.DiskSpillSchedulerContainer 的配置
+    # 内存中最多保存的请求数 超出的写入磁盘
+    "spill_memory_size": 100000,
+    # 每个磁盘分段文件保存的请求数
+    "spill_segment_size": 100000,
+    # 分段文件目录 默认系统临时目录
+    "spill_dir": None,
+    # spiders.distributed 中 redis 去重器和调度容器的地址 同一个引擎的 aioredis 去重器和调度容器共享连接池
+    "redis_url": "redis://127.0.0.1:6379/0",
+    # aioredis 连接池的最大连接数
+    "redis_pool_max_size": 10,
+    # 以下为 redis 调度容器 spiders.distributed.RedisSchuler 的配置
+    # 本地预取的最大请求数 为 None 时与 req_per_concurrent 相同
+    "redis_prefetch_size": None,
+    # 每次 RPUSH/LPOP 的最大请求数 aioredis 去重器每个 pipeline 的最大指纹数
+    "redis_batch_size": 500,
+    # 队列为空时 BLPOP 的阻塞时间 s
+    "redis_block_timeout": 1,
+    # 以下为 redis 布隆过滤器去重器 spiders.distributed.RedisBloomDuplicateFilter 的配置
+    # 所有节点必须使用相同的配置 占用 redis 内存约 -容量*ln(误判率)/(ln2)^2 bit
+    # 容量 超过后误判率升高
+    "redis_bloom_capacity": 100000000,
+    "redis_bloom_error_rate": 0.0001,
+    # 位图 key 的个数 每个 key 最大 512MB 容量大时自动增加
+    "redis_bloom_shards": 8,
+    # 以下为至少一次的 redis 调度容器 spiders.distributed.RedisLeaseSchuler 的配置
+    # 节点租约时间 s 超过这个时间没有续租的节点 它正在处理的请求会被其他节点放回队列
+    "redis_lease_timeout": 30,
     # 调度器
     "scheduler_class": "smart.scheduler.Scheduler",
     # 请求网络的方法  输入 request  输出 response
     # 自己实现需要继承 BaseDown 实现相关抽象方法  系统默认AioHttpDown
     "net_download_class": "smart.downloader.AioHttpDown",
+    # 以下为连接池下载器 smart.downloader.AioHttpPoolDown 的配置
+    # 连接池总连接数 0 不限制
+    "pool_limit": 500,
+    # 单个 host 的最大连接数 0 不限制
+    "pool_limit_per_host": 0,
+    # 空闲连接保持时间 s
+    "pool_keepalive_timeout": 30,
+    # dns 缓存时间 s
+    "pool_dns_cache_ttl": 300,
+    # 以下为缓存下载器 smart.httpcache.HttpCacheDown 的配置
+    # 实际下载的下载器
+    "http_cache_downer_class": "smart.downloader.AioHttpPoolDown",
+    # 缓存目录
+    "http_cache_dir": ".http_cache",
+    # 缓存保存后多少秒内直接使用 超过后用 ETag/Last-Modified 重新验证
+    "http_cache_max_age": 3600,
+    # 缓存最长保存时间 s 超过后删除  0 不限制
+    "http_cache_expire": 7 * 24 * 3600,
+    # 缓存最大字节数 超过后淘汰最久没有访问的响应  0 不限制
+    "http_cache_max_size": 1024 * 1024 * 1024,
+    # 响应体最大字节数 超过时丢弃该请求  None 不限制
+    "max_body_size": None,
+    # 流式下载(request.stream)时 响应体超过此字节数写入临时文件
+    "stream_spool_size": 1024 * 1024,
+    # 分块读取响应体的块大小
+    "stream_chunk_size": 64 * 1024,
     # 线程池数  当 middwire pipline 有不少耗时的同步方法时 适当调大
     "thread_pool_max_size": 250,
+    # 进程池数 默认 cpu 核数  用于 smart.process.run_in_process 标记的 cpu 密集的 pipline 和回调
+    "process_pool_max_size": None,
+    # CrawStater.run_multiprocess 的进程数 默认 cpu 核数
+    "shard_process_num": None,
+    # 以下状态码的响应延迟重试 达到最大重试次数后丢弃
+    # 默认不包含 ignore_response_codes 中的 500 502 504 这些响应仍然直接忽略 需要重试时加入这里
+    "retry_http_codes": [408, 429, 503],
+    # 以下异常延迟重试 类的全路径
+    "retry_exceptions": ["asyncio.TimeoutError", "concurrent.futures.TimeoutError", "aiohttp.ClientError",
+                         "builtins.ConnectionError"],
+    # 第 n 次重试等待 retry_backoff_base * 2^(n-1) s 不超过 retry_backoff_max
+    "retry_backoff_base": 1,
+    "retry_backoff_max": 60,
+    # 重试等待时间的随机抖动比例 0-1
+    "retry_jitter": 0.5,
+    # 同一个 host 连续失败多少次后熔断  0 不熔断
+    "circuit_breaker_threshold": 10,
+    # 熔断时间 s
+    "circuit_breaker_cooldown": 30,
+    # 自动限速 按每个 host 的响应时间和错误率调整该 host 的并发数和请求间隔
+    # 需要配合按 host 限流的 smart.scheduler.DomainSchedulerContainer 使用
+    "autothrottle_enabled": False,
+    # 目标响应时间 s 低于此值时逐步增加并发 高于时降低
+    "autothrottle_target_latency": 1.0,
+    # 每个 host 的初始并发数
+    "autothrottle_start_concurrency": 4,
+    "autothrottle_min_concurrency": 1,
+    "autothrottle_max_concurrency": 32,
+    # 最大请求间隔 s
+    "autothrottle_max_delay": 10,
+    # 降速时并发数乘以此系数
+    "autothrottle_decrease": 0.5,
+    # 以下状态码视为目标站点过载
+    "autothrottle_error_codes": [429, 500, 502, 503, 504],
     # 根据响应的状态码 忽略以下响应
     "ignore_response_codes": [401, 403, 404, 405, 500, 502, 504],
     # 是否是分布式爬虫
     "is_single": 1,
     # pipline之间 处理item 是否并行处理 默认  0 串行   1 并行
     "pipline_is_paralleled": 1,
+    # 待处理 item 数上限 满了之后产生 item 的回调会挂起等待  0 不限制
+    "item_queue_maxsize": 1000,
+    # 处理 item 的常驻 task 数
+    "pipline_worker_num": 10,
+    # 检查点目录 为 None 时不保存检查点 每个爬虫保存在以爬虫名命名的子目录中(需要固定爬虫名)
+    # CrawStater.run_*(resume=True) 时从最新的检查点恢复
+    "checkpoint_dir": None,
+    # 检查点保存间隔 s
+    "checkpoint_interval": 60,
     # 启动时网络是否畅通检查地址
     "net_healthy_check_url": "https://www.baidu.com",
     # log level
@@ -0,0 +1,175 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      shard
+# Author:    liangbaikai
+# Date:      2021/1/30
+# Desc:      shard one spider across processes by host
+# ------------------------------------------------------------------
+import asyncio
+import os
+import queue
+import zlib
+from collections import Counter
+
+from smart.checkpoint import Checkpoint
+from smart.core9 import Engine
+from smart.item import Item
+from smart.request import Request
+from smart.serialize import request_to_tuple, request_from_tuple
+from smart.setting import gloable_setting_dict
+from smart.tool import get_domain
+
+
+def shard_of(url: str, shard_num: int) -> int:
+    """
+    按 host 计算请求所属的分片 同一个 host 的请求始终在同一个进程 按 host 的限流依然有效
+    :param url: 请求地址
+    :param shard_num: 分片数
+    :return: 分片序号
+    """
+    host = get_domain(url) or ""
+    return zlib.crc32(host.lower().encode("utf-8")) % shard_num
+
+
+class ShardContext:
+    """
+    多进程共享的状态 在主进程创建 传给每个分片进程
+    每个分片有一个收件队列 其他分片发现的属于它的请求通过队列发送
+    请求只在所属分片去重 分片自己的去重器就是全局去重 不需要 redis 也不需要跨进程加锁
+    结束判断: 所有分片都空闲 且没有还在队列中的请求
+    """
+
+    def __init__(self, shard_num: int, mp_context):
+        """
+        初始方法
+        :param shard_num: 分片数
+        :param mp_context: multiprocessing 上下文
+        """
+        self.shard_num = shard_num
+        self.inboxes = [mp_context.Queue() for _ in range(shard_num)]
+        # 每个分片是否空闲 只有分片自己会修改
+        self.idle = mp_context.RawArray("b", shard_num)
+        # 已发送 还没有被所属分片放入调度器的请求数
+        self.pending = mp_context.RawValue("q", 0)
+        self.lock = mp_context.Lock()
+        self.done = mp_context.Event()
+        # 各分片结束后发送统计数据
+        self.results = mp_context.Queue()
+
+    def send(self, shard: int, request: Request):
+        with self.lock:
+            self.pending.value += 1
+        # 队列本身会序列化 回调函数只保存名称
+        self.inboxes[shard].put(request_to_tuple(request))
+
+    def receive(self, shard: int, timeout: float):
+        """
+        取一个发给该分片的请求 收到后分片不再空闲 放入调度器后需要调用 received
+        :param shard: 分片序号
+        :param timeout: 超时 s
+        :return: request_to_tuple 的结果 超时返回 None
+        """
+        try:
+            data = self.inboxes[shard].get(True, timeout)
+        except queue.Empty:
+            return None
+        # 先于 received 标记忙碌 否则其他分片可能在请求入队前看到全部空闲
+        self.idle[shard] = 0
+        return data
+
+    def received(self):
+        with self.lock:
+            self.pending.value -= 1
+
+    def busy(self, shard: int):
+        self.idle[shard] = 0
+
+    def is_done(self, shard: int) -> bool:
+        """
+        标记该分片空闲 并判断整个爬取是否结束
+        :param shard: 分片序号
+        :return: bool
+        """
+        self.idle[shard] = 1
+        with self.lock:
+            if self.pending.value == 0 and all(self.idle):
+                self.done.set()
+        return self.done.is_set()
+
+
+class ShardEngine(Engine):
+    """
+    分片进程中的引擎 只抓取属于本分片的 host 其他 host 的请求发送给所属分片
+    """
+
+    def __init__(self, spider, middlewire=None, pipline=None, context: ShardContext = None, shard: int = 0):
+        super().__init__(spider, middlewire, pipline)
+        self.context = context
+        self.shard = shard
+        self.stats = Counter()
+        if self.checkpoint:
+            # 每个分片单独保存检查点 发送中的请求不在检查点中
+            self.checkpoint = Checkpoint(os.path.join(self.checkpoint.directory, f"shard-{shard}"),
+                                         self.spider, self.scheduler)
+
+    def _shard_of(self, request: Request) -> int:
+        return shard_of(request.url, self.context.shard_num)
+
+    async def process_start_urls(self):
+        # 每个分片都会生成 start_urls 只保留属于自己的 避免重复发送
+        async for request in super().process_start_urls():
+            if self._shard_of(request) == self.shard:
+                yield request
+
+    async def _schedule_request(self, request: Request):
+        shard = self._shard_of(request)
+        if shard == self.shard:
+            self.stats["requests_local"] += 1
+            await super()._schedule_request(request)
+        else:
+            self.stats["requests_sent"] += 1
+            self.context.send(shard, request)
+
+    async def _receive(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await loop.run_in_executor(None, self.context.receive, self.shard, 0.1)
+            if data is None:
+                continue
+            try:
+                self.stats["requests_received"] += 1
+                await super()._schedule_request(request_from_tuple(data, self.spider))
+            except Exception as e:
+                self.log.error(f"shard {self.shard} receive a bad request: {e}", exc_info=True)
+            finally:
+                self.context.received()
+
+    async def _is_idle(self) -> bool:
+        if not await super()._is_idle():
+            self.context.busy(self.shard)
+            return False
+        return self.context.is_done(self.shard)
+
+    async def handle_request(self, request: Request):
+        result = await super().handle_request(request)
+        if result and result[1] is not None:
+            self.stats["responses"] += 1
+        return result
+
+    async def _hand_piplines(self, item: Item):
+        self.stats["items"] += 1
+        await super()._hand_piplines(item)
+
+    async def start(self):
+        receiver = asyncio.ensure_future(self._receive())
+        try:
+            await super().start()
+        finally:
+            receiver.cancel()
+            await asyncio.gather(receiver, return_exceptions=True)
+        self.stats["unique_requests"] = self.scheduler.duplicate_filter.length()
+        self.context.results.put((self.shard, dict(self.stats)))
+
+
+def default_shard_num() -> int:
+    return gloable_setting_dict.get("shard_process_num") or os.cpu_count() or 1
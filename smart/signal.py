@@ -33,6 +33,8 @@ class _Reminder:
     response_downloaded = Signal("response_downloaded")
     # item 丢弃的时候调用
     item_dropped = Signal("item_dropped")
+    # 自动限速调整某个 host 的并发数和请求间隔的时候调用
+    autothrottle_adjusted = Signal("autothrottle_adjusted")
 
     def __init__(self, *args, **kwargs):
         pass
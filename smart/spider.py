@@ -53,12 +53,18 @@ class Spider(SpiderHook):
         "piplines_instance": None,
         # 请求url 去重处理器
         # 自己实现需要继承 BaseDuplicateFilter 实现相关抽象方法 系统默认 smart.scheduler.SampleDuplicateFilter
+        # 海量 url 可使用内存占用固定的 smart.scheduler.BloomDuplicateFilter
         "duplicate_filter_class": None,
         # 请求url调度器容器
         # 自己实现需要继承 BaseSchedulerContainer 实现相关抽象方法  系统默认smart.scheduler.DequeSchedulerContainer
+        # 多域名抓取可使用按 host 限流轮询的 smart.scheduler.DomainSchedulerContainer
+        # 需要 request.priority 生效时使用 smart.scheduler.PrioritySchedulerContainer
+        # 待抓取请求超出内存时使用 smart.scheduler.DiskSpillSchedulerContainer
         "scheduler_container_class": None,
         # 请求网络的方法  输入 request  输出 response
         # 自己实现需要继承 BaseDown 实现相关抽象方法  系统默认 smart.downloader.AioHttpDown
+        # 高并发场景可使用连接池下载器 smart.downloader.AioHttpPoolDown
+        # 重复抓取时可使用带本地缓存的 smart.httpcache.HttpCacheDown
         "net_download_class": None,
     }
 
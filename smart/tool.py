@@ -5,10 +5,14 @@
 # Date:      2020/12/21
 # Desc:      there is a  utils module
 # ------------------------------------------------------------------
+import dataclasses
 import hashlib
 import re
 import socket
 import urllib
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from smart.setting import gloable_setting_dict
 
 # 验证Url 是否合法的正则
 
@@ -38,6 +42,83 @@ def get_domain(url):
     return domain
 
 
+# 各协议的默认端口 规范化 url 时去掉
+DEFAULT_PORTS = {"http": 80, "https": 443, "ftp": 21, "ws": 80, "wss": 443}
+
+
+def canonicalize_url(url: str) -> str:
+    """
+    规范化 url  scheme 和 host 转小写 去掉默认端口和 fragment  query 参数按 key 排序
+    :param url: url
+    :return: str
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and DEFAULT_PORTS.get(scheme) != port:
+        netloc = f"{netloc}:{port}"
+    if parts.username:
+        userinfo = parts.username if parts.password is None else f"{parts.username}:{parts.password}"
+        netloc = f"{userinfo}@{netloc}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+def request_fingerprint(url: str, method: str = "get", data=None, retry: int = 0, digest_size: int = 16) -> bytes:
+    """
+    请求指纹 由规范化后的 url, 请求方法, 请求体(和重试次数)计算出的定长二进制摘要
+    比 md5 的 32 位 hex 字符串更省内存 也可以直接作为 redis 的值
+    :param url: 请求地址
+    :param method: 请求方法
+    :param data: 请求体 str bytes 或 dict
+    :param retry: 已重试次数 不同重试次数的同一请求指纹不同
+    :param digest_size: 摘要字节数 8 或 16
+    :return: bytes
+    """
+    h = hashlib.blake2b(digest_size=digest_size)
+    h.update((method or "get").upper().encode())
+    h.update(b" ")
+    h.update(canonicalize_url(url).encode("utf-8"))
+    if data:
+        if isinstance(data, dict):
+            data = urlencode(sorted((str(k), str(v)) for k, v in data.items()))
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        elif not isinstance(data, (bytes, bytearray)):
+            data = str(data).encode("utf-8")
+        h.update(b"\n")
+        h.update(data)
+    if retry:
+        h.update(b"#%d" % retry)
+    return h.digest()
+
+
+def fingerprint_digest_size(spider=None) -> int:
+    """
+    请求指纹的字节数 爬虫的配置优先于全局配置
+    :param spider: 爬虫 为 None 时只读取全局配置
+    :return: int
+    """
+    value = (getattr(spider, "cutome_setting_dict", None) or {}).get("fingerprint_digest_size")
+    return gloable_setting_dict.get("fingerprint_digest_size") if value is None else value
+
+
+def to_fingerprint(value, digest_size: int = None) -> bytes:
+    """
+    去重器的值统一转为指纹  已经是指纹(bytes)的直接返回 其他的当作 url 计算指纹
+    :param value: bytes 或 url
+    :param digest_size: 指纹字节数 为 None 时使用全局配置
+    :return: bytes
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    return request_fingerprint(str(value), digest_size=digest_size or fingerprint_digest_size())
+
+
 def get_index_url(url):
     """
     获取 主页地址
@@ -112,3 +193,25 @@ def mutations_bkdr_hash(value: str):
     # return h & 0x7FFFFFFF
 
 
+def dataclass_slots(*extra_slots: str):
+    """
+    给 dataclass 加上 __slots__ 对象不再有 __dict__  大量请求排队时内存占用更少
+    需要放在 @dataclass 之上  python3.10 以下 dataclass 不支持 slots=True
+    字段的默认值保存在 dataclass 生成的 __init__ 中 这里从类属性中删除 否则和 slots 冲突
+    :param extra_slots: 字段以外需要的属性 如 InitVar 字段 框架设置的属性
+    :return: 装饰器
+    """
+
+    def wrap(cls):
+        field_names = tuple(field.name for field in dataclasses.fields(cls))
+        cls_dict = dict(cls.__dict__)
+        cls_dict["__slots__"] = field_names + tuple(extra_slots)
+        for name in field_names:
+            cls_dict.pop(name, None)
+        cls_dict.pop("__dict__", None)
+        cls_dict.pop("__weakref__", None)
+        new_cls = type(cls)(cls.__name__, cls.__bases__, cls_dict)
+        new_cls.__qualname__ = cls.__qualname__
+        return new_cls
+
+    return wrap
@@ -13,6 +13,7 @@
 import traceback
 import aiomysql
 import pymysql
+from pymysql.converters import escape_item
 
 version = "0.3"
 version_info = (0, 3, 0, 0)
@@ -45,6 +46,7 @@ class SanicDB:
             'autocommit': autocommit,
             'pool_recycle': pool_recycle,
         }
+        self.charset = charset
         self.sanic = sanic
         if sanic:
             sanic.db = self
@@ -127,6 +129,67 @@ class SanicDB:
                     await cur.execute(query, kwparameters or parameters)
                 return cur.lastrowid
 
+    async def execute_many_sql(self, sqls, row_sql=None):
+        """Executes (query, parameters) pairs on one connection, returning the total affected rows.
+        row_sql: when given, a query failed by duplicate key(1062) is executed again row by row
+        with it and the duplicated rows are skipped."""
+        if not self.pool:
+            await self.init_pool()
+
+        async def execute(cur, conn, query, parameters):
+            try:
+                await cur.execute(query, parameters)
+            except pymysql.err.OperationalError as e:
+                # https://github.com/aio-libs/aiomysql/issues/340
+                if e.args[0] not in (2006, 2013):
+                    raise
+                await conn.ping()
+                await cur.execute(query, parameters)
+            return cur.rowcount
+
+        rowcount = 0
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                for query, parameters in sqls:
+                    try:
+                        rowcount += await execute(cur, conn, query, parameters)
+                    except pymysql.err.IntegrityError as e:
+                        if row_sql is None or e.args[0] != 1062:
+                            raise
+                        # the failed statement inserted nothing
+                        width = row_sql.count('%s')
+                        for i in range(0, len(parameters), width):
+                            try:
+                                rowcount += await execute(cur, conn, row_sql, parameters[i:i + width])
+                            except pymysql.err.IntegrityError as e:
+                                if e.args[0] != 1062:
+                                    raise
+        return rowcount
+
+    def _split_values(self, head, items, tail='', max_packet_size=4 * 1024 * 1024):
+        """Yields multi-VALUES (query, parameters) whose escaped size stay under max_packet_size."""
+        items = list(items)
+        if not items:
+            return
+        fields = list(items[0].keys())
+        valstr = '(%s)' % ','.join(['%s'] * len(fields))
+        head = head % ','.join(fields)
+        base_size = len(head.encode()) + len(tail.encode()) + len(' VALUES ')
+        rows, parameters, size = 0, [], base_size
+        for item in items:
+            if len(item) != len(fields) or any(field not in item for field in fields):
+                raise ValueError('all items must have the same fields: %s' % fields)
+            values = [item[field] for field in fields]
+            row_size = 2 + len(values) + sum(
+                len(escape_item(value, self.charset).encode()) for value in values)
+            if rows and size + row_size > max_packet_size:
+                yield '%s VALUES %s%s' % (head, ','.join([valstr] * rows), tail), parameters
+                rows, parameters, size = 0, [], base_size
+            rows += 1
+            parameters.extend(values)
+            size += row_size
+        yield '%s VALUES %s%s' % (head, ','.join([valstr] * rows), tail), parameters
+
     # high level interface
     async def table_has(self, table_name, field, value):
         sql = 'SELECT {} FROM {} WHERE {}=%s limit 1'.format(field, table_name, field)
@@ -158,6 +221,36 @@ class SanicDB:
                     print(fields[i], ' : ', vs, type(values[i]))
             raise e
 
+    async def table_insert_many(self, table_name, items, ignore_duplicated=True,
+                                max_packet_size=4 * 1024 * 1024):
+        '''items is a list of dict with the same keys, inserted by multi-VALUES statements
+        chunked by max_packet_size(the mysql max_allowed_packet), returning the inserted rows.
+        like table_insert only duplicate key errors(1062) are skipped: a chunk with duplicated
+        rows is inserted again row by row, other errors are raised'''
+        items = list(items)
+        if not items:
+            return 0
+        sqls = self._split_values('INSERT INTO %s (%%s)' % table_name, items, max_packet_size=max_packet_size)
+        row_sql = None
+        if ignore_duplicated:
+            fields = list(items[0].keys())
+            row_sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                table_name, ','.join(fields), ','.join(['%s'] * len(fields)))
+        return await self.execute_many_sql(sqls, row_sql)
+
+    async def table_upsert_many(self, table_name, items, update_fields=None,
+                                max_packet_size=4 * 1024 * 1024):
+        '''items is a list of dict with the same keys, rows with duplicated key are updated
+        by update_fields(default all fields), returning the affected rows(an updated row counts 2)'''
+        items = list(items)
+        if not items:
+            return 0
+        update_fields = update_fields or list(items[0].keys())
+        tail = ' ON DUPLICATE KEY UPDATE %s' % ','.join(
+            '%s=VALUES(%s)' % (field, field) for field in update_fields)
+        sqls = self._split_values('INSERT INTO %s (%%s)' % table_name, items, tail, max_packet_size)
+        return await self.execute_many_sql(sqls)
+
     async def table_update(self, table_name, updates,
                            field_where, value_where):
         '''updates is a dict of {field_update:value_update}'''
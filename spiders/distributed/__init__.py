@@ -9,180 +9,876 @@ import asyncio
 import base64
 import hashlib
 import json
-import pickle
+import math
+import os
 import random
+import socket
 import threading
 import time
+import uuid
+import weakref
 from collections import deque
 from concurrent.futures.thread import ThreadPoolExecutor
-from typing import Optional
+from typing import List, Optional, Tuple
 
 import aioredis
 
+from smart.bloom import bloom_hashes
 from smart.log import log
 from smart.request import Request
 from smart.scheduler import BaseDuplicateFilter, BaseSchedulerContainer
+from smart.serialize import dumps_request, loads_request
 import redis  # 导入redis 模块
 
+from smart.setting import gloable_setting_dict
 from smart.signal import reminder
-from smart.tool import mutations_bkdr_hash
-from test.redis_lock import acquire_lock, release_lock
+from smart.tool import to_fingerprint
 
 
-class RedisSchuler(BaseSchedulerContainer):
-    # pool = redis.ConnectionPool(host='121.4.157.53', port=6399, password="Admin123@@@", decode_responses=True)
+# redis_url -> 同步客户端的连接池
+_sync_pools = {}
+
 
-    pool = redis.ConnectionPool(host='localhost', port=6379, decode_responses=True)
-    tp = ThreadPoolExecutor(100)
+def sync_redis_pool(url: str = None) -> redis.ConnectionPool:
+    """
+    同步 redis 客户端共享的连接池 地址由 redis_url 配置
+    :param url: redis 地址 默认 redis_url
+    :return: redis.ConnectionPool
+    """
+    url = url or gloable_setting_dict.get("redis_url")
+    pool = _sync_pools.get(url)
+    if pool is None:
+        pool = _sync_pools[url] = redis.ConnectionPool.from_url(url)
+    return pool
 
-    _stop = False
 
-    def __init__(self):
-        self.redis = redis.Redis(connection_pool=self.pool)
+class RedisSchuler(BaseSchedulerContainer):
+    """
+    redis list 保存 request 多个节点共享待抓取队列 请求用 smart.serialize.dumps_request 序列化
+    push 先放入本地发送队列 由发送线程合并成一次 pipeline 批量 RPUSH
+    预取线程批量 LPOP 到本地缓冲 缓冲上限默认与请求并发数相同 队列为空时 BLPOP 阻塞等待 不轮询
+    引擎关闭时发送剩余请求 未使用的预取请求放回队列头部
+    redis 中的请求数由发送线程和预取线程统计 size() 不访问 redis
+    """
+    persistent = True
+    # 发送线程没有新请求时 最长等待时间 s  每次等待后统计 redis 中的请求数 间隔短一些 空闲判断更及时
+    flush_interval = 0.1
+    # 批量 LPOP: 不支持 LPOP key count 的 redis(< 6.2) 使用
+    lpop_script = """
+    local items = redis.call('LRANGE', KEYS[1], 0, ARGV[1] - 1)
+    if #items > 0 then
+        redis.call('LTRIM', KEYS[1], #items, -1)
+    end
+    return items
+    """
+
+    def __init__(self, client: redis.Redis = None, prefetch_size: int = None, batch_size: int = None):
+        """
+        初始方法
+        :param client: redis 客户端 默认使用 redis_url 的连接池 不能设置 decode_responses
+        :param prefetch_size: 本地预取缓冲的最大请求数 默认 redis_prefetch_size 或请求并发数
+        :param batch_size: 每次 RPUSH/LPOP 的最大请求数
+        """
+        self.redis = client or redis.Redis(connection_pool=sync_redis_pool())
         self.task_queue_name = "smart_spider_redis_task_queue"
+        self.prefetch_size = prefetch_size or gloable_setting_dict.get(
+            "redis_prefetch_size") or gloable_setting_dict.get("req_per_concurrent")
+        self.batch_size = batch_size or gloable_setting_dict.get("redis_batch_size")
+        self.block_timeout = gloable_setting_dict.get("redis_block_timeout")
         # 需要保持session 的放在本地 或者序列化报错的request 的容器
         self.faults = deque()
+        # 预取到本地的请求
         self.caches = deque()
-        self.ecodeing = "latin1"
-        self.tp.submit(self.buffer)
+        # 等待发送到 redis 的请求
+        self.outbox = deque()
+        # 发送线程已取出 还没有写入 redis 的请求数
+        self.flushing = 0
+        # 已写入 redis 的请求数
+        self.pushed = 0
+        # (redis 中的请求数, 统计时的 pushed) 一次赋值 其他线程读到的总是一致的
+        self.remote = (0, 0)
+        # 预取线程已取出 还没有放入缓冲的请求数
+        self.fetching = 0
+        self.lpop_script_sha = None
+        self.push_event = threading.Event()
+        self.space_event = threading.Event()
+        self._stop = False
+        self.log = log
+        self.threads = []
+        self._start()
+        reminder.engin_close.connect(self._on_engin_close)
+
+    def _start(self):
+        """
+        启动发送线程和预取线程
+        :return: None
+        """
+        self._refresh_size()
+        for target in (self._flush_loop, self._prefetch_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def push(self, request: Request):
+        if request.session is not None:
+            self.faults.append(request)
+            return
+        self.outbox.append(request)
+        self.push_event.set()
+
+    def pop(self) -> Optional[Request]:
+        if self.faults:
+            return self.faults.popleft()
+        if self.caches:
+            request = self.caches.popleft()
+            self.space_event.set()
+            return request
+        return None
 
-    def _do_push(self, request: Request):
+    def size(self) -> int:
+        """
+        本地和 redis 中的请求数 正在发送或预取的请求可能短暂地被重复计算 但不会漏算
+        redis 中的部分是最近一次的统计 加上之后本节点写入的请求 已被预取的请求在下次统计前会被重复计算
+        :return: int
+        """
+        local = len(self.faults) + len(self.caches) + len(self.outbox) + self.flushing + self.fetching
+        remote, pushed = self.remote
+        return local + remote + self.pushed - pushed
+
+    def _remote_size(self) -> int:
+        return self.redis.llen(self.task_queue_name)
+
+    def _refresh_size(self):
+        """
+        统计 redis 中的请求数 在发送线程和预取线程中执行
+        :return: None
+        """
+        # 先读 pushed 再统计 统计前后写入的请求最多被重复计算 不会漏算
+        pushed = self.pushed
+        self.remote = (self._remote_size(), pushed)
+
+    def _dumps(self, request: Request) -> Optional[bytes]:
         try:
-            req_byte = pickle.dumps(request)
-            self.redis.rpush(self.task_queue_name, req_byte.decode(self.ecodeing))
+            return dumps_request(request)
         except Exception:
             self.faults.append(request)
+            return None
 
-    def push(self, request: Request):
-        self.tp.submit(self._do_push, request)
+    def _loads(self, code: bytes) -> Optional[Request]:
+        try:
+            # 回调函数是名称 由引擎从 spider 上获取
+            return loads_request(code)
+        except Exception as e:
+            self.log.error(f"bad request in redis queue {self.task_queue_name}: {e}")
+            return None
+
+    def _flush(self):
+        """
+        发送本地发送队列中的所有请求
+        :return: None
+        """
+        while self.outbox:
+            self._push_batch()
+
+    def _push_batch(self):
+        """
+        发送一批请求 一次 pipeline 一个网络往返
+        :return: None
+        """
+        requests = []
+        while self.outbox and len(requests) < self.batch_size * 10:
+            # 先计数再出队 size() 不会漏算
+            self.flushing += 1
+            requests.append(self.outbox.popleft())
+        try:
+            # 序列化失败的请求已放入 faults
+            pairs = [(request, code) for request, code in zip(requests, map(self._dumps, requests))
+                     if code is not None]
+            codes = [code for _, code in pairs]
+            pipe = self.redis.pipeline(transaction=False)
+            for i in range(0, len(codes), self.batch_size):
+                pipe.rpush(self.task_queue_name, *codes[i:i + self.batch_size])
+            if codes:
+                pipe.execute()
+                # 先计入已写入 再清零 flushing size() 不会漏算
+                self.pushed += len(codes)
+        except Exception as e:
+            self.log.error(f"push requests to redis failed: {e}, keep them in local")
+            self.faults.extend(request for request, _ in pairs)
+        finally:
+            self.flushing = 0
 
-    def buffer(self):
-        cons = []
+    def _flush_loop(self):
         while not self._stop:
-            # if len(cons) > 0 and (max(cons) - min(cons) > 3 and len(cons) > 90):
-            #     time.sleep(random.uniform(0.2, 2))
-            #     cons = []
-
-            res = self._do_pop()
-            if res:
-                self.caches.append(res)
-                cons.append(time.time())
-            else:
-                time.sleep(random.uniform(0.1, 0.5))
-            time.sleep(0.001)
-
-    def _do_pop(self) -> Optional[Request]:
-        if len(self.faults) > 0:
-            req = self.faults.popleft()
-            if req:
-                return req
-        else:
+            self.push_event.wait(self.flush_interval)
+            self.push_event.clear()
+            self._flush()
             try:
-                # identifier = acquire_lock('resource')
-                code = self.redis.lpop(self.task_queue_name)
-                if code:
-                    req_byte = code.encode(self.ecodeing)
-                    req = pickle.loads(req_byte)
-                    return req
+                self._refresh_size()
             except Exception as e:
-                print(e)
-        return None
+                self.log.error(f"count requests in redis failed: {e}")
 
-    def pop(self) -> Optional[Request]:
-        if self.caches:
-            return self.caches.popleft()
-        return None
+    def _pop_many(self, count: int) -> list:
+        if self.lpop_script_sha is None:
+            try:
+                return self.redis.lpop(self.task_queue_name, count) or []
+            except redis.ResponseError:
+                # redis < 6.2 不支持 LPOP key count 改用脚本
+                self.lpop_script_sha = self.redis.script_load(self.lpop_script)
+        return self.redis.evalsha(self.lpop_script_sha, 1, self.task_queue_name, count) or []
+
+    def _block_pop(self) -> list:
+        res = self.redis.blpop([self.task_queue_name], self.block_timeout)
+        return [res[1]] if res else []
+
+    def _prefetch(self):
+        count = min(self.batch_size, self.prefetch_size - len(self.caches))
+        # 出队的请求在放入缓冲前也计入 size()
+        self.fetching = count
+        codes = self._pop_many(count)
+        if not codes:
+            self.fetching = 0
+            # 队列为空 阻塞等待 有请求时立即返回
+            codes = self._block_pop()
+        self.fetching = len(codes)
+        try:
+            for code in codes:
+                request = self._loads(code)
+                if request is not None:
+                    self.caches.append(request)
+        finally:
+            self.fetching = 0
+
+    def _prefetch_loop(self):
+        while not self._stop:
+            if len(self.caches) >= self.prefetch_size:
+                self.space_event.wait(0.5)
+                self.space_event.clear()
+                continue
+            try:
+                self._prefetch()
+                self._refresh_size()
+            except Exception as e:
+                self.log.error(f"pop requests from redis failed: {e}")
+                time.sleep(1)
+
+    def close(self):
+        """
+        停止后台线程 发送剩余请求 未使用的预取请求放回队列头部
+        :return: None
+        """
+        if self._stop:
+            return
+        self._stop = True
+        self.push_event.set()
+        self.space_event.set()
+        for thread in self.threads:
+            thread.join()
+        self._flush()
+        self._return_caches()
+
+    def _return_caches(self):
+        codes = [code for code in map(self._dumps, self.caches) if code is not None]
+        self.caches.clear()
+        if codes:
+            self.redis.lpush(self.task_queue_name, *reversed(codes))
+
+    def _on_engin_close(self, sender, **kwargs):
+        scheduler = getattr(sender, "scheduler", None)
+        if scheduler is not None and getattr(scheduler, "scheduler_container", None) is self:
+            self.close()
+
+
+class RedisLeaseSchuler(RedisSchuler):
+    """
+    至少一次的 redis 队列 需要 redis >= 6.2 (LMOVE BLMOVE)
+    请求出队时原子地 LMOVE 到本节点的处理中列表 回调处理结束后引擎调用 ack 才从处理中列表删除
+    每个节点定时在节点表(zset 分数为租约到期时间 使用 redis 服务器时间)中续租
+    租约过期节点(宕机 被抢占)的处理中列表由其他节点放回队列头部 只会重新抓取它正在处理的请求
+    等待退避重试的请求在本地 不在处理中列表中
+    """
+
+    def __init__(self, client: redis.Redis = None, prefetch_size: int = None, batch_size: int = None,
+                 lease_timeout: float = None):
+        """
+        初始方法
+        :param client: redis 客户端 默认使用 redis_url 的连接池
+        :param prefetch_size: 本地预取缓冲的最大请求数
+        :param batch_size: 每次 RPUSH/LMOVE 的最大请求数
+        :param lease_timeout: 节点租约时间 s 超过这个时间没有续租的节点视为宕机
+        """
+        self.node_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lease_timeout = lease_timeout or gloable_setting_dict.get("redis_lease_timeout")
+        # id(request) -> (request, 处理中列表中的数据) ack 时删除 保留请求的引用 id 不会被复用
+        self.leases = {}
+        # 等待发送的 ack
+        self.acks = deque()
+        self.heartbeat_event = threading.Event()
+        super().__init__(client, prefetch_size, batch_size)
+
+    def _start(self):
+        self.processing_name = self._processing_of(self.node_id)
+        self.nodes_name = f"{self.task_queue_name}:nodes"
+        # 先注册节点 再取请求
+        self._heartbeat()
+        super()._start()
+        thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _processing_of(self, node_id) -> str:
+        if isinstance(node_id, bytes):
+            node_id = node_id.decode("utf-8")
+        return f"{self.task_queue_name}:processing:{node_id}"
+
+    def ack(self, request: Request):
+        lease = self.leases.get(id(request))
+        if lease is not None and lease[0] is request:
+            del self.leases[id(request)]
+            self.acks.append(lease[1])
+            self.push_event.set()
 
     def size(self) -> int:
-        return self.redis.llen(self.task_queue_name)
+        """
+        本地还没有发送的请求 队列中的请求 加上所有节点处理中的请求(包括本节点预取的和正在处理的)
+        其他节点的回调可能产生新请求 宕机节点的请求会被放回队列
+        redis 中的部分是最近一次的统计 加上之后本节点写入的请求 不会漏算本节点的请求
+        :return: int
+        """
+        remote, pushed = self.remote
+        return len(self.faults) + len(self.outbox) + self.flushing + remote + self.pushed - pushed
+
+    def _remote_size(self) -> int:
+        # 队列和所有节点处理中列表的请求数
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.llen(self.task_queue_name)
+        for node_id in self.redis.zrange(self.nodes_name, 0, -1):
+            pipe.llen(self._processing_of(node_id))
+        return sum(pipe.execute())
+
+    def _loads(self, code: bytes) -> Optional[Request]:
+        request = super()._loads(code)
+        if request is None:
+            # 无法解析的请求直接删除 避免一直被放回队列
+            self.acks.append(code)
+        else:
+            self.leases[id(request)] = (request, code)
+        return request
+
+    def _pop_many(self, count: int) -> list:
+        pipe = self.redis.pipeline(transaction=False)
+        for _ in range(count):
+            pipe.lmove(self.task_queue_name, self.processing_name, "LEFT", "RIGHT")
+        return [code for code in pipe.execute() if code is not None]
+
+    def _block_pop(self) -> list:
+        code = self.redis.blmove(self.task_queue_name, self.processing_name, self.block_timeout, "LEFT", "RIGHT")
+        return [code] if code is not None else []
+
+    def _flush(self):
+        # 先取出 ack 再发送请求 回调产生的请求先于它的 ack 写入 redis
+        acks = []
+        while self.acks:
+            acks.append(self.acks.popleft())
+        super()._flush()
+        if acks:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for code in acks:
+                    pipe.lrem(self.processing_name, 1, code)
+                pipe.execute()
+            except Exception as e:
+                self.log.error(f"ack requests failed: {e}, will try again")
+                self.acks.extendleft(reversed(acks))
+
+    def _now(self) -> float:
+        seconds, microseconds = self.redis.time()
+        return seconds + microseconds / 1000000
+
+    def _heartbeat(self):
+        """
+        续租 并回收租约过期节点的请求
+        :return: None
+        """
+        now = self._now()
+        self.redis.zadd(self.nodes_name, {self.node_id: now + self.lease_timeout})
+        for node_id in self.redis.zrangebyscore(self.nodes_name, 0, now):
+            count = self._move_back(node_id)
+            self.redis.zrem(self.nodes_name, node_id)
+            if count:
+                self.log.warning(f"node {node_id.decode('utf-8')} lease expired, {count} requests are returned to the queue")
+
+    def _move_back(self, node_id) -> int:
+        """
+        节点处理中的请求按原顺序放回队列头部 LMOVE 是原子的 多个节点同时回收也不会重复
+        :param node_id: 节点
+        :return: 放回的请求数
+        """
+        processing = self._processing_of(node_id)
+        pipe = self.redis.pipeline(transaction=False)
+        for _ in range(self.redis.llen(processing)):
+            pipe.lmove(processing, self.task_queue_name, "RIGHT", "LEFT")
+        return sum(code is not None for code in pipe.execute())
+
+    def _heartbeat_loop(self):
+        while not self.heartbeat_event.wait(self.lease_timeout / 3):
+            try:
+                self._heartbeat()
+            except Exception as e:
+                self.log.error(f"redis lease heartbeat failed: {e}")
 
-    @staticmethod
-    @reminder.engin_close.connect
-    def engin_close(sender, **kwargs):
-        RedisSchuler._stop = True
-        RedisSchuler.tp.shutdown()
+    def close(self):
+        self.heartbeat_event.set()
+        super().close()
 
+    def _return_caches(self):
+        # 未使用的预取请求和没有 ack 的请求都在处理中列表 一起放回队列头部
+        self.caches.clear()
+        self.leases.clear()
+        self._move_back(self.node_id)
+        self.redis.zrem(self.nodes_name, self.node_id)
 
-class RedisBaseDuplicateFilter(BaseDuplicateFilter):
-    pool = redis.ConnectionPool(host='localhost', port=6379, decode_responses=True)
 
-    # pool = redis.ConnectionPool(host='121.4.157.53', port=6399, password="Admin123@@@", decode_responses=True)
+class RedisBaseDuplicateFilter(BaseDuplicateFilter):
 
-    def __init__(self):
-        self.redis = redis.Redis(connection_pool=self.pool)
+    def __init__(self, client: redis.Redis = None):
+        """
+        初始方法
+        :param client: redis 客户端 默认使用 redis_url 的连接池
+        """
+        self.redis = client or redis.Redis(connection_pool=sync_redis_pool())
         self.filterset_name = "smart_spider_redis_repeat_set"
 
     def add(self, url):
         if url:
-            self.redis.sadd(self.filterset_name, mutations_bkdr_hash(url))
+            self.redis.sadd(self.filterset_name, to_fingerprint(url, self.digest_size))
 
     def contains(self, url):
-        res = self.redis.sismember(self.filterset_name, mutations_bkdr_hash(url))
+        res = self.redis.sismember(self.filterset_name, to_fingerprint(url, self.digest_size))
         return res
 
+    def add_if_absent(self, url) -> bool:
+        # SADD 返回新加入的个数 一次网络往返完成检查和加入
+        return self.redis.sadd(self.filterset_name, to_fingerprint(url, self.digest_size)) == 1
+
     def length(self):
         return self.redis.scard(self.filterset_name)
 
 
-class AioRedisBaseDuplicateFilter(BaseDuplicateFilter):
-    # pool = redis.ConnectionPool(host='121.4.157.53', port=6399, password="Admin123@@@", decode_responses=True)
-    def __init__(self):
+class AioRedisBackend:
+    """
+    同一个事件循环(引擎)中的 aioredis 去重器和调度容器共享一个连接池 地址由 redis_url 配置
+    使用者在引擎关闭时释放 最后一个使用者释放后关闭连接池
+    """
+    # 事件循环 -> AioRedisBackend
+    _backends = weakref.WeakKeyDictionary()
+
+    def __init__(self, url: str = None, max_size: int = None):
+        """
+        初始方法
+        :param url: redis 地址 如 redis://:password@127.0.0.1:6379/0
+        :param max_size: 连接池的最大连接数
+        """
+        self.url = url or gloable_setting_dict.get("redis_url")
+        self.max_size = max_size or gloable_setting_dict.get("redis_pool_max_size")
         self.redis = None
-        self.lock = asyncio.Lock()
+        self.lock = None
+        self.users = 0
+
+    @classmethod
+    def of(cls) -> "AioRedisBackend":
+        """
+        当前事件循环的共享实例 调用者需要在不再使用时调用 release
+        :return: AioRedisBackend
+        """
+        loop = asyncio.get_event_loop()
+        backend = cls._backends.get(loop)
+        if backend is None:
+            backend = cls._backends[loop] = cls()
+        backend.users += 1
+        return backend
+
+    async def get(self):
+        """
+        连接池 第一次使用时创建 请求是二进制 不解码
+        :return: aioredis.Redis
+        """
+        if self.redis is None:
+            if self.lock is None:
+                self.lock = asyncio.Lock()
+            async with self.lock:
+                if self.redis is None:
+                    self.redis = await aioredis.create_redis_pool(self.url, maxsize=self.max_size)
+        return self.redis
+
+    async def release(self):
+        self.users -= 1
+        if self.users <= 0 and self.redis is not None:
+            pool, self.redis = self.redis, None
+            pool.close()
+            await pool.wait_closed()
+
+
+class AioRedisBaseDuplicateFilter(BaseDuplicateFilter):
+    """
+    redis set 去重 使用共享的 AioRedisBackend
+    add_if_absent 用一次 SADD 完成检查和加入 同一轮事件循环中的调用合并为一个 pipeline
+    去重的开销是每批一个网络往返 而不是每个 url 两个
+    """
+
+    def __init__(self, backend: AioRedisBackend = None):
+        """
+        初始方法
+        :param backend: redis 后端 默认当前事件循环共享的实例
+        """
+        self.backend = backend or AioRedisBackend.of()
         self.filterset_name = "aio_smart_spider_redis_repeat_set"
+        self.batch_size = gloable_setting_dict.get("redis_batch_size")
+        # 等待合并发送的 (指纹, future)
+        self.pending = []
+        # 事件循环只弱引用 task 这里保存引用 防止发送中的 task 被回收
+        self.tasks = set()
+        reminder.engin_close.connect(self._on_engin_close)
 
     async def add(self, url):
-        await self.creat_redi()
         if url:
-            await self.redis.sadd(self.filterset_name, mutations_bkdr_hash(url))
+            redis = await self.backend.get()
+            await redis.sadd(self.filterset_name, to_fingerprint(url, self.digest_size))
 
     async def contains(self, url):
-        await self.creat_redi()
-        res =await self.redis.sismember(self.filterset_name, mutations_bkdr_hash(url))
+        redis = await self.backend.get()
+        res = await redis.sismember(self.filterset_name, to_fingerprint(url, self.digest_size))
         return res
 
+    async def add_if_absent(self, url) -> bool:
+        """
+        不存在时加入
+        :param url: url 或指纹
+        :return: 是否是新加入的
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((to_fingerprint(url, self.digest_size), future))
+        if len(self.pending) == 1:
+            # 下一轮事件循环发送 期间其他 worker 的调用加入同一批
+            self._spawn(self._flush())
+        return await future
+
+    async def _flush(self):
+        try:
+            redis = await self.backend.get()
+        except Exception as e:
+            batch, self.pending = self.pending, []
+            for _, future in batch:
+                # 等待的调用方可能已被取消
+                if not future.done():
+                    future.set_exception(e)
+            return
+        while self.pending:
+            batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            try:
+                pipe = redis.pipeline()
+                for fingerprint, _ in batch:
+                    self._pipe_add(pipe, fingerprint)
+                results = await pipe.execute()
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(self._is_added(result))
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def _pipe_add(self, pipe, fingerprint: bytes):
+        pipe.sadd(self.filterset_name, fingerprint)
+
+    def _is_added(self, result) -> bool:
+        return result == 1
+
     async def length(self):
-        await self.creat_redi()
-        return await self.redis.scard(self.filterset_name)
+        redis = await self.backend.get()
+        return await redis.scard(self.filterset_name)
+
+    async def _close(self):
+        # 发送中的去重完成后再归还连接池
+        await asyncio.gather(*list(self.tasks - {asyncio.current_task()}), return_exceptions=True)
+        await self.backend.release()
+
+    async def wait_closed(self):
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+    def _on_engin_close(self, sender, **kwargs):
+        scheduler = getattr(sender, "scheduler", None)
+        if scheduler is not None and getattr(scheduler, "duplicate_filter", None) is self:
+            self._spawn(self._close())
 
-    async def creat_redi(self):
-        if not self.redis:
-            async with self.lock:
-                if not self.redis:
-                    self.redis = await aioredis.create_redis_pool(('127.0.0.1', 6379), db=0, encoding='utf-8')
-                    print("#############")
 
 class AioRedisSchuler(BaseSchedulerContainer):
-    def __init__(self):
-        self.redis = None
+    persistent = True
+
+    def __init__(self, backend: AioRedisBackend = None):
+        """
+        初始方法
+        :param backend: redis 后端 默认当前事件循环共享的实例 与去重器共用连接池
+        """
+        self.backend = backend or AioRedisBackend.of()
         self.task_queue_name = "aio_smart_spider_redis_task_queue"
-        self.ecodeing = "latin1"
-        self.lock = asyncio.Lock()
+        # 序列化报错的 request 放在本地
+        self.faults = deque()
+        # 引擎关闭时归还连接池的 task 保存引用 由 wait_closed 等待完成
+        self.tasks = set()
+        reminder.engin_close.connect(self._on_engin_close)
 
     async def push(self, request: Request):
-        await self.creat_redi()
-        req_byte = pickle.dumps(request)
-        await self.redis.rpush(self.task_queue_name, req_byte.decode(self.ecodeing))
-
-    async def creat_redi(self):
-        if not self.redis:
-            async with self.lock:
-                if not self.redis:
-                    self.redis = await aioredis.create_redis_pool(('127.0.0.1', 6379), db=0, encoding='utf-8')
-                    print("#############")
+        try:
+            code = dumps_request(request)
+        except Exception as e:
+            log.warning(f"{request.url} can not be serialized: {e}, keep it in local")
+            self.faults.append(request)
+            return
+        redis = await self.backend.get()
+        await redis.rpush(self.task_queue_name, code)
 
     async def pop(self) -> Optional[Request]:
+        if self.faults:
+            return self.faults.popleft()
         try:
-            await self.creat_redi()
-            code = await self.redis.lpop(self.task_queue_name)
+            redis = await self.backend.get()
+            code = await redis.lpop(self.task_queue_name)
             if code:
-                req_byte = code.encode(self.ecodeing)
-                req = pickle.loads(req_byte)
-                return req
+                return loads_request(code)
         except Exception as e:
-            print(e)
+            log.error(f"pop request from redis failed: {e}")
         return None
 
     async def size(self) -> int:
-        await self.creat_redi()
-        return await self.redis.llen(self.task_queue_name)
+        redis = await self.backend.get()
+        return len(self.faults) + await redis.llen(self.task_queue_name)
+
+    def _on_engin_close(self, sender, **kwargs):
+        scheduler = getattr(sender, "scheduler", None)
+        if scheduler is not None and getattr(scheduler, "scheduler_container", None) is self:
+            task = asyncio.ensure_future(self.backend.release())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def wait_closed(self):
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+
+class RedisBloom:
+    """
+    redis 位图上的布隆过滤器 不需要 redis 模块
+    总 bit 数由容量和误判率决定 分到 shards 个 key 上 每个 key 不超过 redis 字符串的 512MB 上限
+    一个元素的所有 bit 都在同一个 key 中 检查和加入由 lua 脚本一次原子完成 也可以用于 redis 集群
+    参数保存在 redis 中 节点的容量 误判率 分片数不一致时报错 避免写坏过滤器
+    """
+    # 一个 key 最多 2^32 bit
+    max_bits_per_key = 2 ** 32
+
+    # KEYS: 位图 计数  ARGV: bit 位置  返回 0 表示已存在 否则返回该分片的元素数
+    add_script = """
+    local added = 0
+    for i = 1, #ARGV do
+        if redis.call('SETBIT', KEYS[1], ARGV[i], 1) == 0 then
+            added = 1
+        end
+    end
+    if added == 1 then
+        return redis.call('INCR', KEYS[2])
+    end
+    return 0
+    """
+
+    # KEYS: 位图  ARGV: bit 位置  返回 1 表示可能存在
+    contains_script = """
+    for i = 1, #ARGV do
+        if redis.call('GETBIT', KEYS[1], ARGV[i]) == 0 then
+            return 0
+        end
+    end
+    return 1
+    """
+
+    def __init__(self, name: str, capacity: int = None, error_rate: float = None, shards: int = None):
+        """
+        初始方法
+        :param name: key 前缀
+        :param capacity: 容量 超过后误判率升高
+        :param error_rate: 期望误判率
+        :param shards: 位图 key 的个数 bit 数超过单个 key 的上限时自动增加
+        """
+        capacity = capacity or gloable_setting_dict.get("redis_bloom_capacity")
+        error_rate = error_rate or gloable_setting_dict.get("redis_bloom_error_rate")
+        if capacity <= 0:
+            raise ValueError("bloom filter capacity must >0")
+        if not 0 < error_rate < 1:
+            raise ValueError("bloom filter error_rate must between 0 and 1")
+        self.name = name
+        self.capacity = capacity
+        self.error_rate = error_rate
+        num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        self.shards = max(shards or gloable_setting_dict.get("redis_bloom_shards") or 1,
+                          int(math.ceil(num_bits / self.max_bits_per_key)))
+        self.bits_per_shard = int(math.ceil(num_bits / self.shards))
+        # hash tag 保证同一分片的位图和计数在集群的同一个 slot
+        self.bit_keys = [f"{{{name}:{i}}}:bits" for i in range(self.shards)]
+        self.count_keys = [f"{{{name}:{i}}}:count" for i in range(self.shards)]
+        self.meta_key = f"{name}:meta"
+        self.warned = False
+
+    @property
+    def meta(self) -> str:
+        return f"capacity={self.capacity} error_rate={self.error_rate!r} shards={self.shards}"
+
+    def check_meta(self, saved):
+        """
+        与 redis 中保存的参数比较 第一个节点用 SETNX 保存参数
+        :param saved: GET 的结果
+        :return: None
+        """
+        if isinstance(saved, bytes):
+            saved = saved.decode("utf-8")
+        if saved != self.meta:
+            raise ValueError(f"redis bloom filter {self.name} was created with {saved}, but now is {self.meta}, "
+                             f"use the same setting or another name")
+
+    def locate(self, fingerprint: bytes) -> Tuple[int, List[int]]:
+        """
+        元素所在的分片和 bit 位置
+        :param fingerprint: 指纹
+        :return: (分片, bit 位置)
+        """
+        h1, h2 = bloom_hashes(fingerprint)
+        # 分片用 h2 的高位 与位置的计算不相关
+        shard = (h2 >> 33) % self.shards
+        bits = self.bits_per_shard
+        return shard, [(h1 + i * h2) % bits for i in range(self.num_hashes)]
+
+    def is_added(self, result) -> bool:
+        result = int(result)
+        if result > self.capacity / self.shards and not self.warned:
+            self.warned = True
+            log.warning(f"redis bloom filter {self.name} is over capacity {self.capacity}, "
+                        f"the error rate will increase")
+        return result > 0
+
+
+class RedisBloomDuplicateFilter(BaseDuplicateFilter):
+    """
+    全局去重的 redis 布隆过滤器 内存固定: 约 -capacity*ln(error_rate)/(ln2)^2 bit
+    如 10 亿 url 误判率 0.0001 约 2.4GB 而 redis set 保存指纹需要几十 GB
+    存在 error_rate 的误判(新请求被当作重复过滤)
+    """
+
+    def __init__(self, client: redis.Redis = None, capacity: int = None, error_rate: float = None,
+                 shards: int = None):
+        """
+        初始方法
+        :param client: redis 客户端 默认使用 redis_url 的连接池
+        :param capacity: 容量 默认 redis_bloom_capacity
+        :param error_rate: 误判率 默认 redis_bloom_error_rate
+        :param shards: 位图 key 的个数 默认 redis_bloom_shards
+        """
+        self.redis = client or redis.Redis(connection_pool=sync_redis_pool())
+        self.bloom = RedisBloom("smart_spider_redis_bloom", capacity, error_rate, shards)
+        self.add_script = self.redis.register_script(self.bloom.add_script)
+        self.contains_script = self.redis.register_script(self.bloom.contains_script)
+        # 第一个节点保存参数 其他节点检查
+        self.redis.setnx(self.bloom.meta_key, self.bloom.meta)
+        self.bloom.check_meta(self.redis.get(self.bloom.meta_key))
+
+    def add(self, url):
+        if url:
+            self.add_if_absent(url)
+
+    def contains(self, url):
+        if not url:
+            return False
+        shard, positions = self.bloom.locate(to_fingerprint(url, self.digest_size))
+        return self.contains_script(keys=[self.bloom.bit_keys[shard]], args=positions) == 1
+
+    def add_if_absent(self, url) -> bool:
+        shard, positions = self.bloom.locate(to_fingerprint(url, self.digest_size))
+        result = self.add_script(keys=[self.bloom.bit_keys[shard], self.bloom.count_keys[shard]], args=positions)
+        return self.bloom.is_added(result)
+
+    def length(self):
+        # 误判的新元素不计数 略小于实际添加的个数
+        return sum(int(count or 0) for count in self.redis.mget(self.bloom.count_keys))
+
+
+class AioRedisBloomDuplicateFilter(AioRedisBaseDuplicateFilter):
+    """
+    aioredis 版本的 redis 布隆过滤器 使用共享的 AioRedisBackend
+    同一轮事件循环中的 add_if_absent 合并为一个 pipeline
+    """
+
+    def __init__(self, backend: AioRedisBackend = None, capacity: int = None, error_rate: float = None,
+                 shards: int = None):
+        """
+        初始方法
+        :param backend: redis 后端 默认当前事件循环共享的实例
+        :param capacity: 容量 默认 redis_bloom_capacity
+        :param error_rate: 误判率 默认 redis_bloom_error_rate
+        :param shards: 位图 key 的个数 默认 redis_bloom_shards
+        """
+        super().__init__(backend)
+        self.bloom = RedisBloom("aio_smart_spider_redis_bloom", capacity, error_rate, shards)
+        # 参数检查只做一次 并发的调用等待同一个 future
+        self.checking = None
+
+    async def _check_meta(self, redis):
+        if self.checking is None:
+            self.checking = self._spawn(self._do_check_meta(redis))
+        try:
+            await asyncio.shield(self.checking)
+        except Exception:
+            # 网络错误时下次重新检查
+            checking = self.checking
+            if checking.done() and (checking.cancelled() or not isinstance(checking.exception(), ValueError)):
+                self.checking = None
+            raise
+
+    async def _do_check_meta(self, redis):
+        await redis.setnx(self.bloom.meta_key, self.bloom.meta)
+        self.bloom.check_meta(await redis.get(self.bloom.meta_key))
+
+    async def add(self, url):
+        if url:
+            await self.add_if_absent(url)
+
+    async def contains(self, url):
+        if not url:
+            return False
+        redis = await self.backend.get()
+        await self._check_meta(redis)
+        shard, positions = self.bloom.locate(to_fingerprint(url, self.digest_size))
+        return await redis.eval(self.bloom.contains_script, keys=[self.bloom.bit_keys[shard]], args=positions) == 1
+
+    async def add_if_absent(self, url) -> bool:
+        await self._check_meta(await self.backend.get())
+        return await super().add_if_absent(url)
+
+    def _pipe_add(self, pipe, fingerprint: bytes):
+        # redis 按 sha 缓存编译后的脚本 EVAL 只多传输脚本文本
+        shard, positions = self.bloom.locate(fingerprint)
+        pipe.eval(self.bloom.add_script, keys=[self.bloom.bit_keys[shard], self.bloom.count_keys[shard]],
+                  args=positions)
+
+    def _is_added(self, result) -> bool:
+        return self.bloom.is_added(result)
+
+    async def length(self):
+        redis = await self.backend.get()
+        return sum(int(count or 0) for count in await redis.mget(*self.bloom.count_keys))
+
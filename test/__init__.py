@@ -20,10 +20,10 @@ class ReqInte:
 
 @middleware2.request(1)
 async def print_on_request(spider_ins, request):
-    request.metadata = {"url": request.url}
+    request.meta = {"url": request.url}
     global total_res
     total_res += 1
-    print(f"requesssst: {request.metadata}")
+    print(f"requesssst: {request.meta}")
     print(f"total_res: {total_res}")
 
     # Just operate request object, and do not return anything.
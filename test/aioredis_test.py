@@ -0,0 +1,110 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      aioredis_test
+# Author:    liangbaikai
+# Date:      2021/2/2
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+import asyncio
+import threading
+
+import pytest
+
+from smart.request import Request
+from smart.scheduler import AsyncScheduler
+from smart.signal import reminder, Reminder
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from spiders.distributed import AioRedisBackend, AioRedisBaseDuplicateFilter, AioRedisSchuler
+
+
+@pytest.fixture
+def redis_url():
+    server = fakeredis.TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    yield f"redis://{host}:{port}/0"
+    server.shutdown()
+    server.server_close()
+
+
+class TestAioRedis(object):
+    def test_shared_backend_and_batched_dedup(self, redis_url):
+        async def run():
+            backend = AioRedisBackend(redis_url)
+            backend.users = 2
+            duplicate_filter = AioRedisBaseDuplicateFilter(backend)
+            container = AioRedisSchuler(backend)
+            scheduler = AsyncScheduler(duplicate_filter, container)
+            redis = await backend.get()
+            executes = []
+            pipeline = redis.pipeline
+
+            def record_pipeline():
+                executes.append(1)
+                return pipeline()
+
+            redis.pipeline = record_pipeline
+            # 同一轮事件循环中的去重合并为一个 pipeline
+            results = await asyncio.gather(*(scheduler.schedlue(Request(f"http://a.com/{i % 150}"))
+                                             for i in range(300)))
+            assert results.count(True) == 150 and len(executes) == 1
+            assert not await scheduler.schedlue(Request("http://a.com/0"))
+            assert await duplicate_filter.length() == 150
+            assert await container.size() == 150
+            assert (await scheduler.get()).url == "http://a.com/0"
+            # 最后一个使用者释放后关闭连接池
+            await backend.release()
+            assert backend.redis is redis
+            await backend.release()
+            assert backend.redis is None and redis.closed
+
+        asyncio.run(run())
+
+    def test_unserializable_request_in_local(self, redis_url):
+        async def run():
+            backend = AioRedisBackend(redis_url)
+            container = AioRedisSchuler(backend)
+            request = Request("http://a.com/obj", meta={"obj": object()})
+            await container.push(request)
+            await container.push(Request("http://a.com/1"))
+            assert await container.size() == 2
+            assert await container.pop() is request
+            assert (await container.pop()).url == "http://a.com/1"
+            await backend.release()
+
+        asyncio.run(run())
+
+    def test_release_on_engine_close(self, redis_url):
+        async def run():
+            backend = AioRedisBackend(redis_url)
+            backend.users = 2
+            duplicate_filter = AioRedisBaseDuplicateFilter(backend)
+            scheduler = AsyncScheduler(duplicate_filter, AioRedisSchuler(backend))
+            # 调用方被取消后 发送结果时不会出错
+            add = asyncio.ensure_future(duplicate_filter.add_if_absent("http://a.com/cancel"))
+            await asyncio.sleep(0)
+            add.cancel()
+            assert await scheduler.schedlue(Request("http://a.com/1"))
+            redis = backend.redis
+            reminder.go(Reminder.engin_close, type("engine", (), {"scheduler": scheduler})())
+            await scheduler.wait_closed()
+            assert backend.redis is None and redis.closed
+
+        asyncio.run(run())
+
+    def test_backend_per_loop(self):
+        async def of():
+            return AioRedisBackend.of()
+
+        async def run():
+            first, second = AioRedisBackend.of(), await of()
+            assert first is second and first.users == 2
+
+        asyncio.run(run())
+        loop = asyncio.new_event_loop()
+        try:
+            assert loop.run_until_complete(of()).users == 1
+        finally:
+            loop.close()
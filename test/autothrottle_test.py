@@ -0,0 +1,54 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      autothrottle_test
+# Author:    liangbaikai
+# Date:      2021/2/1
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+from smart.autothrottle import AutoThrottle
+from smart.request import Request
+from smart.scheduler import DomainSchedulerContainer, DequeSchedulerContainer
+from smart.signal import reminder
+
+
+class _Spider:
+    cutome_setting_dict = {"autothrottle_target_latency": 0.5, "autothrottle_start_concurrency": 2,
+                           "autothrottle_min_concurrency": 1, "autothrottle_max_concurrency": 4,
+                           "autothrottle_max_delay": 1, "autothrottle_decrease": 0.5}
+
+
+class TestAutoThrottle(object):
+    def test_aimd(self):
+        container = DomainSchedulerContainer(domain_concurrency=8, domain_delay=0)
+        throttle = AutoThrottle(container, _Spider())
+        adjusted = []
+
+        def on_adjusted(host, **kwargs):
+            adjusted.append((host, kwargs["concurrency"], kwargs["delay"]))
+
+        reminder.autothrottle_adjusted.connect(on_adjusted)
+        try:
+            request = Request("http://a.com/1")
+            throttle.on_response(request, 0.1, 200)
+            assert container.limits["a.com"] == (2, 0)
+            for _ in range(20):
+                throttle.on_response(request, 0.1, 200)
+            assert container.limits["a.com"] == (4, 0)
+            throttle.on_response(request, 0.1, 503)
+            assert container.limits["a.com"] == (2, 0.1)
+            # 一个响应时间内只降速一次
+            throttle.on_error(request)
+            assert container.limits["a.com"] == (2, 0.1)
+            assert adjusted[0] == ("a.com", 2, 0.0) and adjusted[-1] == ("a.com", 2, 0.1)
+            assert "b.com" not in container.limits
+        finally:
+            reminder.autothrottle_adjusted.disconnect(on_adjusted)
+
+    def test_container_limit(self):
+        container = DomainSchedulerContainer(domain_concurrency=8, domain_delay=0)
+        for i in range(3):
+            container.push(Request(f"http://a.com/{i}"))
+        container.set_host_limit("a.com", 1, 0)
+        assert container.pop() is not None
+        assert container.pop() is None
+        assert not DequeSchedulerContainer().set_host_limit("a.com", 1, 0)
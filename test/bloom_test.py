@@ -0,0 +1,41 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      bloom_test
+# Author:    liangbaikai
+# Date:      2021/1/26
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+import os
+import tempfile
+
+from smart.bloom import ScalableBloomFilter
+from smart.scheduler import BloomDuplicateFilter
+
+
+class TestBloom(object):
+    def test_grow_and_error_rate(self):
+        bloom = ScalableBloomFilter(initial_capacity=1000, error_rate=0.01)
+        added = sum(bloom.add(f"http://a.com/{i}") for i in range(5000))
+        # 误判的新元素会被当作已存在
+        assert 4950 < added <= 5000
+        assert len(bloom.filters) > 1
+        assert all(f"http://a.com/{i}" in bloom for i in range(5000))
+        false_positive = sum(f"http://b.com/{i}" in bloom for i in range(10000))
+        assert false_positive / 10000 < 0.01
+        assert len(bloom) == added
+        assert not bloom.add("http://a.com/1")
+
+    def test_save_and_load(self):
+        path = os.path.join(tempfile.mkdtemp(), "bloom.bin")
+        duplicate_filter = BloomDuplicateFilter(capacity=100, error_rate=0.001, path=path)
+        for i in range(300):
+            duplicate_filter.add(f"http://a.com/{i}")
+        duplicate_filter.save()
+        loaded = BloomDuplicateFilter(path=path)
+        assert loaded.length() == duplicate_filter.length()
+        assert all(loaded.contains(f"http://a.com/{i}") for i in range(300))
+        assert not loaded.contains("http://a.com/new")
+        loaded.add("http://a.com/new")
+        assert loaded.contains("http://a.com/new")
+        loaded.save(path)
+        assert BloomDuplicateFilter(path=path).contains("http://a.com/new")
@@ -0,0 +1,120 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      checkpoint_test
+# Author:    liangbaikai
+# Date:      2021/1/28
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+import asyncio
+import os
+import tempfile
+
+from smart.checkpoint import Checkpoint
+from smart.request import Request
+from smart.scheduler import Scheduler, BloomDuplicateFilter
+
+
+class _Spider(object):
+    name = "checkpoint"
+
+    def parse(self, response):
+        pass
+
+
+class TestCheckpoint(object):
+    def test_save_and_load(self):
+        spider, directory = _Spider(), tempfile.mkdtemp()
+        scheduler = Scheduler()
+        checkpoint = Checkpoint(directory, spider, scheduler)
+        assert checkpoint.load() is None
+
+        def schedule(request):
+            if scheduler.schedlue(request):
+                checkpoint.push(request)
+
+        for i in range(5):
+            schedule(Request(f"http://a.com/{i}", callback=spider.parse))
+        # 已出队没有处理完的请求没有 done 记录 也会被保存
+        inflight = scheduler.get()
+        asyncio.run(checkpoint.save())
+        # 增量保存
+        schedule(Request("http://a.com/5", callback=spider.parse, priority=3))
+        checkpoint.done(scheduler.get())
+        size = os.path.getsize(os.path.join(directory, checkpoint.frontier_file))
+        asyncio.run(checkpoint.save())
+        assert os.path.getsize(os.path.join(directory, checkpoint.frontier_file)) > size
+
+        restored = Scheduler()
+        requests = Checkpoint(directory, spider, restored).load()
+        assert inflight.url == "http://a.com/0"
+        assert [r.url for r in requests] == [f"http://a.com/{i}" for i in (0, 2, 3, 4, 5)]
+        assert requests[0].callback == spider.parse and requests[-1].priority == 3
+        assert restored.duplicate_filter.length() == 6
+        assert not restored.schedlue(Request("http://a.com/3"))
+
+    def test_frontier_write_failed(self):
+        spider, directory = _Spider(), tempfile.mkdtemp()
+        scheduler = Scheduler()
+        checkpoint = Checkpoint(directory, spider, scheduler)
+
+        def schedule(url):
+            request = Request(url, callback=spider.parse)
+            if scheduler.schedlue(request):
+                checkpoint.push(request)
+
+        schedule("http://a.com/0")
+        asyncio.run(checkpoint.save())
+        schedule("http://a.com/1")
+        frontier = os.path.join(directory, checkpoint.frontier_file)
+        os.rename(frontier, frontier + ".bak")
+        # 待抓取请求写入失败 去重器的增量也不能丢失
+        os.mkdir(frontier)
+        try:
+            asyncio.run(checkpoint.save())
+        except OSError:
+            pass
+        else:
+            assert False
+        os.rmdir(frontier)
+        os.rename(frontier + ".bak", frontier)
+        schedule("http://a.com/2")
+        asyncio.run(checkpoint.save())
+        restored = Scheduler()
+        requests = Checkpoint(directory, spider, restored).load()
+        assert [r.url for r in requests] == [f"http://a.com/{i}" for i in range(3)]
+        assert restored.duplicate_filter.length() == 3
+
+    def test_compact(self):
+        spider, directory = _Spider(), tempfile.mkdtemp()
+        scheduler = Scheduler()
+        checkpoint = Checkpoint(directory, spider, scheduler)
+        checkpoint.compact_min = 10
+        requests = [Request(f"http://a.com/{i}", callback=spider.parse) for i in range(30)]
+        for request in requests:
+            scheduler.schedlue(request)
+            checkpoint.push(request)
+        asyncio.run(checkpoint.save())
+        size = os.path.getsize(os.path.join(directory, checkpoint.frontier_file))
+        for request in requests[:20]:
+            checkpoint.done(request)
+        asyncio.run(checkpoint.save())
+        # done 超过一半时压缩 只保留未完成的请求
+        assert checkpoint.pushes == 10 and checkpoint.dones == 0
+        assert os.path.getsize(os.path.join(directory, checkpoint.frontier_file)) < size / 2
+        # 最后一条记录不完整(写文件时进程退出)被忽略
+        with open(os.path.join(directory, checkpoint.frontier_file), "ab") as f:
+            f.write(b"P\x10")
+        loaded = Checkpoint(directory, spider, Scheduler()).load()
+        assert [r.url for r in loaded] == [f"http://a.com/{i}" for i in range(20, 30)]
+
+    def test_bloom(self):
+        spider, directory = _Spider(), tempfile.mkdtemp()
+        scheduler = Scheduler(BloomDuplicateFilter(capacity=100, error_rate=0.001))
+        request = Request("http://a.com/0", callback=spider.parse)
+        scheduler.schedlue(request)
+        checkpoint = Checkpoint(directory, spider, scheduler)
+        checkpoint.push(request)
+        asyncio.run(checkpoint.save())
+        restored = Scheduler(BloomDuplicateFilter(capacity=100, error_rate=0.001))
+        assert len(Checkpoint(directory, spider, restored).load()) == 1
+        assert restored.duplicate_filter.contains(restored._fingerprint(Request("http://a.com/0")))
@@ -0,0 +1,133 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      downloader_test
+# Author:    liangbaikai
+# Date:      2021/1/25
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+import asyncio
+
+from aiohttp import web
+
+from smart.downloader import AioHttpPoolDown, AioHttpDown, ResponseTooLarge, Downloader
+from smart.request import Request
+from smart.scheduler import Scheduler
+from smart.setting import gloable_setting_dict
+from smart.signal import reminder, Reminder
+
+
+async def _serve(peers):
+    async def handle(request):
+        peers.add(request.transport.get_extra_info("peername"))
+        return web.Response(text="ok")
+
+    async def big(request):
+        return web.Response(body=b"x" * 300000)
+
+    app = web.Application()
+    app.router.add_get("/", handle)
+    app.router.add_get("/big", big)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/"
+
+
+class _Engine:
+    def __init__(self, downer):
+        self.downloader = type("downloader", (), {"downer": downer})()
+
+
+class TestPoolDown(object):
+    def test_reuse_and_close(self):
+        async def run():
+            peers = set()
+            runner, url = await _serve(peers)
+            downer = AioHttpPoolDown()
+            try:
+                for _ in range(5):
+                    response = await downer.fetch(Request(url, timeout=3))
+                    assert response.status == 200
+                    assert response.body == b"ok"
+                # keep-alive: all requests go through one connection
+                assert len(peers) == 1
+                session = downer.session
+                reminder.go(Reminder.engin_close, _Engine(downer))
+                await asyncio.sleep(0.01)
+                assert session.closed and downer.session is None
+            finally:
+                await downer.close()
+                await runner.cleanup()
+
+        asyncio.run(run())
+
+
+class TestStreamDown(object):
+    def test_stream_and_max_body_size(self):
+        async def run():
+            runner, url = await _serve(set())
+            setting = {key: gloable_setting_dict.get(key) for key in ("stream_spool_size", "max_body_size")}
+            gloable_setting_dict["stream_spool_size"] = 100000
+            downer = AioHttpDown()
+            try:
+                response = await downer.fetch(Request(url + "big", timeout=3, stream=True))
+                assert response.body == b""
+                # 超过 stream_spool_size 已写入磁盘
+                assert response.file._rolled
+                assert sum(len(chunk) for chunk in response.iter_content()) == 300000
+                response.close()
+                gloable_setting_dict["max_body_size"] = 200000
+                for stream in (True, False):
+                    try:
+                        await downer.fetch(Request(url + "big", timeout=3, stream=stream))
+                    except ResponseTooLarge:
+                        pass
+                    else:
+                        assert False
+                response = await downer.fetch(Request(url, timeout=3))
+                assert response.body == b"ok" and response.file is None
+            finally:
+                gloable_setting_dict.update(setting)
+                await runner.cleanup()
+
+        asyncio.run(run())
+
+
+class _Spider:
+    cutome_setting_dict = {"req_delay": 1}
+
+
+class TestDownloader(object):
+    def test_cancel_in_req_delay(self):
+        async def run():
+            downloader = Downloader(Scheduler(), reminder=reminder, downer=AioHttpDown())
+            request = Request("http://127.0.0.1:1/")
+            request.__spider__ = _Spider()
+            task = asyncio.ensure_future(downloader.download(request))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            # 等待 req_delay 时被取消 没有响应
+            assert await task is None
+
+        asyncio.run(run())
+
+    def test_not_queue_response(self):
+        async def run():
+            runner, url = await _serve(set())
+            spider = _Spider()
+            spider.cutome_setting_dict = {}
+            try:
+                for queue_response in (True, False):
+                    downloader = Downloader(Scheduler(), reminder=reminder, downer=AioHttpDown(),
+                                            queue_response=queue_response)
+                    request = Request(url, timeout=3)
+                    request.__spider__ = spider
+                    response = await downloader.download(request)
+                    assert response.body == b"ok"
+                    assert downloader.response_queue.qsize() == (1 if queue_response else 0)
+            finally:
+                await runner.cleanup()
+
+        asyncio.run(run())
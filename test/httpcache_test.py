@@ -0,0 +1,97 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      httpcache_test
+# Author:    liangbaikai
+# Date:      2021/1/31
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+import asyncio
+import os
+import tempfile
+import time
+
+from aiohttp import web
+
+from smart.httpcache import HttpCacheDown, HttpCacheStore
+from smart.request import Request
+from smart.setting import gloable_setting_dict
+
+
+async def _serve(hits):
+    async def handle(request):
+        hits.append(request.headers.get("If-None-Match"))
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.Response(text="page", headers={"ETag": '"v1"'})
+
+    app = web.Application()
+    app.router.add_get("/", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/"
+
+
+class TestHttpCache(object):
+    def test_hit_and_revalidate(self):
+        keys = ("http_cache_dir", "http_cache_max_age", "http_cache_downer_class")
+        setting = {key: gloable_setting_dict.get(key) for key in keys}
+
+        async def run(directory):
+            hits = []
+            runner, url = await _serve(hits)
+            gloable_setting_dict.update(http_cache_dir=directory, http_cache_max_age=60,
+                                        http_cache_downer_class="smart.downloader.AioHttpDown")
+            downer = HttpCacheDown()
+            try:
+                for _ in range(3):
+                    response = await downer.fetch(Request(url, timeout=3))
+                    assert response.status == 200 and response.body == b"page"
+                assert hits == [None]
+                downer.max_age = 0
+                request = Request(url, timeout=3)
+                response = await downer.fetch(request)
+                assert response.status == 200 and response.body == b"page"
+                assert hits == [None, '"v1"']
+                assert not request.header
+            finally:
+                await downer.close()
+                await runner.cleanup()
+
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                asyncio.run(run(directory))
+        finally:
+            gloable_setting_dict.update(setting)
+
+    def test_evict_by_size_and_age(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = HttpCacheStore(os.path.join(directory, "cache.sqlite"), 1000, 3600)
+            for i in range(5):
+                store.put(bytes([i]), f"http://a.com/{i}", 200, {}, b"x" * 300)
+            assert store.size() <= 1000
+            assert store.get(bytes([4])) is not None
+            assert store.get(bytes([0])) is None
+            assert store.total_size == store.size()
+            store.conn.execute("UPDATE response SET stored_at=?", (time.time() - 7200,))
+            store.evict()
+            assert store.size() == 0 and store.total_size == 0
+            store.close()
+
+    def test_total_size(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.sqlite")
+            store = HttpCacheStore(path, 1000, 3600)
+            store.put(b"a", "http://a.com/a", 200, {}, b"x" * 300)
+            # 替换已有的响应 不重复计算大小
+            store.put(b"a", "http://a.com/a", 200, {}, b"x" * 200)
+            store.put(b"b", "http://a.com/b", 200, {}, b"x" * 100)
+            assert store.total_size == store.size() == 300
+            store.delete(b"b")
+            assert store.total_size == 200
+            store.close()
+            store = HttpCacheStore(path, 1000, 3600)
+            assert store.total_size == 200
+            store.close()
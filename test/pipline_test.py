@@ -0,0 +1,52 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      pipline_test
+# Author:    liangbaikai
+# Date:      2021/1/29
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+import asyncio
+
+from smart.pipline import Piplines, BatchPipline
+
+
+class TestBatchPipline(object):
+    def test_flush_on_size_time_and_close(self):
+        piplines = Piplines()
+        batches = []
+
+        @piplines.batch(1, size=3, max_wait=0.05)
+        async def to_db(spider_ins, items):
+            batches.append(list(items))
+
+        assert piplines.batch_piplines[0][1] is to_db
+
+        async def run():
+            _, func, size, max_wait = piplines.batch_piplines[0]
+            batch_pipline = BatchPipline(func, size, max_wait)
+            for i in range(4):
+                await batch_pipline.add(None, i)
+            assert batches == [[0, 1, 2]]
+            await asyncio.sleep(0.1)
+            assert batches == [[0, 1, 2], [3]]
+            await batch_pipline.add(None, 4)
+            await batch_pipline.close(None)
+            assert batches == [[0, 1, 2], [3], [4]]
+
+        asyncio.run(run())
+
+    def test_sync_batch(self):
+        piplines = Piplines()
+        batches = []
+
+        @piplines.batch(size=2)
+        def to_file(spider_ins, items):
+            batches.append(items)
+
+        async def run():
+            batch_pipline = BatchPipline(*piplines.batch_piplines[0][1:])
+            await batch_pipline.add(None, 1)
+            await batch_pipline.close(None)
+
+        asyncio.run(run())
+        assert batches == [[1]]
@@ -0,0 +1,63 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      process_test
+# Author:    liangbaikai
+# Date:      2021/1/29
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+import asyncio
+import os
+
+from smart.item import Item
+from smart.process import run_in_process, create_process_pool, call_callback, call_pipline, \
+    response_to_tuple, results_from_process
+from smart.request import Request
+from smart.response import Response
+from smart.spider import Spider
+
+
+class TitleItem(Item):
+    title = None
+    pid = None
+
+
+class ProcessSpider(Spider):
+    name = "process_spider"
+
+    @run_in_process
+    def parse(self, response):
+        item = TitleItem.get_item("x")
+        item.title = response.xpath("//title/text()").get()
+        item.pid = os.getpid()
+        yield item
+        yield Request(response.urljoin("/next"), callback=self.parse)
+
+
+@run_in_process
+def upper_pipline(spider_ins, item):
+    item["title"] = item["title"].upper() + spider_ins.name
+    return item
+
+
+class TestProcess(object):
+    def test_callback_and_pipline_in_process(self):
+        spider = ProcessSpider()
+        request = Request("http://127.0.0.1/page", callback=spider.parse)
+        response = Response(b"<html><title>hi</title></html>", 200, request=request, headers={})
+
+        async def run():
+            pool = create_process_pool(spider, 1)
+            loop = asyncio.get_running_loop()
+            try:
+                results = await loop.run_in_executor(pool, call_callback, "parse", response_to_tuple(response))
+                item, next_request = list(results_from_process(results, spider))
+                item = await loop.run_in_executor(pool, call_pipline, upper_pipline, item)
+            finally:
+                pool.shutdown()
+            return item, next_request
+
+        item, next_request = asyncio.run(run())
+        assert item["title"] == "HIprocess_spider"
+        assert item["pid"] != os.getpid()
+        assert next_request.url == "http://127.0.0.1/next"
+        assert next_request.callback == spider.parse
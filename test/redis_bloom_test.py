@@ -0,0 +1,73 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      redis_bloom_test
+# Author:    liangbaikai
+# Date:      2021/2/2
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+import asyncio
+import threading
+
+import pytest
+
+from smart.request import Request
+from smart.scheduler import Scheduler, DequeSchedulerContainer
+
+fakeredis = pytest.importorskip("fakeredis")
+# fakeredis 需要 lupa 才能执行 lua 脚本
+pytest.importorskip("lupa")
+
+from spiders.distributed import RedisBloomDuplicateFilter, AioRedisBackend, AioRedisBloomDuplicateFilter
+
+
+class TestRedisBloom(object):
+    def test_fixed_memory_and_error_rate(self):
+        client = fakeredis.FakeRedis()
+        bloom_filter = RedisBloomDuplicateFilter(client, capacity=1000, error_rate=0.01, shards=3)
+        bloom = bloom_filter.bloom
+        added = sum(bloom_filter.add_if_absent(f"http://a.com/{i}") for i in range(1000))
+        assert added > 985
+        assert bloom_filter.length() == added
+        assert not any(bloom_filter.add_if_absent(f"http://a.com/{i}") for i in range(1000))
+        assert all(bloom_filter.contains(f"http://a.com/{i}") for i in range(1000))
+        false_positives = sum(bloom_filter.contains(f"http://b.com/{i}") for i in range(2000))
+        assert false_positives < 2000 * 0.03
+        # 元素分布在所有分片 每个分片的内存不超过 bits_per_shard
+        sizes = [client.strlen(key) for key in bloom.bit_keys]
+        assert all(0 < size <= bloom.bits_per_shard // 8 + 1 for size in sizes)
+        # 参数不一致的节点不能使用同一个过滤器
+        with pytest.raises(ValueError):
+            RedisBloomDuplicateFilter(client, capacity=2000, error_rate=0.01, shards=3)
+        scheduler = Scheduler(RedisBloomDuplicateFilter(client, capacity=1000, error_rate=0.01, shards=3),
+                              DequeSchedulerContainer())
+        assert not scheduler.schedlue(Request("http://a.com/1"))
+        assert scheduler.schedlue(Request("http://c.com/1"))
+
+    def test_shards_for_large_capacity(self):
+        bloom_filter = RedisBloomDuplicateFilter(fakeredis.FakeRedis(), capacity=10 ** 9, error_rate=0.0001,
+                                                 shards=1)
+        bloom = bloom_filter.bloom
+        # 约 2.4GB 单个 key 最大 512MB
+        assert bloom.shards == 5 and bloom.bits_per_shard <= 2 ** 32
+
+    def test_aio(self):
+        server = fakeredis.TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+
+        async def run():
+            backend = AioRedisBackend(f"redis://{host}:{port}/0")
+            backend.users = 1
+            bloom_filter = AioRedisBloomDuplicateFilter(backend, capacity=1000, error_rate=0.01, shards=2)
+            results = await asyncio.gather(*(bloom_filter.add_if_absent(f"http://a.com/{i % 100}")
+                                             for i in range(200)))
+            assert 95 < results.count(True) <= 100
+            assert await bloom_filter.contains("http://a.com/1")
+            assert await bloom_filter.length() == results.count(True)
+            await backend.release()
+
+        try:
+            asyncio.run(run())
+        finally:
+            server.shutdown()
+            server.server_close()
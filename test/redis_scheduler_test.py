@@ -0,0 +1,126 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      redis_scheduler_test
+# Author:    liangbaikai
+# Date:      2021/2/2
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+import threading
+import time
+
+import pytest
+
+from smart.request import Request
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from spiders.distributed import RedisSchuler, RedisLeaseSchuler
+
+
+def _wait(condition, timeout=3):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestRedisSchuler(object):
+    def test_batch_push_and_prefetch(self):
+        client = fakeredis.FakeRedis()
+        commands = []
+        execute_command = client.execute_command
+
+        main_commands = []
+
+        def record(*args, **kwargs):
+            commands.append(args[0])
+            if threading.current_thread() is threading.main_thread():
+                main_commands.append(args[0])
+            return execute_command(*args, **kwargs)
+
+        client.execute_command = record
+        pipeline = client.pipeline
+
+        def record_pipeline(*args, **kwargs):
+            commands.append("PIPELINE")
+            return pipeline(*args, **kwargs)
+
+        client.pipeline = record_pipeline
+        container = RedisSchuler(client, prefetch_size=50, batch_size=100)
+        try:
+            for i in range(1000):
+                container.push(Request(f"http://a.com/{i}"))
+            assert _wait(lambda: container.size() == 1000)
+            # size() 使用后台线程的统计 不访问 redis
+            main_commands.clear()
+            for _ in range(100):
+                container.size()
+            assert not main_commands
+            urls = []
+            assert _wait(lambda: len(container.caches) == 50)
+            while len(urls) < 1000:
+                request = container.pop()
+                if request is None:
+                    time.sleep(0.001)
+                    continue
+                urls.append(request.url)
+            assert urls == [f"http://a.com/{i}" for i in range(1000)]
+            # 批量发送和预取 远少于每个请求一次往返
+            assert commands.count("PIPELINE") < 100 and commands.count("LPOP") < 100
+            # 队列为空时阻塞等待 不轮询
+            assert _wait(lambda: "BLPOP" in commands)
+            container.push(Request("http://a.com/last"))
+            assert _wait(lambda: container.caches)
+            assert _wait(lambda: container.size() == 1)
+        finally:
+            container.close()
+        # 未使用的预取请求放回 redis
+        assert client.llen(container.task_queue_name) == 1
+        client.delete(container.task_queue_name)
+
+
+class TestRedisLeaseSchuler(object):
+    def test_ack_and_reclaim(self):
+        server = fakeredis.FakeServer()
+        node = RedisLeaseSchuler(fakeredis.FakeRedis(server=server),
+                                 prefetch_size=100, lease_timeout=0.3)
+        client = node.redis
+        for i in range(10):
+            node.push(Request(f"http://a.com/{i}"))
+        assert _wait(lambda: len(node.caches) == 10)
+        # 预取的请求在处理中列表中 不会因为宕机丢失
+        assert client.llen(node.processing_name) == 10 and client.llen(node.task_queue_name) == 0
+        for _ in range(3):
+            request = node.pop()
+        node.ack(Request("http://a.com/unknown"))
+        node.ack(request)
+        assert _wait(lambda: client.llen(node.processing_name) == 9)
+        # 模拟宕机: 停止线程 不归还请求 不续租
+        node._stop = True
+        node.heartbeat_event.set()
+        node.push_event.set()
+        node.space_event.set()
+        for thread in node.threads:
+            thread.join()
+        time.sleep(0.35)
+        other = RedisLeaseSchuler(fakeredis.FakeRedis(server=server),
+                                  prefetch_size=100, lease_timeout=0.3)
+        try:
+            assert not client.exists(node.processing_name)
+            urls = []
+            assert _wait(lambda: len(other.caches) == 9)
+            while other.caches:
+                urls.append(other.pop().url)
+            # 没有 ack 的请求按原顺序被回收
+            assert urls == [f"http://a.com/{i}" for i in range(10) if i != 2]
+            # 处理中的请求也计入 size
+            assert _wait(lambda: other.size() == 9)
+            for request, _ in list(other.leases.values())[:5]:
+                other.ack(request)
+            assert _wait(lambda: other.size() == 4)
+        finally:
+            other.close()
+        # 正常关闭时没有 ack 的请求放回队列 节点注销
+        assert client.llen(other.task_queue_name) == 4
+        assert client.zcard(other.nodes_name) == 0
+        client.flushall()
@@ -0,0 +1,43 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      request_test
+# Author:    liangbaikai
+# Date:      2021/1/30
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+import pickle
+
+import pytest
+
+from smart.request import Request
+from smart.response import Response
+
+
+def parse(response):
+    pass
+
+
+class TestSlots(object):
+    def test_no_dict(self):
+        request = Request("http://a.com/x")
+        response = Response(b"", 200, request=request)
+        for value in (request, response):
+            assert not hasattr(value, "__dict__")
+            with pytest.raises(AttributeError):
+                value.unknown = 1
+        # 框架设置的属性在 __slots__ 中
+        request.__spider__ = None
+        response.__spider__ = None
+
+    def test_pickle(self):
+        request = Request("http://a.com/x", callback=parse, method="post", header={"a": "b"},
+                          meta={"page": 2}, priority=3)
+        request.retry = 1
+        restored = pickle.loads(pickle.dumps(request))
+        assert restored == request
+        assert restored.url == "http://a.com/x" and restored.retry == 1
+        response = Response(b"<p>x</p>", 200, request=request, headers={"Content-Type": "text/html"})
+        restored = pickle.loads(pickle.dumps(response))
+        assert restored == response
+        assert restored.request.url == "http://a.com/x"
+        assert restored.text == "<p>x</p>"
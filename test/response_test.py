@@ -0,0 +1,35 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      response_test
+# Author:    liangbaikai
+# Date:      2021/1/30
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+from smart.request import Request
+from smart.response import Response
+
+
+class TestResponseText(object):
+    def _response(self, body, headers=None, encoding=None):
+        return Response(body, 200, request=Request("http://a.com", encoding=encoding), headers=headers or {})
+
+    def test_header_charset(self):
+        response = self._response("中文".encode("gbk"), {"Content-Type": "text/html; charset=GBK"})
+        assert response.text == "中文"
+        assert response.encoding == "gbk"
+        assert response.text is response.text
+
+    def test_meta_charset(self):
+        body = '<html><head><meta charset="gb2312"></head><body>中文</body></html>'.encode("gbk")
+        response = self._response(body, {"Content-Type": "text/html; charset=unknown-charset"})
+        assert response.encoding is None
+        assert response.xpath("//body/text()").get() == "中文"
+        assert response.encoding == "gb2312"
+
+    def test_request_encoding_first(self):
+        response = self._response("中文".encode("utf-8"), {"Content-Type": "text/html; charset=gbk"}, "utf-8")
+        assert response.text == "中文"
+
+    def test_detect(self):
+        response = self._response(("<p>中文内容</p>" * 50).encode("utf-8"))
+        assert response.text.startswith("<p>中文内容</p>")
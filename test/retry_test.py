@@ -0,0 +1,62 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      retry_test
+# Author:    liangbaikai
+# Date:      2021/1/31
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+import asyncio
+
+from smart.request import Request
+from smart.retry import RetryManager
+
+
+class _Spider:
+    cutome_setting_dict = {"req_max_retry": 3, "retry_backoff_base": 0.02, "retry_backoff_max": 0.05,
+                           "retry_jitter": 0, "circuit_breaker_threshold": 2, "circuit_breaker_cooldown": 0.1}
+
+
+class TestRetryManager(object):
+    def test_backoff_and_drop(self):
+        manager = RetryManager(None, _Spider())
+        request = Request("http://a.com/1")
+        request.retry = 1
+        assert manager.backoff(request) == 0.02
+        request.retry = 1
+        assert manager.backoff(request) == 0.04
+        request.retry = 1
+        assert manager.backoff(request) == 0.05
+        assert manager.retry(request, 503) is False
+        assert manager.size() == 0
+        assert manager.is_retry_status(503) and not manager.is_retry_status(200)
+        assert manager.is_retry_exception(asyncio.TimeoutError())
+        assert not manager.is_retry_exception(ValueError())
+
+    def test_delayed_requeue_and_circuit_breaker(self):
+        scheduled = []
+
+        async def schedule(request):
+            scheduled.append(request.url)
+
+        async def run():
+            manager = RetryManager(schedule, _Spider())
+            first, second = Request("http://a.com/1"), Request("http://a.com/2")
+            first.retry = 1
+            second.retry = 1
+            assert manager.retry(first, 503)
+            assert manager.allow(second)
+            assert manager.retry(second, 503)
+            # 连续失败 2 次 熔断
+            assert not manager.allow(Request("http://a.com/3"))
+            assert manager.allow(Request("http://b.com/1"))
+            assert manager.size() == 2 and scheduled == []
+            await asyncio.sleep(0.05)
+            # 熔断期间不会放回调度器
+            assert scheduled == []
+            await asyncio.sleep(0.1)
+            assert sorted(scheduled) == ["http://a.com/1", "http://a.com/2"]
+            assert manager.size() == 0
+            manager.record_success(first)
+            assert manager.allow(first)
+
+        asyncio.run(run())
@@ -0,0 +1,112 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      sanicdb_test
+# Author:    liangbaikai
+# Date:      2021/1/29
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+import asyncio
+
+import pymysql
+
+from spiders.db.sanicdb import SanicDB
+
+
+class FakeCursor:
+    def __init__(self, executed):
+        self.executed = executed
+        self.rowcount = 0
+
+    async def execute(self, query, parameters):
+        self.executed.append((query, parameters))
+        if "dup" in parameters:
+            raise pymysql.err.IntegrityError(1062, "Duplicate entry 'dup' for key 'name'")
+        if "bad" in parameters:
+            raise pymysql.err.IntegrityError(1048, "Column 'name' cannot be null")
+        self.rowcount = len(parameters) // query.count("%s") * query.count("(%s")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeConn:
+    def __init__(self, executed):
+        self.executed = executed
+
+    def cursor(self):
+        return FakeCursor(self.executed)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakePool:
+    def __init__(self):
+        self.executed = []
+        self.acquired = 0
+
+    def acquire(self):
+        self.acquired += 1
+        return FakeConn(self.executed)
+
+
+class TestSanicDBMany(object):
+    def _db(self):
+        db = SanicDB("localhost", "testdb", "root", "root")
+        db.pool = FakePool()
+        return db
+
+    def test_insert_many_chunked(self):
+        db = self._db()
+        items = [{"name": f"n{i}", "content": "x" * 100} for i in range(50)]
+        rows = asyncio.run(db.table_insert_many("test", items, max_packet_size=1024))
+        executed = db.pool.executed
+        assert rows == 50
+        assert db.pool.acquired == 1
+        assert len(executed) > 1
+        assert all(query.startswith("INSERT INTO test (name,content) VALUES (%s,%s),") for query, _ in executed)
+        assert [p for _, params in executed for p in params[::2]] == [f"n{i}" for i in range(50)]
+
+    def test_insert_many_duplicated(self):
+        db = self._db()
+        items = [{"name": "a", "content": "1"}, {"name": "dup", "content": "2"}, {"name": "b", "content": "3"}]
+        rows = asyncio.run(db.table_insert_many("test", items))
+        executed = db.pool.executed
+        assert rows == 2
+        assert len(executed) == 4
+        assert [query for query, _ in executed[1:]] == ["INSERT INTO test (name,content) VALUES (%s,%s)"] * 3
+        assert [params for _, params in executed[1:]] == [["a", "1"], ["dup", "2"], ["b", "3"]]
+
+    def test_insert_many_other_error(self):
+        db = self._db()
+        items = [{"name": "bad", "content": "1"}]
+        try:
+            asyncio.run(db.table_insert_many("test", items))
+        except pymysql.err.IntegrityError as e:
+            assert e.args[0] == 1048
+        else:
+            assert False
+
+    def test_upsert_many(self):
+        db = self._db()
+        items = [{"name": "a", "content": "1"}, {"name": "b", "content": "2"}]
+        asyncio.run(db.table_upsert_many("test", items, update_fields=["content"]))
+        (query, params), = db.pool.executed
+        assert query == "INSERT INTO test (name,content) VALUES (%s,%s),(%s,%s) " \
+                        "ON DUPLICATE KEY UPDATE content=VALUES(content)"
+        assert params == ["a", "1", "b", "2"]
+
+    def test_insert_many_different_fields(self):
+        db = self._db()
+        try:
+            asyncio.run(db.table_insert_many("test", [{"name": "a"}, {"content": "b"}]))
+        except ValueError:
+            pass
+        else:
+            assert False
@@ -0,0 +1,148 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      scheduler_test
+# Author:    liangbaikai
+# Date:      2021/1/25
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+import asyncio
+import os
+import tempfile
+import time
+
+from smart.request import Request
+from smart.scheduler import DomainSchedulerContainer, PrioritySchedulerContainer, AsyncPrioritySchedulerContainer, \
+    Scheduler, DiskSpillSchedulerContainer
+from smart.tool import request_fingerprint
+
+
+class TestDomainSchedulerContainer(object):
+    def test_round_robin_and_concurrency(self):
+        container = DomainSchedulerContainer(domain_concurrency=1, domain_delay=0)
+        for i in range(3):
+            container.push(Request(f"http://a.com/{i}"))
+        container.push(Request("http://b.com/0"))
+        assert container.size() == 4
+        first = container.pop()
+        second = container.pop()
+        assert first.url == "http://a.com/0"
+        assert second.url == "http://b.com/0"
+        # a.com 已有一个在途请求
+        assert container.pop() is None
+        container.release(first)
+        assert container.pop().url == "http://a.com/1"
+        assert container.size() == 1
+
+    def test_domain_delay(self):
+        container = DomainSchedulerContainer(domain_concurrency=0, domain_delay=0.05)
+        container.push(Request("http://a.com/0"))
+        container.push(Request("http://a.com/1"))
+        assert container.pop() is not None
+        assert container.pop() is None
+        time.sleep(0.06)
+        assert container.pop().url == "http://a.com/1"
+
+    def test_spider_setting(self):
+        spider = type("spider", (), {"cutome_setting_dict": {"domain_concurrency": 1, "domain_delay": 0}})()
+        scheduler = Scheduler(scheduler_container=DomainSchedulerContainer(domain_delay=0.5))
+        scheduler.open(spider)
+        container = scheduler.scheduler_container
+        # 爬虫的配置优先于全局配置 构造时指定的参数优先于爬虫的配置
+        assert container.domain_concurrency == 1 and container.domain_delay == 0.5
+        container.push(Request("http://a.com/0"))
+        container.push(Request("http://a.com/1"))
+        assert container.pop() is not None
+        assert container.pop() is None
+
+
+class TestPrioritySchedulerContainer(object):
+    def test_priority_and_stable_order(self):
+        container = PrioritySchedulerContainer()
+        container.push(Request("http://a.com/low", priority=-1))
+        container.push(Request("http://a.com/0"))
+        container.push(Request("http://a.com/high", priority=5))
+        container.push(Request("http://a.com/1"))
+        urls = [container.pop().url for _ in range(container.size())]
+        assert urls == ["http://a.com/high", "http://a.com/0", "http://a.com/1", "http://a.com/low"]
+        assert container.pop() is None
+
+    def test_async(self):
+        async def run():
+            container = AsyncPrioritySchedulerContainer()
+            await container.push(Request("http://a.com/0"))
+            await container.push(Request("http://a.com/1", priority=1))
+            return [(await container.pop()).url for _ in range(2)]
+
+        assert asyncio.run(run()) == ["http://a.com/1", "http://a.com/0"]
+
+
+class TestFingerprint(object):
+    def test_canonical(self):
+        fingerprint = request_fingerprint("http://WWW.a.com:80/x?b=2&a=1#top")
+        assert len(fingerprint) == 16
+        assert fingerprint == request_fingerprint("http://www.a.com/x?a=1&b=2")
+        assert fingerprint != request_fingerprint("http://www.a.com/x?a=1&b=2", "post")
+        assert fingerprint != request_fingerprint("http://www.a.com/x?a=1&b=2", retry=1)
+        assert request_fingerprint("http://a.com/", "post", {"b": 1, "a": 2}) == \
+               request_fingerprint("http://a.com", "POST", "a=2&b=1")
+        assert len(request_fingerprint("http://a.com", digest_size=8)) == 8
+
+    def test_scheduler_filter(self):
+        scheduler = Scheduler()
+        assert scheduler.schedlue(Request("http://a.com/?a=1&b=2"))
+        assert not scheduler.schedlue(Request("http://a.com/?b=2&a=1"))
+        assert scheduler.schedlue(Request("http://a.com/?b=2&a=1", dont_filter=True))
+        assert scheduler.scheduler_container.size() == 2
+        assert all(isinstance(x, bytes) for x in scheduler.duplicate_filter.set_container)
+
+    def test_spider_digest_size(self):
+        spider = type("spider", (), {"cutome_setting_dict": {"fingerprint_digest_size": 8}})()
+        scheduler = Scheduler()
+        scheduler.open(spider)
+        assert scheduler.schedlue(Request("http://a.com/x"))
+        assert len(next(iter(scheduler.duplicate_filter.set_container))) == 8
+        # url 和请求计算出的指纹字节数相同
+        assert scheduler.duplicate_filter.contains("http://a.com/x")
+        assert not scheduler.schedlue(Request("http://a.com/x"))
+
+
+class TestDiskSpillSchedulerContainer(object):
+    def parse(self, response):
+        pass
+
+    def test_spill_order(self):
+        container = DiskSpillSchedulerContainer(memory_size=5, spill_dir=tempfile.mkdtemp(), segment_size=4)
+        for i in range(23):
+            container.push(Request(f"http://a.com/{i}", callback=self.parse, meta={"i": i}))
+        assert container.size() == 23
+        assert container.spilled == 18
+        urls = []
+        for i in range(10):
+            urls.append(container.pop().url)
+        for i in range(23, 30):
+            container.push(Request(f"http://a.com/{i}", callback=self.parse, meta={"i": i}))
+        assert container.size() == 20
+        while container.size():
+            request = container.pop()
+            assert request.callback == self.parse
+            assert request.meta["i"] == int(request.url.split("/")[-1])
+            urls.append(request.url)
+        assert urls == [f"http://a.com/{i}" for i in range(30)]
+        assert container.pop() is None
+        container.close()
+        assert not os.path.exists(container.directory)
+
+    def test_unrestorable_callback(self):
+        container = DiskSpillSchedulerContainer(memory_size=1, spill_dir=tempfile.mkdtemp(), segment_size=4)
+        container.push(Request("http://a.com/0", callback=self.parse))
+        callback = lambda response: None
+        # lambda 无法按名称还原 保存在内存中
+        container.push(Request("http://a.com/1", callback=callback))
+        container.push(Request("http://a.com/2", callback=self.parse))
+        container.push(Request("http://a.com/3", callback=self.parse))
+        assert container.spilled == 2 and container.size() == 4
+        assert [container.pop().url for _ in range(2)] == ["http://a.com/0", "http://a.com/1"]
+        # 无法还原的记录被跳过
+        container.owners.clear()
+        assert container.pop() is None and container.size() == 0
+        container.close()
@@ -0,0 +1,74 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      serialize_test
+# Author:    liangbaikai
+# Date:      2021/2/2
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+from collections import OrderedDict
+
+import pytest
+
+from smart.request import Request
+from smart.serialize import dumps_request, loads_request, WIRE_VERSION
+
+
+class _Spider:
+    def parse(self, response):
+        pass
+
+
+def parse_detail(response):
+    pass
+
+
+class TestWireFormat(object):
+    def test_round_trip(self):
+        spider = _Spider()
+        request = Request("http://a.com/x", callback=spider.parse, method="post", timeout=3.5,
+                          header={"a": "b"}, data=b"\x00\xff", priority=-2, stream=True,
+                          meta={"page": 2 ** 40, "tags": ["x", None, True], "pair": (1, 2.5), "u": "中文" * 200})
+        request.retry = 2
+        data = dumps_request(request)
+        restored = loads_request(data, spider)
+        assert restored == request
+        # 没有 owner 时回调函数保留为名称
+        assert loads_request(data).callback == "parse"
+        # 默认值不写入
+        assert len(dumps_request(Request("http://a.com/x"))) == 25
+
+    def test_errors(self):
+        with pytest.raises(TypeError):
+            dumps_request(Request("http://a.com/", meta={"obj": object()}))
+        data = bytearray(dumps_request(Request("http://a.com/")))
+        data[1] = WIRE_VERSION + 1
+        with pytest.raises(ValueError):
+            loads_request(bytes(data))
+        with pytest.raises(ValueError):
+            loads_request(b"\x80\x04")
+
+    def test_callback_module(self):
+        spider = _Spider()
+        data = dumps_request(Request("http://a.com/", callback=parse_detail))
+        assert loads_request(data, spider).callback is parse_detail
+        # 只从 spider 所在的模块获取回调函数 不导入数据中的其他模块
+        data = dumps_request(Request("http://a.com/", callback="os:system"))
+        with pytest.raises(ValueError):
+            loads_request(data, spider)
+        assert loads_request(data).callback == "os:system"
+
+    def test_plain_types(self):
+        request = Request("http://a.com/", header=OrderedDict(a="b"), meta={"data": bytearray(b"x")})
+        restored = loads_request(dumps_request(request))
+        assert type(restored.header) is dict and restored.header == {"a": "b"}
+        assert restored.meta == {"data": b"x"}
+
+    def test_version_1(self):
+        data = (b"\xa5\x01s\x0ehttp://a.com/x\x01\x05s\x05parsem\x01s\x04pagei\x02\x00\x00\x00\x00\x00\x00\x00"
+                b"i\x01\x00\x00\x00\x00\x00\x00\x00")
+        assert loads_request(data) == Request("http://a.com/x", callback="parse", meta={"page": 2}, priority=1)
+
+    def test_big_int(self):
+        values = [2 ** 63 - 1, -2 ** 63, 2 ** 63, -2 ** 63 - 1, 2 ** 200, -2 ** 200]
+        request = Request("http://a.com/", meta={"ids": values})
+        assert loads_request(dumps_request(request)).meta == {"ids": values}
@@ -0,0 +1,34 @@
+# -*- coding utf-8 -*-#
+# ------------------------------------------------------------------
+# Name:      shard_test
+# Author:    liangbaikai
+# Date:      2021/1/30
+# Desc:      there is a python file description
+# ------------------------------------------------------------------
+import multiprocessing
+
+from smart.request import Request
+from smart.serialize import request_from_tuple
+from smart.shard import shard_of, ShardContext
+
+
+class TestShard(object):
+    def test_shard_of_host(self):
+        assert shard_of("http://a.com/1", 4) == shard_of("http://A.com/2?x=1", 4)
+        assert len({shard_of(f"http://host{i}.com/", 4) for i in range(50)}) == 4
+
+    def test_done_waits_for_pending(self):
+        context = ShardContext(2, multiprocessing.get_context())
+        context.send(1, Request("http://b.com/1"))
+        assert not context.is_done(0)
+        assert not context.is_done(1)
+        data = context.receive(1, 1)
+        assert request_from_tuple(data).url == "http://b.com/1"
+        # 已取出但未放入调度器 仍未结束
+        assert not context.is_done(0)
+        context.received()
+        assert not context.done.is_set()
+        context.busy(1)
+        assert not context.is_done(0)
+        assert context.is_done(1)
+        assert context.is_done(0)